@@ -1,14 +1,17 @@
 from __future__ import annotations
 
+import hashlib
 import logging
 from datetime import datetime, timedelta
 
 import jose.exceptions
 import jose.jwt
 from dateutil.tz import UTC
-from fastapi import HTTPException, Request, status
+from fastapi import HTTPException, Request, WebSocket, WebSocketException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from fastapi.security.utils import get_authorization_scheme_param
 
+from .cache import LRUCache
 from .settings import Settings
 
 logger = logging.getLogger(__name__)
@@ -18,6 +21,11 @@ SECRET_KEY = Settings().jwt_secret
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Already-verified tokens, keyed on a hash of the credentials
+token_cache: LRUCache[str, "UserToken"] = LRUCache(
+    max_entries=Settings.get().jwt_cache_size
+)
+
 
 def create_access_token(
     data: dict, expires_delta: timedelta | None = None, expires: datetime = None
@@ -66,23 +74,74 @@ class JWTBearer(HTTPBearer):
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid authentication scheme",
                 )
-            try:
-                data = jose.jwt.decode(
-                    token.credentials, SECRET_KEY, algorithms=[ALGORITHM]
-                )
-            except jose.exceptions.ExpiredSignatureError:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Expired token",
-                )
-            except jose.exceptions.JWTError:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail="Invalid authentication token",
-                )
-            return UserToken.from_jwt(data)
+            return verify_token(token.credentials)
         else:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid authorization credentials.",
             )
+
+
+async def verify_websocket(websocket: WebSocket) -> UserToken:
+    """
+    Authenticate a WebSocket connection, as JWTBearer does HTTP requests.
+
+    Browsers can't set headers on WebSocket connections, so the token may
+    instead be given as the token query parameter. The connection is closed
+    with a policy violation if the token is missing or invalid.
+    """
+    authorization = websocket.headers.get("Authorization")
+    if authorization:
+        scheme, credentials = get_authorization_scheme_param(authorization)
+        if scheme.lower() != "bearer":
+            raise WebSocketException(
+                code=status.WS_1008_POLICY_VIOLATION,
+                reason="Invalid authentication scheme",
+            )
+    else:
+        credentials = websocket.query_params.get("token")
+    if not credentials:
+        raise WebSocketException(
+            code=status.WS_1008_POLICY_VIOLATION,
+            reason="Invalid authorization credentials.",
+        )
+    try:
+        return verify_token(credentials)
+    except HTTPException as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+
+
+def verify_token(credentials: str) -> UserToken:
+    """
+    Verify a JWT, responding 401 if it is invalid or has expired.
+
+    Successfully verified tokens are cached until they expire, so that clients
+    reusing the same token for many requests only pay for verifying it once.
+    Invalid tokens are never cached.
+    """
+    key = hashlib.sha256(credentials.encode()).hexdigest()
+    user_token = token_cache.get(key) if token_cache.max_entries else None
+    if user_token is not None:
+        if user_token.expiry > datetime.now(tz=UTC):
+            return user_token
+        token_cache.discard(lambda k: k == key)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Expired token",
+        )
+    try:
+        data = jose.jwt.decode(credentials, SECRET_KEY, algorithms=[ALGORITHM])
+    except jose.exceptions.ExpiredSignatureError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Expired token",
+        )
+    except jose.exceptions.JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication token",
+        )
+    user_token = UserToken.from_jwt(data)
+    if token_cache.max_entries:
+        token_cache.put(key, user_token)
+    return user_token
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Generic, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """
+    A thread-safe least-recently-used cache.
+
+    The cache is bounded by the number of entries and, optionally, by the total
+    size in bytes of its entries as estimated by the sizeof callable. The least
+    recently used entries are evicted once either limit is exceeded.
+    """
+
+    def __init__(
+        self,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        sizeof: Callable[[V], int] | None = None,
+    ):
+        if max_bytes is not None and sizeof is None:
+            raise ValueError("sizeof must be provided if max_bytes is set")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[K, tuple[V, int]] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    def get(self, key: K, default: V | None = None) -> V | None:
+        with self._lock:
+            try:
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: K, value: V):
+        size = self._sizeof(value) if self._sizeof else 0
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if self.max_bytes is not None and size > self.max_bytes:
+                # Never going to fit, so don't flush everything else trying
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries)
+                or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_create(self, key: K, factory: Callable[[], V]) -> V:
+        """
+        Return the cached value for key, calling factory() to create it if absent.
+
+        The lock is not held while calling factory(), so concurrent misses for
+        the same key may each call factory().
+        """
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def discard(self, predicate: Callable[[K], bool]) -> int:
+        """Remove all entries whose key matches predicate, returning the number removed"""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self.nbytes -= self._entries.pop(key)[1]
+            self.evictions += len(keys)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class DiskCache:
+    """
+    A least-recently-used cache of byte strings stored as files in a directory.
+
+    Keys must be valid file names, e.g. hex digests. Entries already present in
+    the directory are picked up on construction, so the cache survives server
+    restarts. Entries are evicted, least recently used first, once their total
+    size exceeds max_bytes.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        existing = sorted(
+            (p.stat().st_mtime_ns, p.name, p.stat().st_size)
+            for p in self.directory.iterdir()
+            if p.is_file() and not p.name.startswith(".")
+        )
+        for _, key, size in existing:
+            self._entries[key] = size
+            self.nbytes += size
+        with self._lock:
+            self._evict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            data = (self.directory / key).read_bytes()
+        except FileNotFoundError:
+            # Removed from under us
+            with self._lock:
+                self.nbytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        # Write to a temporary file first so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.directory / key)
+        except OSError as e:
+            logger.warning(f"Failed to write {key} to disk cache: {e}")
+            Path(tmp).unlink(missing_ok=True)
+            return
+        with self._lock:
+            self.nbytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._entries and self.nbytes > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+            (self.directory / key).unlink(missing_ok=True)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def file_identity(path: Path) -> tuple[int, int] | None:
+    """
+    A cheap fingerprint of a file's contents, i.e. its modification time and size.
+
+    For a filename template e.g. image_#####.cbf, this instead fingerprints the
+    containing directory, which changes whenever an image is added or removed.
+    Returns None if the file does not exist.
+    """
+    if "#" in path.stem:
+        path = path.parent
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
@@ -0,0 +1,316 @@
+"""
+Benchmark the latency and throughput of the dials-rest server on synthetic data.
+
+Synthetic CBF and NeXus datasets are generated in a temporary directory, then
+/find_spots/ and /export_bitmap/ requests for their images are sent at each of
+the requested concurrency levels. Requests cycle through the images of each
+dataset, so once every image has been requested the server's caches are warm.
+
+By default the benchmark runs against an in-process server. Use --url to
+benchmark a running server instead; it must be able to read the benchmark's
+temporary directory (see --data-dir).
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .. import __version__
+from ..synthetic import Geometry, synthetic_image, write_cbf, write_nexus
+
+
+def _int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(",")]
+
+
+def _str_list(value: str) -> list[str]:
+    return value.split(",")
+
+
+def _detector_size(value: str) -> tuple[int, int]:
+    fast, slow = (int(v) for v in value.lower().split("x"))
+    return fast, slow
+
+
+def generate_datasets(
+    directory: Path,
+    formats: list[str],
+    detector_size: tuple[int, int],
+    n_images: int,
+    n_spots: int,
+    seed: int = 0,
+) -> dict[str, Path]:
+    """Write the synthetic datasets, returning the filename to request for each format"""
+    fast, slow = detector_size
+    rng = np.random.default_rng(seed)
+    geometry = Geometry()
+
+    def images():
+        for _ in range(n_images):
+            yield synthetic_image((slow, fast), n_spots, rng)
+
+    datasets = {}
+    if "cbf" in formats:
+        for i, image in enumerate(images(), start=1):
+            write_cbf(directory / f"synthetic_{i:05d}.cbf", image, i, geometry)
+        datasets["cbf"] = directory / "synthetic_#####.cbf"
+    if "nexus" in formats:
+        path = directory / "synthetic.nxs"
+        write_nexus(path, images(), n_images, (slow, fast), geometry)
+        datasets["nexus"] = path
+    return datasets
+
+
+def _cases(args, datasets: dict[str, Path]):
+    for fmt, filename in datasets.items():
+        for endpoint in args.endpoints:
+            binnings = args.binning if endpoint == "export_bitmap" else [None]
+            for binning in binnings:
+                for concurrency in args.concurrency:
+                    yield {
+                        "endpoint": endpoint,
+                        "format": fmt,
+                        "filename": filename,
+                        "binning": binning,
+                        "concurrency": concurrency,
+                    }
+
+
+def _request_body(case: dict, image_index: int) -> dict:
+    if case["endpoint"] == "find_spots":
+        return {
+            "filename": os.fspath(case["filename"]),
+            "scan_range": [image_index, image_index],
+        }
+    return {
+        "filename": os.fspath(case["filename"]),
+        "image_index": image_index,
+        "binning": case["binning"],
+    }
+
+
+async def run_case(client, case: dict, n_requests: int, n_images: int) -> dict:
+    """Send n_requests requests at the case's concurrency, summarising their latencies"""
+    path = {"find_spots": "/find_spots/", "export_bitmap": "/export_bitmap/"}
+    semaphore = asyncio.Semaphore(case["concurrency"])
+    latencies: list[float] = []
+    errors: dict[str, int] = {}
+
+    async def request(i: int):
+        async with semaphore:
+            t0 = time.perf_counter()
+            response = await client.post(
+                path[case["endpoint"]], json=_request_body(case, i % n_images + 1)
+            )
+            latencies.append(time.perf_counter() - t0)
+            if response.status_code != 200:
+                key = str(response.status_code)
+                errors[key] = errors.get(key, 0) + 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(n_requests)))
+    elapsed = time.perf_counter() - t0
+    return {
+        **{k: v for k, v in case.items() if k != "filename"},
+        "requests": n_requests,
+        "errors": errors,
+        "throughput": n_requests / elapsed,
+        **summarise(latencies),
+    }
+
+
+def summarise(latencies: list[float]) -> dict[str, float]:
+    """Summary statistics of request latencies, in seconds"""
+    ordered = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "latency_mean": statistics.fmean(ordered),
+        "latency_p50": percentile(50),
+        "latency_p90": percentile(90),
+        "latency_p99": percentile(99),
+        "latency_max": ordered[-1],
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metadata(args) -> dict:
+    return {
+        "version": __version__,
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "server": args.url or "in-process",
+        "detector_size": "x".join(str(n) for n in args.detector_size),
+        "images": args.images,
+        "spots": args.spots,
+    }
+
+
+def _case_key(result: dict) -> tuple:
+    return tuple(result[k] for k in ("endpoint", "format", "binning", "concurrency"))
+
+
+def _print_header(compare: bool = False):
+    print(
+        f"{'endpoint':<14}{'format':<8}{'binning':>8}{'conc.':>6}"
+        f"{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}"
+        + (f"{'change':>9}" if compare else "")
+    )
+
+
+def _print_result(result: dict, baseline: dict | None = None):
+    line = (
+        f"{result['endpoint']:<14}{result['format']:<8}"
+        f"{str(result['binning'] or '-'):>8}{result['concurrency']:>6}"
+        f"{result['throughput']:>9.1f}{result['latency_p50'] * 1000:>9.1f}"
+        f"{result['latency_p99'] * 1000:>9.1f}{sum(result['errors'].values()):>8}"
+    )
+    if baseline:
+        change = result["throughput"] / baseline["throughput"] - 1
+        line += f"{change:>+9.1%}"
+    print(line)
+
+
+async def _benchmark(args, datasets: dict[str, Path]) -> list[dict]:
+    import httpx
+
+    if args.url:
+        token = args.token or os.environ.get("DIALS_REST_TOKEN")
+        transport = None
+        base_url = args.url
+    else:
+        from ..auth import create_access_token
+        from ..main import app
+
+        token = create_access_token({})
+        transport = httpx.ASGITransport(app=app)
+        base_url = "http://dials-rest"
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    async with httpx.AsyncClient(
+        transport=transport, base_url=base_url, headers=headers, timeout=None
+    ) as client:
+        results = []
+        _print_header()
+        for case in _cases(args, datasets):
+            result = await run_case(client, case, args.requests, args.images)
+            results.append(result)
+            _print_result(result)
+    return results
+
+
+def run(args=None):
+    parser = argparse.ArgumentParser(
+        "dials-rest-benchmark",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--url", help="Benchmark the server at this URL")
+    parser.add_argument(
+        "--token",
+        help="Access token for --url (defaults to the DIALS_REST_TOKEN environment variable)",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        help="Directory in which to write the synthetic datasets (defaults to a temporary directory)",
+    )
+    parser.add_argument(
+        "--formats", type=_str_list, default=["cbf", "nexus"], help="cbf and/or nexus"
+    )
+    parser.add_argument(
+        "--endpoints",
+        type=_str_list,
+        default=["find_spots", "export_bitmap"],
+        help="find_spots and/or export_bitmap",
+    )
+    parser.add_argument(
+        "--detector-size",
+        type=_detector_size,
+        default=(2463, 2527),
+        help="Detector size in pixels, as FASTxSLOW",
+    )
+    parser.add_argument("--images", type=int, default=10, help="Images per dataset")
+    parser.add_argument("--spots", type=int, default=200, help="Spots per image")
+    parser.add_argument(
+        "--concurrency",
+        type=_int_list,
+        default=[1, 4, 16],
+        help="Comma-separated concurrency levels",
+    )
+    parser.add_argument(
+        "--binning",
+        type=_int_list,
+        default=[1, 4],
+        help="Comma-separated binning factors for export_bitmap",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=50, help="Requests per benchmark case"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output", "-o", type=Path, help="Write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--compare", type=Path, help="Compare throughput with a previous results file"
+    )
+    args = parser.parse_args(args=args)
+
+    if not args.url:
+        # The in-process server just needs a secret matching the token we create
+        os.environ.setdefault("DIALS_REST_JWT_SECRET", os.urandom(16).hex())
+
+    with tempfile.TemporaryDirectory(prefix="dials-rest-benchmark-") as tmpdir:
+        directory = args.data_dir or Path(tmpdir)
+        directory.mkdir(parents=True, exist_ok=True)
+        print(f"Generating synthetic datasets in {directory}", file=sys.stderr)
+        datasets = generate_datasets(
+            directory,
+            args.formats,
+            args.detector_size,
+            args.images,
+            args.spots,
+            seed=args.seed,
+        )
+        results = asyncio.run(_benchmark(args, datasets))
+
+    output = {"metadata": _metadata(args), "results": results}
+    if args.compare:
+        baseline = {
+            _case_key(result): result
+            for result in json.loads(args.compare.read_text())["results"]
+        }
+        print(f"\nThroughput compared with {args.compare}:")
+        _print_header(compare=True)
+        for result in results:
+            _print_result(result, baseline.get(_case_key(result)))
+    if args.output:
+        args.output.write_text(json.dumps(output, indent=2))
+        print(f"Results written to {args.output}", file=sys.stderr)
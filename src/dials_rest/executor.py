@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import threading
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Iterable, TypeVar
+
+from fastapi import HTTPException, status
+
+from .metrics import StageTiming, observe_stages, recording_stages
+from .settings import Settings, WorkerPoolType
+from .warmup import initialize_worker
+
+logger = logging.getLogger(__name__)
+
+A = TypeVar("A")
+T = TypeVar("T")
+
+
+class WorkerError(Exception):
+    """An HTTPException raised inside a worker, in a form that survives pickling"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _invoke(fn, *args, **kwargs) -> tuple[T, list[StageTiming]]:
+    # Stage timings are returned alongside the result, so that they reach the
+    # metrics of the server process even when fn runs in a worker process
+    with recording_stages() as timings:
+        try:
+            result = fn(*args, **kwargs)
+        except HTTPException as e:
+            raise WorkerError(e.status_code, e.detail) from None
+    return result, timings
+
+
+class WorkerPool:
+    """
+    Run blocking DIALS work off the event loop with bounded concurrency.
+
+    At most max_workers jobs run at once, and at most max_queued_jobs more may
+    wait for a free worker; any further submissions are rejected with a 503
+    rather than queueing indefinitely. Jobs that do not complete within timeout
+    seconds respond 504. Note that a job that has already started cannot be
+    interrupted: it continues to occupy its worker (and counts towards the
+    limits above) until it finishes.
+    """
+
+    def __init__(
+        self,
+        kind: WorkerPoolType = WorkerPoolType.thread,
+        max_workers: int | None = None,
+        max_queued_jobs: int = 0,
+        timeout: float | None = None,
+        initializer: Callable[[], None] | None = None,
+    ):
+        self.kind = WorkerPoolType(kind)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queued_jobs = max_queued_jobs
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = 0
+        if self.kind is WorkerPoolType.process:
+            self._executor: concurrent.futures.Executor = (
+                concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers, initializer=initializer
+                )
+            )
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="dials-rest"
+            )
+        logger.info(
+            "Started %s pool with %i workers", self.kind.value, self.max_workers
+        )
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> WorkerPool:
+        return cls(
+            kind=settings.worker_pool,
+            max_workers=settings.max_workers,
+            max_queued_jobs=settings.max_queued_jobs,
+            timeout=settings.job_timeout,
+            # Worker processes load the DIALS stack as soon as they start
+            initializer=initialize_worker,
+        )
+
+    @property
+    def pending(self) -> int:
+        """The number of jobs either running or waiting for a free worker"""
+        return self._pending
+
+    @property
+    def alive(self) -> bool:
+        """Whether the pool can still run jobs, i.e. isn't shut down or broken"""
+        # Neither executor exposes this publicly
+        return not any(
+            getattr(self._executor, name, False)
+            for name in ("_broken", "_shutdown", "_shutdown_thread")
+        )
+
+    @property
+    def saturated(self) -> bool:
+        return self._pending >= self.max_workers + self.max_queued_jobs
+
+    def _admit(self):
+        if self.saturated:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, try again later",
+                headers={"Retry-After": "1"},
+            )
+
+    async def wait_until_available(self, interval: float = 0.1):
+        """Wait until the pool is no longer saturated, rather than responding 503"""
+        while self.saturated:
+            await asyncio.sleep(interval)
+
+    def _job_done(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._pending -= 1
+
+    async def _submit(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        with self._lock:
+            self._pending += 1
+        future = self._executor.submit(_invoke, fn, *args, **kwargs)
+        future.add_done_callback(self._job_done)
+        try:
+            result, timings = await asyncio.wait_for(
+                asyncio.wrap_future(future), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"Job did not complete within {self.timeout} seconds",
+            )
+        except WorkerError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        observe_stages(timings)
+        return result
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Run fn(*args, **kwargs) in the pool and return its result.
+
+        When using a process pool, fn, its arguments and its return value must
+        all be picklable.
+        """
+        self._admit()
+        return await self._submit(fn, *args, **kwargs)
+
+    async def imap_unordered(
+        self, fn: Callable[[A], T], items: Iterable[A]
+    ) -> AsyncIterator[tuple[A, T]]:
+        """
+        Run fn(item) in the pool for each item, yielding (item, result) pairs
+        in order of completion.
+
+        The batch as a whole is subject to admission control, but once admitted
+        it keeps at most max_workers of its jobs in flight at a time, rather
+        than flooding the queue. If a job fails, or the caller stops iterating,
+        any outstanding jobs that have not yet started are cancelled.
+        """
+        self._admit()
+        remaining = iter(items)
+        in_flight: dict[asyncio.Future, A] = {}
+
+        def submit_next() -> bool:
+            for item in remaining:
+                in_flight[asyncio.ensure_future(self._submit(fn, item))] = item
+                return True
+            return False
+
+        try:
+            while len(in_flight) < self.max_workers and submit_next():
+                pass
+            while in_flight:
+                done, _ = await asyncio.wait(
+                    in_flight, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    item = in_flight.pop(task)
+                    result = task.result()
+                    submit_next()
+                    yield item, result
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SingleFlight:
+    """
+    Share one in-flight computation between concurrent callers with the same key.
+
+    The first caller for a key starts the computation, and any callers with
+    the same key that arrive before it completes wait for its result (or
+    exception) rather than repeating the work. Nothing is remembered once the
+    computation completes, so this complements rather than replaces caching.
+    """
+
+    def __init__(self):
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._in_flight[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+        else:
+            self.coalesced += 1
+        # A caller going away (e.g. the client disconnecting) mustn't cancel
+        # the computation for everyone else waiting on it
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved, in case every caller went away
+            future.exception()
+
+
+_worker_pool: WorkerPool | None = None
+
+
+def get_worker_pool() -> WorkerPool:
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = WorkerPool.from_settings(Settings.get())
+    return _worker_pool
+
+
+def shutdown_worker_pool():
+    global _worker_pool
+    if _worker_pool is not None:
+        _worker_pool.shutdown()
+        _worker_pool = None
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import logging
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from fastapi import HTTPException, status
+
+from .cache import LRUCache, file_identity
+from .metrics import experiment_labels, record_stage
+from .settings import Settings
+
+if TYPE_CHECKING:
+    from dxtbx.imageset import ImageSet
+    from dxtbx.model import Experiment
+    from dxtbx.model.experiment_list import ExperimentList
+
+logger = logging.getLogger(__name__)
+
+
+def _experiments_sizeof(experiments: ExperimentList) -> int:
+    # Each imageset holds on to (at least) the most recently read image, so
+    # estimate the memory footprint as one frame of double-precision pixels
+    nbytes = 0
+    for detector in experiments.detectors():
+        if detector is None:
+            continue
+        for panel in detector:
+            fast, slow = panel.get_image_size()
+            nbytes += fast * slow * 8
+    return nbytes or 2**20
+
+
+_settings = Settings.get()
+experiment_cache: LRUCache[tuple, ExperimentList] = LRUCache(
+    max_entries=_settings.experiment_cache_size,
+    max_bytes=_settings.experiment_cache_max_bytes,
+    sizeof=_experiments_sizeof,
+)
+
+
+def _import_experiments(filename: Path, load_models: bool) -> ExperimentList:
+    from dxtbx.model.experiment_list import ExperimentListFactory
+
+    t0 = time.perf_counter()
+    if "#" in filename.stem:
+        # A filename template e.g. image_#####.cbf
+        experiments = ExperimentListFactory.from_templates([filename])
+    else:
+        experiments = ExperimentListFactory.from_filenames(
+            [filename], load_models=load_models
+        )
+    if experiments:
+        record_stage(
+            "import", time.perf_counter() - t0, **experiment_labels(experiments[0])
+        )
+    return experiments
+
+
+def import_experiments(filename: Path, load_models: bool = True) -> ExperimentList:
+    """
+    Import the experiments for an image file or filename template.
+
+    Imported experiments are cached, keyed on the resolved filename and the
+    modification time and size of the file, so repeated requests for the same
+    file (e.g. subsequent images of a NeXus file) don't need to re-read the
+    file metadata and rebuild the models. A cached entry is discarded as soon
+    as the file changes on disk.
+
+    The returned experiments may be shared between concurrent requests, so
+    should not be modified.
+    """
+    path = filename.resolve()
+    if "#" in path.stem:
+        # Templates are always imported with their models
+        load_models = True
+    identity = file_identity(path)
+    try:
+        if identity is None or not _settings.experiment_cache_size:
+            experiments = _import_experiments(path, load_models)
+        else:
+            key = (path, load_models, identity)
+            experiments = experiment_cache.get(key)
+            if experiments is None:
+                n_stale = experiment_cache.discard(
+                    lambda k: k[:2] == key[:2] and k != key
+                )
+                if n_stale:
+                    logger.info(f"Discarded stale cached experiments for {path}")
+                experiments = _import_experiments(path, load_models)
+                experiment_cache.put(key, experiments)
+    except FileNotFoundError as e:
+        logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e),
+        )
+    except ValueError as e:
+        logger.exception(e)
+        msg = str(e)
+        if "does not match any files" in msg:
+            logger.exception(e)
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=msg,
+            )
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=msg,
+        )
+    except Exception as e:
+        logger.exception(e)
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=str(e),
+        )
+    if not experiments:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Could not find matching image format for {filename}",
+        )
+    return experiments
+
+
+def import_experiment_for_image(filename: Path, image_index: int) -> Experiment:
+    """
+    Import the experiment containing the given (1-based) image of a file or
+    filename template.
+    """
+    if "#" in filename.stem:
+        # A filename template e.g. image_#####.cbf
+        return import_experiments(filename)[0]
+    elif filename.suffix in {".h5", ".nxs"}:
+        # A multi-image NeXus file
+        # Use load_models=False workaround to ensure that we only construct a
+        # single experiment object for the specific image we're interested in
+        from dxtbx.model import Experiment
+
+        cached = import_experiments(filename, load_models=False)[0]
+        # The cached experiment is shared between concurrent requests, so load
+        # the models for this image into a new experiment sharing its imageset
+        expt = Experiment(imageset=cached.imageset)
+        expt.load_models(index=image_index - 1)
+        return expt
+    else:
+        # An individual image file e.g. image_00001.cbf
+        return import_experiments(filename)[0]
+
+
+def image_numbers(experiments: ExperimentList) -> list[int]:
+    """The (1-based) image numbers of all the images of the imported experiments"""
+    if len(experiments) > 1:
+        # A sequence of still images
+        return list(range(1, len(experiments) + 1))
+    scan = experiments[0].scan
+    if scan is None:
+        return [1]
+    start, end = scan.get_image_range()
+    return list(range(start, end + 1))
+
+
+def template_image_path(template: Path, image_number: int) -> Path:
+    """The path of an image of a filename template e.g. image_#####.cbf"""
+    width = template.name.count("#")
+    return template.with_name(
+        template.name.replace("#" * width, f"{image_number:0{width}d}")
+    )
+
+
+def imageset_index(imageset: ImageSet, image_index: int) -> int:
+    """
+    Convert a (1-based) image number into an index into the imageset,
+    consistent with the image numbering used by dials.export_bitmaps.
+    """
+    from dxtbx.imageset import ImageSequence
+
+    if isinstance(imageset, ImageSequence):
+        first = imageset.get_scan().get_image_range()[0]
+    else:
+        first = 1
+    index = image_index - first
+    if not 0 <= index < len(imageset):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=(
+                f"Image {image_index} is outside the range of images "
+                f"{first}-{first + len(imageset) - 1}"
+            ),
+        )
+    return index
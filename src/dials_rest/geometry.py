@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+
+from .cache import LRUCache
+from .settings import Settings
+
+
+def geometry_key(detector, beam) -> str:
+    """A digest of the detector and beam models, identifying the geometry of an image"""
+    models = {"detector": detector.to_dict(), "beam": beam.to_dict()}
+    return hashlib.sha256(
+        json.dumps(models, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# Per-pixel quantities are computed this many rows at a time, so that the
+# temporary arrays stay small even for the largest detectors
+_BLOCK_ROWS = 256
+
+
+@dataclass(frozen=True)
+class Rings:
+    """The pixels crossed by a set of rings, and where to label each ring"""
+
+    d_spacings: tuple[float, ...]
+    # Per-panel masks of the pixels on any of the rings
+    masks: list[np.ndarray]
+    # The (panel, x, y) of the top-most pixel of each ring, or None if the ring
+    # isn't on the detector
+    label_positions: list[tuple[int, int, int] | None]
+
+
+class DetectorGeometry:
+    """
+    Quantities derived from the detector and beam models of an image.
+
+    These are constant across a sweep, so are computed once, on first use, and
+    shared between every image with the same geometry. Per-pixel quantities are
+    computed for each panel at a given binning, i.e. at the centre of each
+    binning x binning block of pixels, matching the size of the image rendered
+    at that binning.
+
+    on_resize, if given, is called whenever more quantities have been computed,
+    e.g. so that a cache can account for the memory they use.
+    """
+
+    def __init__(
+        self,
+        detector,
+        beam,
+        on_resize: Callable[[DetectorGeometry], None] | None = None,
+    ):
+        self.key = geometry_key(detector, beam)
+        self.detector = detector
+        self.beam = beam
+        self.max_resolution = detector.get_max_resolution(beam.get_s0())
+        self._on_resize = on_resize
+        self._lock = threading.Lock()
+        self._d_star_sq: dict[int, list[np.ndarray]] = {}
+        self._powder_ring_spacings: dict[tuple, list[float]] = {}
+        self._rings: LRUCache[tuple, Rings] = LRUCache(
+            max_entries=16, sizeof=lambda rings: sum(m.nbytes for m in rings.masks)
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """The memory used by the per-pixel quantities computed so far"""
+        with self._lock:
+            d_star_sq = sum(
+                a.nbytes for arrays in self._d_star_sq.values() for a in arrays
+            )
+        return d_star_sq + self._rings.nbytes
+
+    def shape(self, binning: int = 1) -> list[tuple[int, int]]:
+        """The per-panel (slow, fast) shapes of the (binned) images"""
+        return [
+            (slow // binning, fast // binning)
+            for fast, slow in (panel.get_image_size() for panel in self.detector)
+        ]
+
+    def d_star_sq(self, binning: int = 1) -> list[np.ndarray]:
+        """Per-panel float32 arrays of d*² (in Å⁻²) at the centre of each (binned) pixel"""
+        with self._lock:
+            computed = binning not in self._d_star_sq
+            if computed:
+                self._d_star_sq[binning] = [
+                    self._panel_d_star_sq(panel, binning) for panel in self.detector
+                ]
+            d_star_sq = self._d_star_sq[binning]
+        if computed:
+            self._resized()
+        return d_star_sq
+
+    def _resized(self):
+        if self._on_resize is not None:
+            self._on_resize(self)
+
+    def _panel_d_star_sq(self, panel, binning: int) -> np.ndarray:
+        fast, slow = panel.get_image_size()
+        pixel_fast, pixel_slow = panel.get_pixel_size()
+        origin = np.array(panel.get_origin())
+        fast_axis = np.array(panel.get_fast_axis())
+        slow_axis = np.array(panel.get_slow_axis())
+        s0 = np.array(self.beam.get_s0())
+        wavelength = self.beam.get_wavelength()
+        x = (np.arange(fast // binning) + 0.5) * binning * pixel_fast
+        y = (np.arange(slow // binning) + 0.5) * binning * pixel_slow
+        d_star_sq = np.empty((len(y), len(x)), dtype=np.float32)
+        for start in range(0, len(y), _BLOCK_ROWS):
+            rows = y[start : start + _BLOCK_ROWS, np.newaxis]
+            # One (rows, fast) array per lab axis, rather than (rows, fast, 3)
+            lab = [origin[i] + x * fast_axis[i] + rows * slow_axis[i] for i in range(3)]
+            scale = 1 / (np.sqrt(lab[0] ** 2 + lab[1] ** 2 + lab[2] ** 2) * wavelength)
+            # Accumulated in double precision, to avoid cancellation near the beam
+            block = sum((lab[i] * scale - s0[i]) ** 2 for i in range(3))
+            d_star_sq[start : start + _BLOCK_ROWS] = block
+        return d_star_sq
+
+    def resolution_ring_spacings(self, n_rings: int) -> list[float]:
+        """
+        The d-spacings of n_rings resolution rings, equally spaced in d*² out to
+        the maximum resolution of the detector, as in dials.export_bitmaps.
+        """
+        step = 1 / self.max_resolution**2 / (n_rings + 1)
+        return [1 / np.sqrt((i + 1) * step) for i in range(n_rings)]
+
+    def powder_ring_spacings(
+        self, unit_cell: tuple[float, ...], space_group: int | str
+    ) -> list[float]:
+        """The distinct d-spacings on the detector of powder rings, e.g. of ice"""
+        key = (tuple(unit_cell), space_group)
+        with self._lock:
+            if key not in self._powder_ring_spacings:
+                self._powder_ring_spacings[key] = self._compute_powder_ring_spacings(
+                    unit_cell, space_group
+                )
+            return self._powder_ring_spacings[key]
+
+    def _compute_powder_ring_spacings(
+        self, unit_cell: tuple[float, ...], space_group: int | str
+    ) -> list[float]:
+        from cctbx import crystal, miller, sgtbx, uctbx
+
+        ms = miller.build_set(
+            crystal.symmetry(
+                unit_cell=uctbx.unit_cell(unit_cell),
+                space_group=sgtbx.space_group_info(space_group).group(),
+            ),
+            anomalous_flag=False,
+            d_min=self.max_resolution,
+        )
+        d_spacings = np.unique(np.round(ms.d_spacings().data().as_numpy_array(), 6))
+        return d_spacings[::-1].tolist()
+
+    def rings(
+        self, d_spacings: list[float], binning: int = 1, width: float = 2
+    ) -> Rings:
+        """
+        The (binned) pixels crossed by rings at the given d-spacings, drawn with a
+        line width in (binned) pixels.
+
+        A pixel is on a ring if its d*² is within half the line width of the ring's
+        d*², as estimated from the local gradient of d*² across the panel.
+        """
+        key = (tuple(d_spacings), binning, width)
+        rings = self._rings.get(key)
+        if rings is None:
+            rings = self._compute_rings(tuple(d_spacings), binning, width)
+            self._rings.put(key, rings)
+            self._resized()
+        return rings
+
+    def _compute_rings(
+        self, d_spacings: tuple[float, ...], binning: int, width: float
+    ) -> Rings:
+        masks = []
+        label_positions: list[tuple[int, int, int] | None] = [None] * len(d_spacings)
+        ring_d_star_sq = np.array([1 / d**2 for d in d_spacings], dtype=np.float32)
+        for i_panel, d_star_sq in enumerate(self.d_star_sq(binning)):
+            mask = np.zeros(d_star_sq.shape, dtype=bool)
+            masks.append(mask)
+            n_rows = d_star_sq.shape[0]
+            if min(d_star_sq.shape) < 2:
+                continue
+            # Work down the panel a block of rows at a time, from the top, so the
+            # first rows found on each ring are its top-most
+            for start in range(0, n_rows, _BLOCK_ROWS):
+                end = min(start + _BLOCK_ROWS, n_rows)
+                # Include a row either side, so the gradient at the edges of the
+                # block matches that computed over the whole panel
+                lo, hi = max(start - 1, 0), min(end + 1, n_rows)
+                gradient = np.gradient(d_star_sq[lo:hi])
+                tolerance = (0.5 * width) * np.hypot(*gradient)[start - lo : end - lo]
+                block = d_star_sq[start:end]
+                for i_ring, ring in enumerate(ring_d_star_sq):
+                    on_ring = np.abs(block - ring) <= tolerance
+                    mask[start:end] |= on_ring
+                    if label_positions[i_ring] is None and on_ring.any():
+                        y = int(np.argmax(on_ring.any(axis=1)))
+                        xs = np.flatnonzero(on_ring[y])
+                        x = int(xs[np.argmin(np.abs(xs - xs.mean()))])
+                        label_positions[i_ring] = (i_panel, x, start + y)
+        return Rings(d_spacings, masks, label_positions)
+
+
+_settings = Settings.get()
+geometry_cache: LRUCache[str, DetectorGeometry] = LRUCache(
+    max_entries=_settings.geometry_cache_size,
+    max_bytes=_settings.geometry_cache_max_bytes,
+    sizeof=lambda geometry: geometry.nbytes,
+)
+
+
+def _geometry_resized(geometry: DetectorGeometry):
+    # Re-account for the geometry's size, if it is still cached
+    if geometry.key in geometry_cache:
+        geometry_cache.put(geometry.key, geometry)
+
+
+def get_geometry(detector, beam) -> DetectorGeometry:
+    """The (cached) derived geometry for the given detector and beam models"""
+    return geometry_cache.get_or_create(
+        geometry_key(detector, beam),
+        lambda: DetectorGeometry(detector, beam, on_resize=_geometry_resized),
+    )
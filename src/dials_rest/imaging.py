@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+from enum import Enum
+from typing import Iterable, Sequence
+
+import numpy as np
+
+
+def _blocks(image: np.ndarray, factor: int) -> np.ndarray:
+    # A (height, factor, width, factor, ...) view of the image, discarding any
+    # partial blocks at the right and bottom edges
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    return image[: height * factor, : width * factor].reshape(
+        height, factor, width, factor, *image.shape[2:]
+    )
+
+
+def downsample(image: np.ndarray, factor: int = 2) -> np.ndarray:
+    """
+    Downsample an image by averaging factor x factor blocks of pixels.
+
+    Works on both single channel (height, width) and multi-channel e.g. RGB
+    (height, width, 3) images. Any partial blocks at the right and bottom edges
+    are discarded, consistent with the image size at a given binning in
+    dials.export_bitmaps. Integer images are rounded to the nearest integer and
+    keep their dtype.
+    """
+    blocks = _blocks(image, factor)
+    if np.issubdtype(image.dtype, np.integer):
+        n = factor * factor
+        summed = blocks.sum(axis=(1, 3), dtype=np.int64)
+        return ((summed + n // 2) // n).astype(image.dtype)
+    return blocks.mean(axis=(1, 3))
+
+
+def pyramid(image: np.ndarray, n_levels: int) -> list[np.ndarray]:
+    """
+    An image pyramid with successive power-of-two downsampling.
+
+    Level i of the pyramid corresponds to binning 2**i. Each level is computed
+    from the previous one, so the full resolution image is only traversed once.
+    Fewer than n_levels levels are returned if the image becomes too small to
+    downsample further.
+    """
+    levels = [image]
+    while len(levels) < n_levels and min(levels[-1].shape[:2]) >= 2:
+        levels.append(downsample(levels[-1]))
+    return levels
+
+
+def bin_pixels(
+    data: np.ndarray, factor: int, mask: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Bin raw pixel counts by summing factor x factor blocks of pixels.
+
+    If a mask is given, pixels where the mask is False are excluded from the
+    sums, and binned pixels consisting entirely of masked pixels are set to -1.
+    The result has the same dtype as the input; integer sums that would
+    overflow it are clipped.
+    """
+    if mask is not None:
+        data = np.where(mask, data, 0)
+    if factor == 1:
+        binned = data
+    elif np.issubdtype(data.dtype, np.integer):
+        summed = _blocks(data, factor).sum(axis=(1, 3), dtype=np.int64)
+        info = np.iinfo(data.dtype)
+        binned = np.clip(summed, info.min, info.max).astype(data.dtype)
+    else:
+        binned = _blocks(data, factor).sum(axis=(1, 3)).astype(data.dtype)
+    if mask is not None:
+        binned[~_blocks(mask, factor).any(axis=(1, 3))] = -1
+    return binned
+
+
+class StackMode(str, Enum):
+    sum = "sum"
+    mean = "mean"
+    max = "max"
+
+
+def stack(frames: Iterable[Sequence[np.ndarray]], mode: StackMode) -> list[np.ndarray]:
+    """
+    Combine a sequence of (multi-panel) frames pixel-wise, panel by panel, into
+    a single double-precision frame.
+
+    Frames are accumulated one at a time, so only a single frame needs to be in
+    memory at once when frames is a generator.
+    """
+    mode = StackMode(mode)
+    result: list[np.ndarray] = []
+    n = 0
+    for frame in frames:
+        n += 1
+        if not result:
+            result = [np.array(panel, dtype=np.float64) for panel in frame]
+        elif mode is StackMode.max:
+            for acc, panel in zip(result, frame):
+                np.maximum(acc, panel, out=acc)
+        else:
+            for acc, panel in zip(result, frame):
+                np.add(acc, panel, out=acc)
+    if not n:
+        raise ValueError("No frames to stack")
+    if mode is StackMode.mean:
+        for acc in result:
+            acc /= n
+    return result
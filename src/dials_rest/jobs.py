@@ -0,0 +1,394 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import pydantic
+from dateutil.tz import UTC
+from fastapi import HTTPException, status
+
+from .settings import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    completed = "completed"
+    failed = "failed"
+
+
+class JobProgress(pydantic.BaseModel):
+    done: pydantic.NonNegativeInt = 0
+    total: pydantic.NonNegativeInt | None = None
+
+
+class JobError(pydantic.BaseModel):
+    status_code: int
+    detail: str
+
+
+class Job(pydantic.BaseModel):
+    job_id: str
+    status: JobStatus = JobStatus.queued
+    created: datetime
+    updated: datetime
+    progress: JobProgress = JobProgress()
+    results: list[dict] = []
+    error: JobError | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in {JobStatus.completed, JobStatus.failed}
+
+
+def _now() -> datetime:
+    return datetime.now(tz=UTC)
+
+
+class InMemoryJobStore:
+    """Keep jobs and their results in memory, i.e. only for the lifetime of the process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs: dict[str, Job] = {}
+
+    def create(self, job: Job):
+        with self._lock:
+            self._jobs[job.job_id] = job.copy(deep=True)
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return job.copy(update={"results": list(job.results)})
+
+    def update(
+        self,
+        job_id: str,
+        status: JobStatus | None = None,
+        total: int | None = None,
+        error: JobError | None = None,
+    ):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if status is not None:
+                job.status = status
+            if total is not None:
+                job.progress.total = total
+            if error is not None:
+                job.error = error
+            job.updated = _now()
+
+    def add_result(self, job_id: str, result: dict):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.results.append(result)
+            job.progress.done += 1
+            job.updated = _now()
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock:
+            return self._jobs.pop(job_id, None) is not None
+
+    def delete_expired(self, before: datetime) -> int:
+        with self._lock:
+            expired = [
+                k
+                for k, job in self._jobs.items()
+                if job.finished and job.updated < before
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return len(expired)
+
+
+class SQLiteJobStore:
+    """
+    Keep jobs and their results in an SQLite database.
+
+    Jobs survive server restarts, and may be queried by any server process
+    sharing the database, although only the process that submitted a job can
+    run or cancel it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT, created REAL, updated REAL, "
+                "done INTEGER, total INTEGER, error TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (job_id TEXT, result TEXT)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS results_job_id ON results (job_id)"
+            )
+
+    def create(self, job: Job):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.job_id,
+                    job.status.value,
+                    job.created.timestamp(),
+                    job.updated.timestamp(),
+                    job.progress.done,
+                    job.progress.total,
+                    job.error.json() if job.error else None,
+                ),
+            )
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, created, updated, done, total, error FROM jobs "
+                "WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            results = self._db.execute(
+                "SELECT result FROM results WHERE job_id = ? ORDER BY rowid",
+                (job_id,),
+            ).fetchall()
+        job_status, created, updated, done, total, error = row
+        return Job(
+            job_id=job_id,
+            status=job_status,
+            created=datetime.fromtimestamp(created, tz=UTC),
+            updated=datetime.fromtimestamp(updated, tz=UTC),
+            progress=JobProgress(done=done, total=total),
+            results=[json.loads(result) for (result,) in results],
+            error=JobError.parse_raw(error) if error else None,
+        )
+
+    def update(
+        self,
+        job_id: str,
+        status: JobStatus | None = None,
+        total: int | None = None,
+        error: JobError | None = None,
+    ):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE jobs SET status = coalesce(?, status), "
+                "total = coalesce(?, total), error = coalesce(?, error), "
+                "updated = ? WHERE job_id = ?",
+                (
+                    status.value if status else None,
+                    total,
+                    error.json() if error else None,
+                    _now().timestamp(),
+                    job_id,
+                ),
+            )
+
+    def add_result(self, job_id: str, result: dict):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO results VALUES (?, ?)", (job_id, json.dumps(result))
+            )
+            self._db.execute(
+                "UPDATE jobs SET done = done + 1, updated = ? WHERE job_id = ?",
+                (_now().timestamp(), job_id),
+            )
+
+    def delete(self, job_id: str) -> bool:
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM results WHERE job_id = ?", (job_id,))
+            return bool(
+                self._db.execute(
+                    "DELETE FROM jobs WHERE job_id = ?", (job_id,)
+                ).rowcount
+            )
+
+    def delete_expired(self, before: datetime) -> int:
+        # Queued and running jobs never expire
+        finished = (JobStatus.completed.value, JobStatus.failed.value)
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM results WHERE job_id IN (SELECT job_id FROM jobs "
+                "WHERE status IN (?, ?) AND updated < ?)",
+                (*finished, before.timestamp()),
+            )
+            return self._db.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+                (*finished, before.timestamp()),
+            ).rowcount
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+JobStore = InMemoryJobStore | SQLiteJobStore
+
+
+class JobContext:
+    """Passed to a running job, to report its progress and results"""
+
+    def __init__(self, store: JobStore, job_id: str):
+        self._store = store
+        self.job_id = job_id
+
+    def set_total(self, total: int):
+        self._store.update(self.job_id, total=total)
+
+    def add_result(self, result: dict):
+        self._store.add_result(self.job_id, result)
+
+
+class JobManager:
+    """
+    Run jobs in the background, recording their progress and results in a store.
+
+    At most max_running_jobs jobs run at once; further jobs stay queued until
+    one finishes. Finished jobs are deleted from the store once they have not
+    been updated for ttl seconds; queued and running jobs are kept however long
+    they take.
+    """
+
+    # How often to look for expired jobs
+    CLEANUP_INTERVAL = 60
+
+    def __init__(self, store: JobStore, max_running_jobs: int = 1, ttl: float = 3600):
+        self.store = store
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(max_running_jobs)
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._finished: dict[str, asyncio.Event] = {}
+        self._last_cleanup = 0.0
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> JobManager:
+        if settings.job_store_path is None:
+            store: JobStore = InMemoryJobStore()
+        else:
+            store = SQLiteJobStore(settings.job_store_path)
+        return cls(
+            store, max_running_jobs=settings.max_running_jobs, ttl=settings.job_ttl
+        )
+
+    def cleanup(self):
+        if time.monotonic() - self._last_cleanup < self.CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = time.monotonic()
+        before = datetime.fromtimestamp(time.time() - self.ttl, tz=UTC)
+        n_expired = self.store.delete_expired(before)
+        if n_expired:
+            logger.info(f"Deleted {n_expired} expired jobs")
+
+    def submit(self, fn: Callable[[JobContext], Awaitable[None]]) -> Job:
+        """Schedule await fn(context) to run in the background, returning the new job"""
+        self.cleanup()
+        now = _now()
+        job = Job(job_id=uuid.uuid4().hex, created=now, updated=now)
+        self.store.create(job)
+        self._finished[job.job_id] = asyncio.Event()
+        self._tasks[job.job_id] = asyncio.create_task(self._run(job.job_id, fn))
+        return job
+
+    async def _run(self, job_id: str, fn: Callable[[JobContext], Awaitable[None]]):
+        try:
+            async with self._semaphore:
+                self.store.update(job_id, status=JobStatus.running)
+                logger.info(f"Started job {job_id}")
+                await fn(JobContext(self.store, job_id))
+            self.store.update(job_id, status=JobStatus.completed)
+            logger.info(f"Completed job {job_id}")
+        except HTTPException as e:
+            logger.error(f"Job {job_id} failed: {e.detail}")
+            self.store.update(
+                job_id,
+                status=JobStatus.failed,
+                error=JobError(status_code=e.status_code, detail=str(e.detail)),
+            )
+        except Exception as e:
+            logger.exception(e)
+            self.store.update(
+                job_id,
+                status=JobStatus.failed,
+                error=JobError(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e)
+                ),
+            )
+        finally:
+            self._tasks.pop(job_id, None)
+            self._finished.pop(job_id).set()
+
+    def get(self, job_id: str) -> Job | None:
+        self.cleanup()
+        return self.store.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float) -> Job | None:
+        """
+        Get a job, first waiting up to timeout seconds for it to finish.
+
+        Jobs submitted by another process sharing the store are polled.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.finished or remaining <= 0:
+                return job
+            finished = self._finished.get(job_id)
+            if finished is None:
+                await asyncio.sleep(min(remaining, 1))
+                continue
+            try:
+                await asyncio.wait_for(finished.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a job if it is running in this process, and delete it"""
+        task = self._tasks.pop(job_id, None)
+        if task is not None:
+            task.cancel()
+        return self.store.delete(job_id)
+
+    def shutdown(self):
+        for task in self._tasks.values():
+            task.cancel()
+        if isinstance(self.store, SQLiteJobStore):
+            self.store.close()
+
+
+_job_manager: JobManager | None = None
+
+
+def get_job_manager() -> JobManager:
+    global _job_manager
+    if _job_manager is None:
+        _job_manager = JobManager.from_settings(Settings.get())
+    return _job_manager
+
+
+def shutdown_job_manager():
+    global _job_manager
+    if _job_manager is not None:
+        _job_manager.shutdown()
+        _job_manager = None
@@ -28,13 +28,17 @@ response.raise_for_status()  # Check if the call was successful
 ```
 """
 
+import asyncio
+import functools
 import logging
 
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, status
+from fastapi.responses import JSONResponse, RedirectResponse
 
-from . import __version__
-from .routers import find_spots, image
+from . import __version__, auth, experiments, geometry, prefetch, warmup
+from .executor import get_worker_pool, shutdown_worker_pool
+from .jobs import shutdown_job_manager
+from .routers import find_spots, image, jobs, raw_data, viewer
 from .settings import Settings
 
 logging.basicConfig(level=logging.INFO)
@@ -43,12 +47,20 @@ logging.basicConfig(level=logging.INFO)
 tags_metadata = [
     {
         "name": "images",
-        "description": "Generate bitmaps of diffraction images",
+        "description": "Generate bitmaps of diffraction images, or export their raw pixel data",
     },
     {
         "name": "spotfinding",
         "description": "Run spotfinding on a diffraction image and report summary statistics",
     },
+    {
+        "name": "jobs",
+        "description": "Submit long-running work in the background and poll for its progress and results",
+    },
+    {
+        "name": "health",
+        "description": "Check whether the server is ready to handle requests",
+    },
 ]
 
 
@@ -62,6 +74,9 @@ app = FastAPI(
 
 app.include_router(find_spots.router)
 app.include_router(image.router)
+app.include_router(raw_data.router)
+app.include_router(jobs.router)
+app.include_router(viewer.router)
 
 if settings.enable_metrics:
     from prometheus_fastapi_instrumentator import Instrumentator
@@ -73,7 +88,102 @@ if settings.enable_metrics:
     instrumentator.instrument(app)
     instrumentator.expose(app)
 
+    from .metrics import (
+        register_cache_metrics,
+        register_startup_metrics,
+        register_worker_pool_metrics,
+    )
+
+    caches = {
+        "jwt": auth.token_cache,
+        "experiments": experiments.experiment_cache,
+        "bitmap": image.bitmap_cache,
+        "frame": image.frame_cache,
+        "pyramid": image.pyramid_cache,
+        "geometry": geometry.geometry_cache,
+        "overlay": image.overlay_cache,
+        "prefetch": prefetch.frame_prefetcher.cache,
+    }
+    if image.bitmap_disk_cache is not None:
+        caches["bitmap_disk"] = image.bitmap_disk_cache
+    register_cache_metrics(caches)
+    register_worker_pool_metrics(get_worker_pool)
+    register_startup_metrics(warmup.startup_timings)
+
+
+_warm_up: asyncio.Task | None = None
+
+
+@app.on_event("startup")
+async def startup():
+    global _warm_up
+    warmup.record_startup("startup")
+    worker_pool = get_worker_pool()
+    # The DIALS stack is imported on first use, but load it and any datasets to
+    # preload in the background now, so the first requests don't wait for them
+    preload = [
+        (
+            str(filename),
+            functools.partial(
+                image.preload, filename, settings.preload_binning, worker_pool
+            ),
+        )
+        for filename in settings.preload
+    ]
+    _warm_up = asyncio.create_task(warmup.warm_up(preload))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    global _warm_up
+    if _warm_up is not None:
+        # Stop preloading, rather than leave the task pending as the loop closes
+        _warm_up.cancel()
+        await asyncio.gather(_warm_up, return_exceptions=True)
+        _warm_up = None
+    shutdown_job_manager()
+    shutdown_worker_pool()
+    prefetch.frame_prefetcher.shutdown()
+
 
 @app.get("/", include_in_schema=False)
 def get_root():
     return RedirectResponse("/docs")
+
+
+@app.get("/healthz", tags=["health"])
+def healthz():
+    """Respond as long as the server is running"""
+    return {"status": "ok"}
+
+
+@app.get(
+    "/readyz",
+    tags=["health"],
+    responses={
+        200: {"description": "The server is ready"},
+        503: {"description": "The server is still starting up, or can't run jobs"},
+    },
+)
+def readyz():
+    """
+    Report whether the DIALS stack is imported, any datasets are preloaded and the
+    worker pool can run jobs
+    """
+    checks = {
+        "dials": warmup.is_imported(),
+        "preload": warmup.is_ready(),
+        "worker_pool": get_worker_pool().alive,
+    }
+    ready = all(checks.values())
+    return JSONResponse(
+        {
+            "ready": ready,
+            "checks": checks,
+            "startup_seconds": warmup.startup_timings,
+            "error": warmup.error,
+        },
+        status_code=status.HTTP_200_OK
+        if ready
+        else status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import contextlib
+import threading
+import time
+from typing import Callable, Iterator, Mapping, Protocol
+
+from .settings import Settings
+
+# Pipeline stages, as (stage, file format, detector, duration in seconds)
+StageTiming = tuple[str, str, str, float]
+
+_settings = Settings.get()
+_local = threading.local()
+_stage_histogram = None
+
+
+def experiment_labels(experiment) -> dict[str, str]:
+    """The file format and detector labels for the stages processing an experiment"""
+    imageset = experiment.imageset
+    fmt = imageset.get_format_class().__name__ if imageset is not None else ""
+    detector = ""
+    if experiment.detector is not None:
+        fast, slow = experiment.detector[0].get_image_size()
+        detector = f"{len(experiment.detector)}x{fast}x{slow}"
+    return {"fmt": fmt, "detector": detector}
+
+
+def record_stage(stage: str, seconds: float, fmt: str = "", detector: str = ""):
+    """
+    Record the duration of a stage of processing a request.
+
+    Within recording_stages() the timing is collected for the caller to observe
+    later, e.g. in the parent of a worker process; otherwise it is observed
+    immediately.
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        timings.append((stage, fmt, detector, seconds))
+    else:
+        observe_stages([(stage, fmt, detector, seconds)])
+
+
+class StageTimer:
+    def __init__(self):
+        self.elapsed = 0.0
+
+
+@contextlib.contextmanager
+def stage_timer(stage: str, fmt: str = "", detector: str = "") -> Iterator[StageTimer]:
+    """Time the enclosed block as the given stage"""
+    timer = StageTimer()
+    t0 = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.elapsed = time.perf_counter() - t0
+        record_stage(stage, timer.elapsed, fmt=fmt, detector=detector)
+
+
+@contextlib.contextmanager
+def recording_stages() -> Iterator[list[StageTiming]]:
+    """Collect the stage timings recorded by the current thread in the enclosed block"""
+    previous = getattr(_local, "timings", None)
+    _local.timings = timings = []
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def observe_stages(timings: list[StageTiming]):
+    if not _settings.enable_metrics or not timings:
+        return
+    global _stage_histogram
+    if _stage_histogram is None:
+        from prometheus_client import Histogram
+
+        _stage_histogram = Histogram(
+            "dials_rest_stage_duration_seconds",
+            "Time spent in each stage of processing a request",
+            ["stage", "format", "detector"],
+            buckets=(
+                0.001,
+                0.005,
+                0.01,
+                0.025,
+                0.05,
+                0.1,
+                0.25,
+                0.5,
+                1,
+                2.5,
+                5,
+                10,
+                30,
+            ),
+        )
+    for stage, fmt, detector, seconds in timings:
+        _stage_histogram.labels(stage, fmt, detector).observe(seconds)
+
+
+class _Cache(Protocol):
+    def stats(self) -> dict[str, int]:
+        ...
+
+
+class CacheCollector:
+    """
+    A prometheus collector reporting the statistics of the server's caches.
+
+    The statistics are read from each cache when the metrics are scraped, so
+    the caches themselves don't need to know about prometheus.
+    """
+
+    def __init__(self, caches: Mapping[str, _Cache]):
+        self.caches = caches
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        entries = GaugeMetricFamily(
+            "dials_rest_cache_entries", "Number of cached entries", labels=["cache"]
+        )
+        nbytes = GaugeMetricFamily(
+            "dials_rest_cache_bytes",
+            "Estimated size of cached entries",
+            labels=["cache"],
+        )
+        counters = {
+            name: CounterMetricFamily(
+                f"dials_rest_cache_{name}", f"Number of cache {name}", labels=["cache"]
+            )
+            for name in ("hits", "misses", "evictions")
+        }
+        for cache_name, cache in self.caches.items():
+            stats = cache.stats()
+            entries.add_metric([cache_name], stats["entries"])
+            nbytes.add_metric([cache_name], stats["bytes"])
+            for name, counter in counters.items():
+                counter.add_metric([cache_name], stats[name])
+        yield entries
+        yield nbytes
+        yield from counters.values()
+
+
+def register_cache_metrics(caches: Mapping[str, _Cache], registry=None):
+    from prometheus_client import REGISTRY
+
+    (registry or REGISTRY).register(CacheCollector(caches))
+
+
+class WorkerPoolCollector:
+    """A prometheus collector reporting the queue depth of the worker pool"""
+
+    def __init__(self, get_worker_pool: Callable):
+        self.get_worker_pool = get_worker_pool
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        worker_pool = self.get_worker_pool()
+        yield GaugeMetricFamily(
+            "dials_rest_worker_pool_pending",
+            "Number of jobs running or waiting for a free worker",
+            value=worker_pool.pending,
+        )
+        yield GaugeMetricFamily(
+            "dials_rest_worker_pool_workers",
+            "Maximum number of concurrently running jobs",
+            value=worker_pool.max_workers,
+        )
+
+
+def register_worker_pool_metrics(get_worker_pool: Callable, registry=None):
+    from prometheus_client import REGISTRY
+
+    (registry or REGISTRY).register(WorkerPoolCollector(get_worker_pool))
+
+
+class StartupCollector:
+    """A prometheus collector reporting how long the server took to start up"""
+
+    def __init__(self, startup_timings: Mapping[str, float]):
+        self.startup_timings = startup_timings
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        gauge = GaugeMetricFamily(
+            "dials_rest_startup_seconds",
+            "Time from loading the app to each phase of starting up",
+            labels=["phase"],
+        )
+        for phase, seconds in self.startup_timings.items():
+            gauge.add_metric([phase], seconds)
+        yield gauge
+
+
+def register_startup_metrics(startup_timings: Mapping[str, float], registry=None):
+    from prometheus_client import REGISTRY
+
+    (registry or REGISTRY).register(StartupCollector(startup_timings))
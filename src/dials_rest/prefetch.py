@@ -0,0 +1,208 @@
+"""
+Read-ahead of the raw data of image frames.
+
+Viewers playing through a sweep almost always request frames in order, so
+after each frame is read the next few frames are read in the background into a
+bounded cache, where the following requests find them. How far to read ahead
+adapts to the pattern of requests for each dataset: it doubles with each
+consecutive frame read in the same direction, up to a maximum, and drops to
+nothing as soon as the requests jump about, so that scrubbing doesn't waste
+reads.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import logging
+import threading
+from pathlib import Path
+from typing import Hashable
+
+from fastapi import HTTPException
+
+from .cache import LRUCache, file_identity
+from .settings import Settings
+from .watch import is_hdf5, written_frames
+
+logger = logging.getLogger(__name__)
+
+
+def _frame_sizeof(data: tuple) -> int:
+    # Estimate as double-precision pixels, as for cached experiments
+    return sum(panel.size() * 8 for panel in data) or 1
+
+
+class _AccessPattern:
+    """The recent requests for frames of one dataset"""
+
+    def __init__(self):
+        self.last_index: int | None = None
+        self.step = 1
+        self.depth = 0
+
+    def update(self, index: int, max_depth: int):
+        step = None if self.last_index is None else index - self.last_index
+        if step in (1, -1):
+            if step == self.step:
+                self.depth = min(max_depth, max(1, 2 * self.depth))
+            else:
+                # Changed direction
+                self.step = step
+                self.depth = 1
+        elif step != 0:
+            # Random access, or the first request
+            self.depth = 0
+        self.last_index = index
+
+
+class FramePrefetcher:
+    """
+    Read the raw data of frames, reading ahead of the frames requested.
+
+    Frames are cached keyed on the file they are read from, its modification
+    time and size, and their index, so a frame is read again if its file changes.
+    The frames of an HDF5 (e.g. NeXus) master file don't change it as they are
+    written, so only frames that have been written are cached or read ahead.
+    """
+
+    def __init__(self, max_depth: int, max_bytes: int, max_datasets: int = 64):
+        self.max_depth = max_depth
+        self.cache: LRUCache[tuple, tuple] = LRUCache(
+            max_bytes=max_bytes, sizeof=_frame_sizeof
+        )
+        self._patterns: LRUCache[Hashable, _AccessPattern] = LRUCache(
+            max_entries=max_datasets
+        )
+        self._lock = threading.Lock()
+        self._pending: dict[tuple, concurrent.futures.Future] = {}
+        # A single thread, so that reading ahead never competes with more than
+        # one request for I/O
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="frame-prefetch"
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_depth > 0 and bool(self.cache.max_bytes)
+
+    def get_raw_data(self, dataset: Hashable, imageset, index: int) -> tuple:
+        """
+        The raw data of frame index of the imageset, which belongs to the given
+        dataset, e.g. its filename.
+
+        The returned data may be shared with the cache, so must not be modified.
+        """
+        if not self.enabled:
+            return imageset.get_raw_data(index)
+        n_frames = _cacheable_frames(imageset, limit=index + self.max_depth + 1)
+        key = _frame_key(imageset, index) if index < n_frames else None
+        data = self._cached_or_pending(key) if key is not None else None
+        if data is None:
+            data = imageset.get_raw_data(index)
+            if key is not None:
+                self.cache.put(key, data)
+        self._read_ahead(dataset, imageset, index, n_frames)
+        return data
+
+    def _cached_or_pending(self, key: tuple) -> tuple | None:
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        with self._lock:
+            future = self._pending.get(key)
+        if future is None:
+            return None
+        # The frame is already being read ahead, so wait for it
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def _read_ahead(self, dataset: Hashable, imageset, index: int, n_frames: int):
+        pattern = self._patterns.get_or_create(dataset, _AccessPattern)
+        with self._lock:
+            pattern.update(index, self.max_depth)
+            step, depth = pattern.step, pattern.depth
+        for i in range(1, depth + 1):
+            next_index = index + step * i
+            if not 0 <= next_index < min(n_frames, len(imageset)):
+                break
+            key = _frame_key(imageset, next_index)
+            if key is None or key in self.cache:
+                continue
+            with self._lock:
+                if key in self._pending:
+                    continue
+                future = self._executor.submit(self._read, key, imageset, next_index)
+                self._pending[key] = future
+            future.add_done_callback(functools.partial(self._done, key))
+
+    def _read(self, key: tuple, imageset, index: int) -> tuple:
+        try:
+            data = imageset.get_raw_data(index)
+        except Exception as e:
+            logger.warning(f"Failed to read ahead frame {index} of {key[0]}: {e}")
+            raise
+        self.cache.put(key, data)
+        return data
+
+    def _done(self, key: tuple, future: concurrent.futures.Future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class PrefetchingImageSet:
+    """
+    A stand-in for an imageset that reads raw data through the frame prefetcher.
+
+    Every other attribute is delegated to the wrapped imageset.
+    """
+
+    def __init__(self, imageset, dataset: Hashable, prefetcher: FramePrefetcher):
+        self._imageset = imageset
+        self._dataset = dataset
+        self._prefetcher = prefetcher
+
+    def __getattr__(self, name):
+        return getattr(self._imageset, name)
+
+    def __len__(self):
+        return len(self._imageset)
+
+    def get_raw_data(self, index):
+        return self._prefetcher.get_raw_data(self._dataset, self._imageset, index)
+
+
+def _cacheable_frames(imageset, limit: int) -> int:
+    """
+    The number of frames of the imageset, from the first and counting no
+    further than limit, that may be cached: for an HDF5 file, those written.
+    """
+    path = Path(imageset.get_path(0))
+    if not is_hdf5(path):
+        return limit
+    try:
+        return written_frames(path, limit=limit)
+    except HTTPException:
+        # Not a NeXus file, so there is no telling which frames are written
+        return 0
+
+
+def _frame_key(imageset, index: int) -> tuple | None:
+    path = Path(imageset.get_path(index))
+    identity = file_identity(path)
+    if identity is None:
+        return None
+    return (str(path), identity, index)
+
+
+_settings = Settings.get()
+frame_prefetcher = FramePrefetcher(
+    max_depth=_settings.frame_prefetch_max_frames,
+    max_bytes=_settings.frame_prefetch_cache_max_bytes,
+)
@@ -1,5 +1,9 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import functools
+import json
 import logging
 import time
 from enum import Enum
@@ -7,25 +11,31 @@ from pathlib import Path
 from typing import Annotated
 
 import pydantic
-from cctbx import uctbx
-from dials.algorithms.spot_finding import per_image_analysis
-from dials.array_family import flex
-from dials.command_line.find_spots import phil_scope as find_spots_phil_scope
-from dials.util import phil
-from dxtbx.model.experiment_list import ExperimentListFactory
-from fastapi import APIRouter, Body, Depends, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from ..auth import JWTBearer
+from ..cache import file_identity
+from ..executor import SingleFlight, WorkerPool, get_worker_pool
+from ..experiments import image_numbers, import_experiments, template_image_path
+from ..metrics import experiment_labels, stage_timer
+from ..watch import DatasetWatcher, is_template, new_images
 
 logger = logging.getLogger(__name__)
 
+# Spotfinding currently in progress, keyed on the request parameters
+find_spots_requests = SingleFlight()
 
 router = APIRouter(
     prefix="/find_spots",
     tags=["spotfinding"],
     dependencies=[Depends(JWTBearer())],
-    responses={404: {"description": "Not found"}},
+    responses={
+        404: {"description": "Not found"},
+        503: {"description": "Server is busy"},
+        504: {"description": "Timed out"},
+    },
 )
 
 
@@ -42,8 +52,13 @@ class PerImageAnalysisParameters(pydantic.BaseModel):
     scan_range: tuple[int, int] | None = None
     filter_ice: bool = True
     ice_rings_width: pydantic.NonNegativeFloat = 0.004
+    gain: pydantic.PositiveFloat | None = None
+    kernel_size: tuple[pydantic.PositiveInt, pydantic.PositiveInt] | None = None
+    min_spot_size: pydantic.PositiveInt | None = None
+    max_spot_size: pydantic.PositiveInt | None = None
+    mask: Path | None = None
 
-    @pydantic.validator("scan_range", pre=True)
+    @pydantic.validator("scan_range", "kernel_size", pre=True)
     def str_to_tuple(cls, v):
         if isinstance(v, str):
             return tuple(int(i) for i in v.split(","))
@@ -51,6 +66,13 @@ class PerImageAnalysisParameters(pydantic.BaseModel):
             return tuple(v)
         return None
 
+    @pydantic.validator("max_spot_size")
+    def check_spot_size_range(cls, v, values):
+        min_spot_size = values.get("min_spot_size")
+        if v is not None and min_spot_size is not None and v < min_spot_size:
+            raise ValueError("max_spot_size must not be less than min_spot_size")
+        return v
+
 
 class PerImageAnalysisResults(pydantic.BaseModel):
     n_spots_4A: pydantic.NonNegativeInt
@@ -79,6 +101,41 @@ class PerImageAnalysisResults(pydantic.BaseModel):
         }
 
 
+class BatchAnalysisParameters(PerImageAnalysisParameters):
+    images: list[pydantic.PositiveInt] | None = None
+
+    @pydantic.validator("images")
+    def check_images_or_scan_range(cls, v, values):
+        if v and values.get("scan_range"):
+            raise ValueError("Only one of images or scan_range may be given")
+        return v
+
+
+class WatchParameters(PerImageAnalysisParameters):
+    start: pydantic.PositiveInt = 1
+    end: pydantic.PositiveInt | None = None
+    poll_interval: pydantic.confloat(ge=0.1) = 1
+    idle_timeout: pydantic.PositiveFloat = 60
+
+    @pydantic.validator("scan_range")
+    def check_no_scan_range(cls, v):
+        if v:
+            raise ValueError("Use start and end to select the images to watch")
+        return v
+
+    @pydantic.validator("end")
+    def check_start_end(cls, v, values):
+        start = values.get("start")
+        if v is not None and start is not None and v < start:
+            raise ValueError("end must not be less than start")
+        return v
+
+
+class ImageAnalysisResults(PerImageAnalysisResults):
+    image_index: pydantic.PositiveInt
+    processing_time: pydantic.NonNegativeFloat | None = None
+
+
 find_spots_examples = {
     "Single image example": {
         "description": "Perform spotfinding on a single image with a high resolution cutoff of 3.5 Å",
@@ -102,6 +159,65 @@ find_spots_examples = {
             "filter_ice": True,
         },
     },
+    "Spotfinder options example": {
+        "description": "Perform spotfinding on a single image with a custom gain, kernel size and mask",
+        "value": {
+            "filename": "/path/to/image_00001.cbf",
+            "gain": 2.0,
+            "kernel_size": [5, 5],
+            "min_spot_size": 3,
+            "mask": "/path/to/mask.pickle",
+        },
+    },
+}
+
+
+find_spots_batch_examples = {
+    "Image range example": {
+        "description": "Perform spotfinding on the first 100 images of a NeXus file",
+        "value": {
+            "filename": "/path/to/master.h5",
+            "scan_range": [1, 100],
+        },
+    },
+    "Image list example": {
+        "description": "Perform spotfinding on selected images matching the given filename template",
+        "value": {
+            "filename": "/path/to/image_#####.cbf",
+            "images": [1, 10, 20],
+        },
+    },
+    "Whole dataset example": {
+        "description": "Perform spotfinding on every image of a NeXus file",
+        "value": {
+            "filename": "/path/to/master.h5",
+        },
+    },
+}
+
+
+find_spots_watch_examples = {
+    "NeXus example": {
+        "description": (
+            "Perform spotfinding on each image of a NeXus file as it is written, "
+            "until no new images have appeared for two minutes"
+        ),
+        "value": {
+            "filename": "/path/to/master.h5",
+            "idle_timeout": 120,
+        },
+    },
+    "Image template example": {
+        "description": (
+            "Perform spotfinding on images 1 to 3600 matching the given filename "
+            "template, as each image is written"
+        ),
+        "value": {
+            "filename": "/path/to/image_#####.cbf",
+            "start": 1,
+            "end": 3600,
+        },
+    },
 }
 
 
@@ -115,94 +231,370 @@ find_spots_examples = {
     },
 )
 async def find_spots(
-    params: Annotated[PerImageAnalysisParameters, Body(examples=find_spots_examples)]
+    params: Annotated[PerImageAnalysisParameters, Body(examples=find_spots_examples)],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
 ) -> PerImageAnalysisResults:
+    # Resolving and stat-ing the file may block on network filesystems
+    key = await run_in_threadpool(_request_key, params)
+    if key is None:
+        # The file doesn't exist (yet), so let the worker report the error
+        stats = await worker_pool.run(_find_spots, params)
+    else:
+        # Identical concurrent requests, e.g. from several dashboards following
+        # the latest image, share a single spotfinding job
+        stats = await find_spots_requests.run(
+            key, functools.partial(worker_pool.run, _find_spots, params)
+        )
+    return PerImageAnalysisResults(**stats)
+
+
+@router.post(
+    "/batch",
+    status_code=200,
+    response_class=JSONResponse,
+    responses={
+        200: {"description": "The spotfinding results for each image"},
+        404: {"description": "File not found"},
+    },
+)
+async def find_spots_batch(
+    params: Annotated[
+        BatchAnalysisParameters, Body(examples=find_spots_batch_examples)
+    ],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+) -> list[ImageAnalysisResults]:
+    # Import the experiments once up front, so that the per-image jobs can
+    # reuse the cached models
+    image_indices = await worker_pool.run(_image_indices, params)
+    results = []
+    async for image_index, stats in worker_pool.imap_unordered(
+        functools.partial(_find_spots_for_image, params), image_indices
+    ):
+        results.append(ImageAnalysisResults(image_index=image_index, **stats))
+    return sorted(results, key=lambda r: r.image_index)
+
+
+@router.post(
+    "/stream",
+    status_code=200,
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": (
+                "The spotfinding results for each image, in order of completion, "
+                "as newline-delimited JSON or as server-sent events if requested "
+                "with Accept: text/event-stream"
+            ),
+            "content": {"application/x-ndjson": {}, "text/event-stream": {}},
+        },
+        404: {"description": "File not found"},
+    },
+)
+async def find_spots_stream(
+    params: Annotated[
+        BatchAnalysisParameters, Body(examples=find_spots_batch_examples)
+    ],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+    accept: Annotated[str | None, Header()] = None,
+) -> StreamingResponse:
+    # Errors importing the experiments are reported with the appropriate status
+    # code before we start streaming
+    image_indices = await worker_pool.run(_image_indices, params)
+    event_stream = accept is not None and "text/event-stream" in accept
+    return StreamingResponse(
+        _stream_results(worker_pool, params, image_indices, event_stream),
+        media_type="text/event-stream" if event_stream else "application/x-ndjson",
+    )
+
+
+async def _stream_results(
+    worker_pool: WorkerPool,
+    params: BatchAnalysisParameters,
+    image_indices: list[int],
+    event_stream: bool,
+):
     try:
-        if "#" in params.filename.stem:
-            experiments = ExperimentListFactory.from_templates([params.filename])
-        else:
-            experiments = ExperimentListFactory.from_filenames([params.filename])
-        if params.scan_range and len(experiments) > 1:
-            # This means we've imported a sequence of still images: select
-            # only the experiment, i.e. image, we're interested in
-            start, end = params.scan_range
-            experiments = experiments[start - 1 : end]
-    except FileNotFoundError as e:
-        logger.exception(e)
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=str(e),
+        async for image_index, stats in worker_pool.imap_unordered(
+            functools.partial(_find_spots_for_image, params), image_indices
+        ):
+            results = ImageAnalysisResults(image_index=image_index, **stats)
+            yield _format_event("result", results.json(), event_stream)
+    except HTTPException as e:
+        # It is too late to change the response status, so report the error
+        # in-band and stop
+        logger.error(f"Streaming spotfinding failed: {e.detail}")
+        yield _format_event(
+            "error",
+            json.dumps({"status_code": e.status_code, "detail": e.detail}),
+            event_stream,
         )
-    except ValueError as e:
-        logger.exception(e)
-        msg = str(e)
-        if "does not match any files" in msg:
-            logger.exception(e)
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=msg,
+
+
+def _format_event(event: str, data: str, event_stream: bool) -> str:
+    if event_stream:
+        return f"event: {event}\ndata: {data}\n\n"
+    return f"{data}\n"
+
+
+@router.post(
+    "/watch",
+    status_code=200,
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "description": (
+                "The spotfinding results for each image as it is written, as "
+                "newline-delimited JSON or as server-sent events if requested "
+                "with Accept: text/event-stream"
+            ),
+            "content": {"application/x-ndjson": {}, "text/event-stream": {}},
+        },
+    },
+)
+async def find_spots_watch(
+    params: Annotated[WatchParameters, Body(examples=find_spots_watch_examples)],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+    accept: Annotated[str | None, Header()] = None,
+) -> StreamingResponse:
+    """
+    Watch a dataset that is being collected, streaming the spotfinding results
+    for each new image as soon as it is written.
+
+    The file, or the files of a filename template, need not exist yet. The
+    stream ends once the end image has been processed, or once no new images
+    have appeared for idle_timeout seconds.
+    """
+    event_stream = accept is not None and "text/event-stream" in accept
+    return StreamingResponse(
+        _watch_results(worker_pool, params, event_stream),
+        media_type="text/event-stream" if event_stream else "application/x-ndjson",
+    )
+
+
+async def _watch_results(
+    worker_pool: WorkerPool, params: WatchParameters, event_stream: bool
+):
+    watcher = DatasetWatcher(params.filename, params.start)
+    last_image_time = time.monotonic()
+    while params.end is None or watcher.next_image <= params.end:
+        images = []
+        try:
+            if await run_in_threadpool(watcher.poll):
+                # Wait for room in the pool rather than responding 503 mid-stream
+                await worker_pool.wait_until_available()
+                images = await worker_pool.run(
+                    new_images,
+                    params.filename,
+                    watcher.next_image,
+                    settle_time=params.poll_interval,
+                )
+                images = [i for i in images if params.end is None or i <= params.end]
+                watcher.update(images)
+            if images:
+                last_image_time = time.monotonic()
+                await worker_pool.wait_until_available()
+                async for image_index, stats in worker_pool.imap_unordered(
+                    functools.partial(_find_spots_for_watched_image, params), images
+                ):
+                    results = ImageAnalysisResults(image_index=image_index, **stats)
+                    yield _format_event("result", results.json(), event_stream)
+        except HTTPException as e:
+            logger.error(f"Watching {params.filename} failed: {e.detail}")
+            yield _format_event(
+                "error",
+                json.dumps({"status_code": e.status_code, "detail": e.detail}),
+                event_stream,
             )
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=msg,
-        )
-    except Exception as e:
-        logger.exception(e)
-        raise HTTPException(
-            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=str(e),
+            return
+        if not images:
+            if time.monotonic() - last_image_time > params.idle_timeout:
+                logger.info(f"Stopped watching {params.filename}: no new images")
+                return
+            await asyncio.sleep(params.poll_interval)
+
+
+def _find_spots_for_watched_image(params: WatchParameters, image_index: int) -> dict:
+    if is_template(params.filename):
+        # Import just the new image, rather than re-importing the whole template
+        # every time an image is added to it
+        params = params.copy(
+            update={"filename": template_image_path(params.filename, image_index)}
         )
-    if not experiments:
+    return _find_spots_for_image(params, image_index)
+
+
+def _request_key(params: PerImageAnalysisParameters) -> str | None:
+    """
+    A canonical serialisation of the parameters and the identity of the image file.
+
+    Returns None if the file does not exist.
+    """
+    path = params.filename.resolve()
+    identity = file_identity(path)
+    if identity is None:
+        return None
+    return json.dumps(
+        {"params": params.copy(update={"filename": path}).dict(), "file": identity},
+        sort_keys=True,
+        default=str,
+    )
+
+
+def _image_indices(params: BatchAnalysisParameters) -> list[int]:
+    """
+    The image numbers to analyse, responding 422 if any of those requested are
+    not in the file, rather than failing part way through the analysis.
+    """
+    available = image_numbers(import_experiments(params.filename))
+    if params.images:
+        requested = list(params.images)
+    elif params.scan_range:
+        start, end = params.scan_range
+        requested = list(range(start, end + 1))
+    else:
+        return available
+    missing = sorted(set(requested) - set(available))
+    if missing:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=f"Could not find matching image format for {params.filename}",
+            detail=(
+                f"Images {', '.join(map(str, missing))} are outside the range of "
+                f"images {available[0]}-{available[-1]}"
+            ),
         )
+    return requested
 
-    phil_params = find_spots_phil_scope.fetch(source=phil.parse("")).extract()
-    phil_params.spotfinder.scan_range = (params.scan_range,)
-    phil_params.spotfinder.threshold.algorithm = params.threshold_algorithm.value
-    phil_params.spotfinder.filter.disable_parallax_correction = (
-        params.disable_parallax_correction
-    )
 
+def _find_spots_for_image(params: PerImageAnalysisParameters, image_index: int) -> dict:
     t0 = time.perf_counter()
-    reflections = flex.reflection_table.from_observations(experiments, phil_params)
+    stats = _find_spots(
+        params.copy(update={"images": None, "scan_range": (image_index, image_index)})
+    )
+    stats["processing_time"] = time.perf_counter() - t0
+    return stats
+
+
+def _find_spots(params: PerImageAnalysisParameters) -> dict:
+    from dials.algorithms.spot_finding import per_image_analysis
+    from dials.array_family import flex
+
+    experiments = import_experiments(params.filename)
+    if params.scan_range and len(experiments) > 1:
+        # This means we've imported a sequence of still images: select
+        # only the experiment, i.e. image, we're interested in
+        start, end = params.scan_range
+        experiments = experiments[start - 1 : end]
+
+    phil_params = _phil_params(params)
+    labels = experiment_labels(experiments[0]) if experiments else {}
+
+    with stage_timer("spotfinding", **labels) as timer:
+        reflections = flex.reflection_table.from_observations(experiments, phil_params)
+    logger.info("Spotfinding took %.2f seconds", timer.elapsed)
+
+    # Map the centroids to reciprocal space once, for both the resolution
+    # filter and the per-image analysis
+    with stage_timer("reciprocal_space", **labels):
+        reflections.centroid_px_to_mm(experiments)
+        reflections.map_centroids_to_reciprocal_space(experiments)
 
     if params.d_min or params.d_max:
-        reflections = _filter_by_resolution(
-            experiments, reflections, d_min=params.d_min, d_max=params.d_max
-        )
+        with stage_timer("resolution_filter", **labels):
+            reflections = _filter_by_resolution(
+                reflections, d_min=params.d_min, d_max=params.d_max
+            )
 
-    t1 = time.perf_counter()
-    logger.info("Spotfinding took %.2f seconds", t1 - t0)
-
-    reflections.centroid_px_to_mm(experiments)
-    reflections.map_centroids_to_reciprocal_space(experiments)
-    stats = per_image_analysis.stats_for_reflection_table(
-        reflections,
-        filter_ice=params.filter_ice,
-        ice_rings_width=params.ice_rings_width,
-    )._asdict()
-    t2 = time.perf_counter()
-    logger.info("Resolution analysis took %.2f seconds", t2 - t1)
+    with stage_timer("analysis", **labels) as timer:
+        stats = per_image_analysis.stats_for_reflection_table(
+            reflections,
+            filter_ice=params.filter_ice,
+            ice_rings_width=params.ice_rings_width,
+        )._asdict()
+    logger.info("Resolution analysis took %.2f seconds", timer.elapsed)
     logger.info(stats)
-    return PerImageAnalysisResults(**stats)
+    return stats
+
+
+@functools.lru_cache(maxsize=None)
+def _default_phil_params():
+    # Extracting the find_spots PHIL scope is surprisingly expensive relative
+    # to spotfinding on a single image, so do it once and copy the result per
+    # request
+    from dials.command_line.find_spots import phil_scope
 
+    return phil_scope.extract()
+
+
+@functools.lru_cache(maxsize=64)
+def _spotfinder_phil_params(
+    threshold_algorithm: ThresholdAlgorithm,
+    disable_parallax_correction: bool,
+    gain: float | None,
+    kernel_size: tuple[int, int] | None,
+    min_spot_size: int | None,
+    max_spot_size: int | None,
+    mask: Path | None,
+):
+    # The returned parameters are shared between requests, so must be copied
+    # before use: dials updates them in place e.g. when loading the mask
+    phil_params = copy.deepcopy(_default_phil_params())
+    spotfinder = phil_params.spotfinder
+    spotfinder.threshold.algorithm = threshold_algorithm.value
+    spotfinder.filter.disable_parallax_correction = disable_parallax_correction
+    if gain is not None:
+        spotfinder.threshold.dispersion.gain = gain
+    if kernel_size is not None:
+        spotfinder.threshold.dispersion.kernel_size = kernel_size
+    if min_spot_size is not None:
+        spotfinder.filter.min_spot_size = min_spot_size
+    if max_spot_size is not None:
+        spotfinder.filter.max_spot_size = max_spot_size
+    if mask is not None:
+        spotfinder.lookup.mask = str(mask)
+    return phil_params
+
+
+def _phil_params(params: PerImageAnalysisParameters):
+    """The find_spots PHIL parameters for a request"""
+    if params.mask is not None and not params.mask.is_file():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Mask file {params.mask} not found",
+        )
+    phil_params = copy.deepcopy(
+        _spotfinder_phil_params(
+            params.threshold_algorithm,
+            params.disable_parallax_correction,
+            params.gain,
+            params.kernel_size,
+            params.min_spot_size,
+            params.max_spot_size,
+            params.mask,
+        )
+    )
+    phil_params.spotfinder.scan_range = (params.scan_range,)
+    return phil_params
+
+
+def _filter_by_resolution(reflections, d_min=None, d_max=None):
+    """
+    Select the reflections within the given resolution limits.
+
+    The reflections must already have been mapped to reciprocal space.
+    """
+    from cctbx import uctbx
+    from dials.array_family import flex
 
-def _filter_by_resolution(experiments, reflections, d_min=None, d_max=None):
-    reflections.centroid_px_to_mm(experiments)
-    reflections.map_centroids_to_reciprocal_space(experiments)
     d_star_sq = flex.pow2(reflections["rlp"].norms())
     reflections["d"] = uctbx.d_star_sq_as_d(d_star_sq)
-    # Filter based on resolution
+    # Filter based on resolution, in a single selection
+    selection = flex.bool(len(reflections), True)
     if d_min is not None:
-        selection = reflections["d"] >= d_min
-        reflections = reflections.select(selection)
-        logger.debug(f"Selected {len(reflections)} reflections with d >= {d_min:f}")
-
-    # Filter based on resolution
+        selection &= reflections["d"] >= d_min
     if d_max is not None:
-        selection = reflections["d"] <= d_max
-        reflections = reflections.select(selection)
-        logger.debug(f"Selected {len(reflections)} reflections with d <= {d_max:f}")
+        selection &= reflections["d"] <= d_max
+    reflections = reflections.select(selection)
+    logger.debug(
+        f"Selected {len(reflections)} reflections with {d_min} <= d <= {d_max}"
+    )
     return reflections
@@ -1,28 +1,77 @@
 from __future__ import annotations
 
+import functools
+import hashlib
 import io
+import json
 import logging
+import time
 from enum import Enum
 from pathlib import Path
-from typing import Annotated
+from typing import TYPE_CHECKING, Annotated, Callable, TypeVar
 
-import PIL.Image
 import pydantic
-from cctbx import sgtbx, uctbx
-from dials.util import export_bitmaps
-from dxtbx.model.experiment_list import ExperimentListFactory
-from fastapi import APIRouter, Body, Depends, HTTPException, status
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response
 
+from .. import __version__
 from ..auth import JWTBearer
+from ..cache import DiskCache, LRUCache, file_identity
+from ..executor import SingleFlight, WorkerPool, get_worker_pool
+from ..experiments import imageset_index, import_experiment_for_image
+from ..geometry import DetectorGeometry, Rings, get_geometry
+from ..imaging import StackMode, pyramid, stack
+from ..metrics import experiment_labels, record_stage, stage_timer
+from ..prefetch import PrefetchingImageSet, frame_prefetcher
+from ..settings import Settings
+from ..watch import is_hdf5, written_frames
+
+if TYPE_CHECKING:
+    import PIL.Image
 
 logger = logging.getLogger(__name__)
 
+P = TypeVar("P", bound="ExportBitmapParams")
+
+_settings = Settings.get()
+bitmap_cache: LRUCache[str, bytes] = LRUCache(
+    max_bytes=_settings.bitmap_cache_max_bytes, sizeof=len
+)
+# Rendered, but not yet encoded, frames shared between tiles
+frame_cache: LRUCache[str, PIL.Image.Image] = LRUCache(
+    max_bytes=_settings.frame_cache_max_bytes,
+    sizeof=lambda img: img.width * img.height * len(img.getbands()),
+)
+# Frames rendered at every power-of-two binning level, if enabled
+pyramid_cache: LRUCache[str, list[PIL.Image.Image]] = LRUCache(
+    max_bytes=_settings.pyramid_cache_max_bytes,
+    sizeof=lambda levels: sum(
+        img.width * img.height * len(img.getbands()) for img in levels
+    ),
+)
+bitmap_disk_cache = (
+    DiskCache(_settings.bitmap_cache_dir, _settings.bitmap_cache_dir_max_bytes)
+    if _settings.bitmap_cache_dir
+    else None
+)
+# Transparent ring overlays, shared between every image with the same geometry
+overlay_cache: LRUCache[tuple, PIL.Image.Image] = LRUCache(
+    max_bytes=_settings.overlay_cache_max_bytes,
+    sizeof=lambda img: img.width * img.height * len(img.getbands()),
+)
+# Renders currently in progress, keyed on the bitmap cache key
+bitmap_requests = SingleFlight()
+
 router = APIRouter(
     prefix="/export_bitmap",
     tags=["images"],
     dependencies=[Depends(JWTBearer())],
-    responses={404: {"description": "Not found"}},
+    responses={
+        404: {"description": "Not found"},
+        503: {"description": "Server is busy"},
+        504: {"description": "Timed out"},
+    },
 )
 
 
@@ -30,6 +79,7 @@ class FormatEnum(str, Enum):
     jpeg = "jpeg"
     tiff = "tiff"
     png = "png"
+    webp = "webp"
 
 
 class ColourSchemes(str, Enum):
@@ -57,16 +107,23 @@ class ResolutionRingsParams(pydantic.BaseModel):
     fill: str = "red"
 
 
+# The same as export_bitmaps.HEXAGONAL_ICE_UNIT_CELL and
+# export_bitmaps.HEXAGONAL_ICE_SPACE_GROUP, which can't be used here without
+# importing dials when the app starts
+HEXAGONAL_ICE_UNIT_CELL = (4.498, 4.498, 7.338, 90.0, 90.0, 120.0)
+HEXAGONAL_ICE_SPACE_GROUP = "P 63/m m c"
+
+
 class IceRingsParams(pydantic.BaseModel):
     show: bool = False
     fontsize: pydantic.PositiveInt = 30
     fill: str = "blue"
-    unit_cell: tuple[
-        float, float, float, float, float, float
-    ] = export_bitmaps.HEXAGONAL_ICE_UNIT_CELL.parameters()
-    space_group: int | str = (
-        export_bitmaps.HEXAGONAL_ICE_SPACE_GROUP.type().lookup_symbol()
-    )
+    unit_cell: tuple[float, float, float, float, float, float] = HEXAGONAL_ICE_UNIT_CELL
+    space_group: int | str = HEXAGONAL_ICE_SPACE_GROUP
+
+    # The unit cell and space group are checked with cctbx by _check_ice_rings()
+    # when the rings are drawn, so that validating a request doesn't import
+    # cctbx on the event loop
 
     @pydantic.validator("unit_cell", pre=True)
     def check_unit_cell(cls, v):
@@ -75,21 +132,15 @@ class IceRingsParams(pydantic.BaseModel):
         orig_v = v
         if isinstance(v, str):
             v = v.replace(",", " ").split()
-        v = [float(v) for v in v]
         try:
-            uctbx.unit_cell(v)
-        except Exception:
+            return [float(v) for v in v]
+        except (TypeError, ValueError):
             raise ValueError(f"Invalid unit_cell {orig_v}")
-        return v
 
     @pydantic.validator("space_group", pre=True)
     def check_space_group(cls, v):
         if not v:
             return None
-        try:
-            sgtbx.space_group_info(v)
-        except Exception:
-            raise ValueError(f"Invalid space group {v}")
         return v
 
 
@@ -97,14 +148,43 @@ class ExportBitmapParams(pydantic.BaseModel):
     filename: Path
     image_index: pydantic.PositiveInt = 1
     format: FormatEnum = FormatEnum.png
+    # From 0 (fastest, largest) to 9 (slowest, smallest), for png and webp
+    compression_level: pydantic.conint(ge=0, le=9) | None = None
+    # For jpeg and webp; webp images are lossless unless a quality is given
+    quality: pydantic.conint(ge=1, le=100) | None = None
     binning: pydantic.PositiveInt = 1
     display: DisplayEnum = DisplayEnum.image
     colour_scheme: ColourSchemes = ColourSchemes.greyscale
     brightness: pydantic.NonNegativeFloat = 10
+    stack_images: pydantic.PositiveInt = 1
+    stack_mode: StackMode = StackMode.sum
     resolution_rings: ResolutionRingsParams = ResolutionRingsParams()
     ice_rings: IceRingsParams = IceRingsParams()
 
 
+class TileParams(ExportBitmapParams):
+    x: pydantic.NonNegativeInt = 0
+    y: pydantic.NonNegativeInt = 0
+    width: pydantic.PositiveInt = 256
+    height: pydantic.PositiveInt = 256
+
+
+# The parameters that affect the rendered frame, as opposed to how it is
+# cropped and encoded
+_RENDER_FIELDS = {
+    "filename",
+    "image_index",
+    "binning",
+    "display",
+    "colour_scheme",
+    "brightness",
+    "stack_images",
+    "stack_mode",
+    "resolution_rings",
+    "ice_rings",
+}
+
+
 image_as_bitmap_examples = {
     "Single image example": {
         "description": "Convert a cbf image to a png with binning of pixel to reduce overall image size",
@@ -138,6 +218,65 @@ image_as_bitmap_examples = {
             "resolution_rings": {"show": True, "number": 10},
         },
     },
+    "Fast encoding": {
+        "description": (
+            "Generate an unbinned image with fast, light compression, e.g. for "
+            "viewers on a fast network"
+        ),
+        "value": {
+            "filename": "/path/to/image_00001.cbf",
+            "format": "png",
+            "compression_level": 1,
+        },
+    },
+    "Lossy webp": {
+        "description": "Generate a small lossy webp image",
+        "value": {
+            "filename": "/path/to/image_00001.cbf",
+            "binning": 2,
+            "format": "webp",
+            "quality": 80,
+        },
+    },
+    "Stacked images": {
+        "description": "Generate a png of the maximum projection of ten images",
+        "value": {
+            "filename": "/path/to/master.h5",
+            "image_index": 1,
+            "binning": 4,
+            "stack_images": 10,
+            "stack_mode": "max",
+        },
+    },
+}
+
+
+tile_as_bitmap_examples = {
+    "Tile example": {
+        "description": (
+            "Generate a 256x256 png of the top-left corner of the image at full "
+            "resolution. Tiles are specified in the pixel coordinates of the "
+            "binned image"
+        ),
+        "value": {
+            "filename": "/path/to/master.h5",
+            "image_index": 5,
+            "x": 0,
+            "y": 0,
+            "width": 256,
+            "height": 256,
+        },
+    },
+    "Zoomed out tile example": {
+        "description": "Generate the second tile along the top of the image at binning 4",
+        "value": {
+            "filename": "/path/to/master.h5",
+            "image_index": 5,
+            "binning": 4,
+            "x": 256,
+            "y": 0,
+        },
+    },
 }
 
 
@@ -150,67 +289,457 @@ image_as_bitmap_examples = {
             "description": "Returns the image as a byte string",
             "content": {"image/png": {}},
         },
+        304: {"description": "The image matches the ETag given in If-None-Match"},
         404: {"description": "File not found"},
     },
 )
 async def image_as_bitmap(
-    params: Annotated[ExportBitmapParams, Body(examples=image_as_bitmap_examples)]
+    params: Annotated[ExportBitmapParams, Body(examples=image_as_bitmap_examples)],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+    if_none_match: Annotated[str | None, Header()] = None,
 ) -> Response:
-    logger.info(f"Exporting bitmap with parameters:\n{params!r}")
+    return await _cached_bitmap_response(
+        _image_as_bitmap, params, worker_pool, if_none_match
+    )
+
+
+@router.post(
+    "/tile",
+    status_code=200,
+    response_class=Response,
+    responses={
+        200: {
+            "description": "Returns the requested region of the image as a byte string",
+            "content": {"image/png": {}},
+        },
+        304: {"description": "The image matches the ETag given in If-None-Match"},
+        404: {"description": "File not found"},
+    },
+)
+async def tile_as_bitmap(
+    params: Annotated[TileParams, Body(examples=tile_as_bitmap_examples)],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+    if_none_match: Annotated[str | None, Header()] = None,
+) -> Response:
+    return await _cached_bitmap_response(
+        _tile_as_bitmap, params, worker_pool, if_none_match
+    )
+
+
+async def _cached_bitmap_response(
+    render: Callable[[P], bytes],
+    params: P,
+    worker_pool: WorkerPool,
+    if_none_match: str | None,
+) -> Response:
+    media_type = f"image/{params.format.value}"
+    # Resolving and stat-ing the file may block on network filesystems
+    key = await run_in_threadpool(_bitmap_cache_key, params)
+    if key is None:
+        content = await _cached_bitmap(render, params, key, worker_pool)
+        return Response(content=content, media_type=media_type)
+
+    headers = {
+        "ETag": f'"{key}"',
+        "Cache-Control": (
+            f"private, max-age={_settings.bitmap_max_age}"
+            if _settings.bitmap_max_age
+            else "no-cache"
+        ),
+    }
+    if if_none_match and _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    content = await _cached_bitmap(render, params, key, worker_pool)
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+async def _cached_bitmap(
+    render: Callable[[P], bytes], params: P, key: str | None, worker_pool: WorkerPool
+) -> bytes:
+    """The bitmap for the parameters with the given cache key, rendered if not cached"""
+    if key is None:
+        # The file doesn't exist (yet), so let the worker report the error, or
+        # the image mustn't be cached
+        return await worker_pool.run(render, params)
+    content = bitmap_cache.get(key)
+    if content is None:
+        # Identical concurrent requests, e.g. from several viewers following
+        # the latest image, share a single render
+        content = await bitmap_requests.run(
+            key, functools.partial(_load_or_render, render, params, key, worker_pool)
+        )
+    return content
+
+
+async def _load_or_render(
+    render: Callable[[P], bytes], params: P, key: str, worker_pool: WorkerPool
+) -> bytes:
+    if bitmap_disk_cache is not None:
+        content = await run_in_threadpool(bitmap_disk_cache.get, key)
+        if content is not None:
+            bitmap_cache.put(key, content)
+            return content
+    content = await worker_pool.run(render, params)
+    bitmap_cache.put(key, content)
+    if bitmap_disk_cache is not None:
+        await run_in_threadpool(bitmap_disk_cache.put, key, content)
+    return content
+
+
+def _render_settings() -> dict:
+    """The server settings that change the image rendered for given parameters"""
+    return {
+        "bitmap_pyramid": _settings.bitmap_pyramid,
+        "bitmap_pyramid_levels": _settings.bitmap_pyramid_levels,
+        "png_compression_level": _settings.png_compression_level,
+    }
+
+
+def _canonical_params(params: ExportBitmapParams, **kwargs) -> str | None:
+    """
+    A canonical serialisation of the parameters, the server settings that affect
+    rendering and the identity of the image file.
+
+    Keyword arguments are passed on to params.dict(). Returns None if the file
+    does not exist, or if the requested frames of an HDF5 file haven't all been
+    written yet.
+    """
+    path = params.filename.resolve()
+    identity = file_identity(path)
+    if identity is None:
+        return None
+    if is_hdf5(path) and not _frames_written(path, params):
+        # NeXus files declare their frames before they are written, and their
+        # identity doesn't change as the frames are written, so an image of an
+        # unwritten frame would be cached (and its ETag match) indefinitely
+        return None
+    return json.dumps(
+        {
+            "version": __version__,
+            "params": params.copy(update={"filename": path}).dict(**kwargs),
+            "settings": _render_settings(),
+            "file": identity,
+        },
+        sort_keys=True,
+        default=str,
+    )
+
+
+def _frames_written(path: Path, params: ExportBitmapParams) -> bool:
+    last = params.image_index + params.stack_images - 1
     try:
-        if "#" in params.filename.stem:
-            # A filename template e.g. image_#####.cbf
-            expt = ExperimentListFactory.from_templates([params.filename])[0]
-        elif params.filename.suffix in {".h5", ".nxs"}:
-            # A multi-image NeXus file
-            # Use load_models=False workaround to ensure that we only construct a
-            # single experiment object for the specific image we're interested in
-            expt = ExperimentListFactory.from_filenames(
-                [params.filename], load_models=False
-            )[0]
-            expt.load_models(index=params.image_index - 1)
-        else:
-            # An individual image file e.g. image_00001.cbf
-            expt = ExperimentListFactory.from_filenames([params.filename])[0]
-    except FileNotFoundError as e:
-        logger.exception(e)
+        return written_frames(path, limit=last) >= last
+    except HTTPException:
+        # Not a NeXus file, so there is no telling which frames are written
+        return False
+
+
+def _bitmap_cache_key(params: ExportBitmapParams) -> str | None:
+    """
+    A digest of the canonicalised parameters and the identity of the image file.
+
+    This identifies the rendered image, so doubles as its (strong) ETag. Returns
+    None if the image shouldn't be cached, see _canonical_params().
+    """
+    canonical = _canonical_params(params)
+    if canonical is None:
+        return None
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    tags = (tag.strip() for tag in if_none_match.split(","))
+    return etag in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def _image_as_bitmap(params: ExportBitmapParams) -> bytes:
+    logger.info(f"Exporting bitmap with parameters:\n{params!r}")
+    pil_img = _render(params)
+    return _encode(pil_img, params, _image_labels(params))
+
+
+def _tile_as_bitmap(params: TileParams) -> bytes:
+    logger.info(f"Exporting tile with parameters:\n{params!r}")
+    pil_img = _rendered_frame(params)
+    width, height = pil_img.size
+    if params.x >= width or params.y >= height:
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=str(e),
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=(
+                f"Tile origin ({params.x}, {params.y}) is outside the image of "
+                f"size ({width}, {height}) at binning {params.binning}"
+            ),
         )
-    except ValueError as e:
-        logger.exception(e)
-        msg = str(e)
-        if "does not match any files" in msg:
-            logger.exception(e)
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=msg,
-            )
+    tile = pil_img.crop(
+        (
+            params.x,
+            params.y,
+            min(params.x + params.width, width),
+            min(params.y + params.height, height),
+        )
+    )
+    return _encode(tile, params, _image_labels(params))
+
+
+def _image_labels(params: ExportBitmapParams) -> dict[str, str]:
+    """The file format and detector labels for the stages processing the image"""
+    # Rendering the image has already imported its experiment into the cache
+    return experiment_labels(
+        import_experiment_for_image(params.filename, params.image_index)
+    )
+
+
+async def preload(filename: Path, binning: list[int], worker_pool: WorkerPool):
+    """
+    Render the first image of a dataset at each binning into the bitmap cache,
+    as /export_bitmap/ would for the default parameters, and compute its
+    resolution rings, so that they are cached before the first request for it.
+    """
+    logger.info(f"Preloading {filename} at binning {binning}")
+    for b in binning:
+        params = ExportBitmapParams(filename=filename, binning=b)
+        key = await run_in_threadpool(_bitmap_cache_key, params)
+        await _cached_bitmap(_image_as_bitmap, params, key, worker_pool)
+    await worker_pool.run(_preload_rings, filename, binning)
+
+
+def _preload_rings(filename: Path, binning: list[int]):
+    expt = import_experiment_for_image(filename, 1)
+    if expt.detector is None or expt.beam is None:
+        return
+    geometry = get_geometry(expt.detector, expt.beam)
+    for b in binning:
+        geometry.rings(
+            geometry.resolution_ring_spacings(ResolutionRingsParams().number),
+            binning=b,
+        )
+
+
+def _rendered_frame(params: ExportBitmapParams) -> PIL.Image.Image:
+    """
+    The full rendered frame for the given parameters, ignoring the output format
+    and any tile region.
+
+    Rendered frames are cached, so that all the tiles of a frame share a single
+    decode and colour-mapping of the image.
+    """
+    canonical = _canonical_params(params, include=_RENDER_FIELDS)
+    if canonical is None:
+        # Let _render report the missing file, or render an uncacheable frame
+        return _render(params)
+    return frame_cache.get_or_create(canonical, lambda: _render(params))
+
+
+def _render(params: ExportBitmapParams) -> PIL.Image.Image:
+    """
+    Render the requested frame.
+
+    The returned image may be shared with a cache, so must not be modified.
+    """
+    if _use_pyramid(params):
+        return _pyramid_level(params)
+    return _render_direct(params)
+
+
+def _render_direct(params: ExportBitmapParams) -> PIL.Image.Image:
+    import PIL.Image
+
+    if params.ice_rings.show:
+        _check_ice_rings(params.ice_rings)
+    expt, flex_img, rgb = _colour_mapped(params)
+    # This copies the frame once, as Image.frombytes() did before: PIL pads RGB
+    # pixels to four bytes, so it can't share the colour-mapped bytes
+    # (Image.frombuffer copies RGB too), and the rings are drawn on the image
+    # in place
+    pil_img = PIL.Image.fromarray(rgb)
+    if params.resolution_rings.show or params.ice_rings.show:
+        with stage_timer("ring_drawing", **experiment_labels(expt)):
+            _draw_rings(expt, pil_img, flex_img, params)
+    return pil_img
+
+
+def _check_ice_rings(params: IceRingsParams):
+    """Check that the ice ring unit cell and space group are understood by cctbx"""
+    from cctbx import sgtbx, uctbx
+
+    try:
+        uctbx.unit_cell(params.unit_cell)
+    except Exception:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=msg,
+            detail=f"Invalid unit_cell {params.unit_cell}",
         )
-    except Exception as e:
-        logger.exception(e)
+    try:
+        sgtbx.space_group_info(params.space_group)
+    except Exception:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-            detail=str(e),
+            detail=f"Invalid space group {params.space_group}",
         )
 
+
+def _colour_mapped(params: ExportBitmapParams) -> tuple:
+    """
+    Read and colour-map the requested frame with dials.export_bitmaps.
+
+    Returns the experiment, the flex image and a read-only (height, width, 3)
+    array viewing the RGB bytes from the flex image's as_bytes(). Rendering a
+    frame directly still copies these into PIL, but building an image pyramid
+    downsamples the view itself.
+    """
+    import numpy as np
+    from dials.util import export_bitmaps
+
+    expt = import_experiment_for_image(params.filename, params.image_index)
+    index = imageset_index(expt.imageset, params.image_index)
+    # Viewers usually play through the frames in order, so read ahead of them
+    imageset = PrefetchingImageSet(expt.imageset, params.filename, frame_prefetcher)
+    if params.stack_images > 1:
+        imageset = _StackedImageSet(
+            imageset,
+            [
+                imageset_index(expt.imageset, params.image_index + i)
+                for i in range(params.stack_images)
+            ],
+            params.stack_mode,
+        )
+    labels = experiment_labels(expt)
+    # Time reading the image separately from colour mapping it, although both
+    # happen within imageset_as_flex_image
+    imageset = _TimedImageSet(imageset)
+    t0 = time.perf_counter()
     flex_img = next(
         export_bitmaps.imageset_as_flex_image(
-            expt.imageset,
-            images=[params.image_index],
+            imageset,
+            # The wrappers aren't ImageSequences, so export_bitmaps numbers
+            # their images from 1 whatever the image range of the sequence
+            images=[index + 1],
             brightness=params.brightness,
             binning=params.binning,
             display=export_bitmaps.Display(params.display),
             colour_scheme=export_bitmaps.ColourScheme[params.colour_scheme.upper()],
         )
     )
-    pil_img = PIL.Image.frombytes(
-        "RGB", (flex_img.ex_size2(), flex_img.ex_size1()), flex_img.as_bytes()
+    rgb = np.frombuffer(flex_img.as_bytes(), dtype=np.uint8).reshape(
+        flex_img.ex_size1(), flex_img.ex_size2(), 3
+    )
+    record_stage("read", imageset.read_time, **labels)
+    record_stage(
+        "colour_mapping", time.perf_counter() - t0 - imageset.read_time, **labels
+    )
+    return expt, flex_img, rgb
+
+
+def _draw_rings(expt, pil_img: PIL.Image.Image, flex_img, params: ExportBitmapParams):
+    # The overlay is rendered once per detector geometry, binning and ring
+    # parameters. Multi-panel images are laid out by export_bitmaps, so leave
+    # drawing their rings to it
+    geometry = get_geometry(expt.detector, expt.beam)
+    if len(expt.detector) > 1 or geometry.shape(params.binning)[0] != (
+        pil_img.height,
+        pil_img.width,
+    ):
+        _draw_rings_export_bitmaps(expt, pil_img, flex_img, params)
+        return
+    key = (
+        geometry.key,
+        params.binning,
+        params.resolution_rings.json() if params.resolution_rings.show else None,
+        params.ice_rings.json() if params.ice_rings.show else None,
+    )
+    overlay = overlay_cache.get_or_create(
+        key, lambda: _ring_overlay(geometry, pil_img.size, params)
+    )
+    pil_img.paste(overlay, mask=overlay)
+
+
+def _ring_overlay(
+    geometry: DetectorGeometry, size: tuple[int, int], params: ExportBitmapParams
+) -> PIL.Image.Image:
+    """A transparent layer with the requested rings drawn on it"""
+    import PIL.Image
+
+    overlay = PIL.Image.new("RGBA", size, (0, 0, 0, 0))
+    if params.resolution_rings.show:
+        _draw_ring_overlay(
+            overlay,
+            geometry.rings(
+                geometry.resolution_ring_spacings(params.resolution_rings.number),
+                binning=params.binning,
+            ),
+            fill=params.resolution_rings.fill,
+            fontsize=params.resolution_rings.fontsize,
+        )
+    if params.ice_rings.show:
+        _draw_ring_overlay(
+            overlay,
+            geometry.rings(
+                geometry.powder_ring_spacings(
+                    params.ice_rings.unit_cell, params.ice_rings.space_group
+                ),
+                binning=params.binning,
+            ),
+            fill=params.ice_rings.fill,
+            fontsize=params.ice_rings.fontsize,
+        )
+    return overlay
+
+
+def _draw_ring_overlay(
+    pil_img: PIL.Image.Image, rings: Rings, fill: str, fontsize: int
+):
+    """Colour the pixels on the rings of a single-panel image, and label each ring"""
+    import numpy as np
+    import PIL.Image
+    import PIL.ImageColor
+    import PIL.ImageDraw
+    import PIL.ImageFont
+
+    pil_img.paste(
+        PIL.ImageColor.getcolor(fill, pil_img.mode),
+        mask=PIL.Image.fromarray(rings.masks[0].astype(np.uint8) * 255),
     )
+    draw = PIL.ImageDraw.Draw(pil_img)
+    font = _label_font(fontsize)
+    for d, position in zip(rings.d_spacings, rings.label_positions):
+        if position is not None:
+            _, x, y = position
+            label = f"{d:.2f}"
+            if isinstance(font, PIL.ImageFont.FreeTypeFont):
+                draw.text((x, y), label, fill=fill, font=font, anchor="mb")
+            else:
+                # Bitmap fonts don't support anchors, so centre the label by hand
+                left, top, right, bottom = draw.textbbox((0, 0), label, font=font)
+                draw.text(
+                    (x - (right - left) / 2, y - (bottom - top)),
+                    label,
+                    fill=fill,
+                    font=font,
+                )
+
+
+def _label_font(fontsize: int):
+    """
+    The font for ring labels, falling back to Pillow's fixed-size bitmap font
+    (as dials.export_bitmaps does) without FreeType or before Pillow 10.1.
+    """
+    import PIL.ImageFont
+
+    try:
+        return PIL.ImageFont.load_default(size=fontsize)
+    except (TypeError, ImportError, OSError):
+        return PIL.ImageFont.load_default()
+
+
+def _draw_rings_export_bitmaps(
+    expt, pil_img: PIL.Image.Image, flex_img, params: ExportBitmapParams
+):
+    from cctbx import sgtbx, uctbx
+    from dials.util import export_bitmaps
 
     if params.resolution_rings.show:
         export_bitmaps.draw_resolution_rings(
@@ -234,8 +763,160 @@ async def image_as_bitmap(
             binning=params.binning,
         )
 
-    img_bytes = io.BytesIO()
-    pil_img.save(img_bytes, format=params.format.value)
-    return Response(
-        content=img_bytes.getvalue(), media_type=f"image/{params.format.value}"
+
+def _use_pyramid(params: ExportBitmapParams) -> bool:
+    level = params.binning.bit_length() - 1
+    return (
+        _settings.bitmap_pyramid
+        and params.binning == 2**level
+        and level < _settings.bitmap_pyramid_levels
+        # Ring overlays are drawn at the requested binning, so can't be
+        # downsampled
+        and not params.resolution_rings.show
+        and not params.ice_rings.show
     )
+
+
+def _pyramid_level(params: ExportBitmapParams) -> PIL.Image.Image:
+    """
+    The frame at the requested binning, taken from the frame's image pyramid.
+
+    On first access of a frame, it is rendered once at full resolution and
+    every power-of-two binning level is computed from that by averaging
+    blocks of pixels, rather than re-reading and re-binning the raw data for
+    each binning. The colours of binned pixels can therefore differ slightly
+    from those rendered directly at that binning.
+    """
+    canonical = _canonical_params(params, include=_RENDER_FIELDS - {"binning"})
+
+    def build() -> list[PIL.Image.Image]:
+        import PIL.Image
+
+        # Downsample straight from the colour-mapped bytes, rather than from a
+        # full resolution PIL image, which would copy the frame twice more: into
+        # PIL and back out with np.asarray()
+        _, _, full = _colour_mapped(params.copy(update={"binning": 1}))
+        return [
+            PIL.Image.fromarray(level)
+            for level in pyramid(full, _settings.bitmap_pyramid_levels)
+        ]
+
+    if canonical is None:
+        levels = build()
+    else:
+        levels = pyramid_cache.get_or_create(canonical, build)
+    level = params.binning.bit_length() - 1
+    if level >= len(levels):
+        # The image is too small to bin this far
+        return _render_direct(params)
+    return levels[level]
+
+
+class _TimedImageSet:
+    """
+    A stand-in for an imageset that records the time spent reading raw data.
+
+    Every other attribute is delegated to the wrapped imageset.
+    """
+
+    def __init__(self, imageset):
+        self._imageset = imageset
+        self.read_time = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self._imageset, name)
+
+    def __len__(self):
+        return len(self._imageset)
+
+    def _timed(self, method, index):
+        t0 = time.perf_counter()
+        try:
+            return method(index)
+        finally:
+            self.read_time += time.perf_counter() - t0
+
+    def get_raw_data(self, index):
+        return self._timed(self._imageset.get_raw_data, index)
+
+    def get_corrected_data(self, index):
+        return self._timed(self._imageset.get_corrected_data, index)
+
+
+class _StackedImageSet:
+    """
+    A stand-in for an imageset whose image data is the sum, mean or maximum of
+    several images of the wrapped imageset.
+
+    This lets the stacked image go through the same colour scheme, brightness
+    and display pipeline in export_bitmaps as a single image. Every other
+    attribute is delegated to the wrapped imageset.
+    """
+
+    def __init__(self, imageset, indices: list[int], mode: StackMode):
+        self._imageset = imageset
+        self._indices = indices
+        self._mode = mode
+        self._data = None
+        self._mask = None
+
+    def __getattr__(self, name):
+        return getattr(self._imageset, name)
+
+    def __len__(self):
+        return len(self._imageset)
+
+    def get_raw_data(self, index=None):
+        from dials.array_family import flex
+
+        if self._data is None:
+            frames = (
+                [panel.as_numpy_array() for panel in self._imageset.get_raw_data(i)]
+                for i in self._indices
+            )
+            self._data = tuple(
+                flex.double(panel.ravel()).reshape(flex.grid(panel.shape))
+                for panel in stack(frames, self._mode)
+            )
+        return self._data
+
+    def get_corrected_data(self, index=None):
+        return self.get_raw_data(index)
+
+    def get_mask(self, index=None):
+        if self._mask is None:
+            masks = [self._imageset.get_mask(i) for i in self._indices]
+            combined = list(masks[0])
+            for mask in masks[1:]:
+                combined = [a & b for a, b in zip(combined, mask)]
+            self._mask = tuple(combined)
+        return self._mask
+
+
+def _encode(
+    pil_img: PIL.Image.Image, params: ExportBitmapParams, labels: dict[str, str]
+) -> bytes:
+    with stage_timer("encoding", **labels):
+        img_bytes = io.BytesIO()
+        pil_img.save(img_bytes, format=params.format.value, **_encoder_options(params))
+        return img_bytes.getvalue()
+
+
+def _encoder_options(params: ExportBitmapParams) -> dict:
+    """The PIL save() options for the requested format, compression and quality"""
+    if params.format is FormatEnum.png:
+        if params.compression_level is None:
+            return {"compress_level": _settings.png_compression_level}
+        return {"compress_level": params.compression_level}
+    options: dict = {}
+    if params.format is FormatEnum.webp:
+        options["lossless"] = params.quality is None
+        if params.compression_level is not None:
+            # webp has methods 0 (fastest) to 6 (slowest)
+            options["method"] = round(params.compression_level * 6 / 9)
+    if params.quality is not None and params.format in {
+        FormatEnum.jpeg,
+        FormatEnum.webp,
+    }:
+        options["quality"] = params.quality
+    return options
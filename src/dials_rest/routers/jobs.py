@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import functools
+import logging
+from typing import Annotated
+
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Response, status
+
+from ..auth import JWTBearer
+from ..executor import WorkerPool, get_worker_pool
+from ..jobs import Job, JobContext, JobManager, get_job_manager
+from .find_spots import (
+    BatchAnalysisParameters,
+    ImageAnalysisResults,
+    _find_spots_for_image,
+    _image_indices,
+    find_spots_batch_examples,
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["jobs"],
+    dependencies=[Depends(JWTBearer())],
+    responses={404: {"description": "Not found"}},
+)
+
+# The longest time for which a client may long-poll a job
+MAX_WAIT = 60
+
+
+class SpotfindingJob(Job):
+    results: list[ImageAnalysisResults] = []
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "job_id": "9f1c2a7e0b3d4c5e8f6a1b2c3d4e5f60",
+                "status": "running",
+                "created": "2024-01-01T12:00:00+00:00",
+                "updated": "2024-01-01T12:00:05+00:00",
+                "progress": {"done": 1, "total": 100},
+                "results": [
+                    {
+                        "image_index": 1,
+                        "processing_time": 0.5,
+                        **ImageAnalysisResults.Config.schema_extra["example"],
+                    }
+                ],
+                "error": None,
+            }
+        }
+
+
+def _spotfinding_job(job: Job) -> SpotfindingJob:
+    results = sorted(job.results, key=lambda r: r["image_index"])
+    return SpotfindingJob(**job.copy(update={"results": results}).dict())
+
+
+@router.post(
+    "/find_spots",
+    status_code=status.HTTP_202_ACCEPTED,
+    responses={202: {"description": "The submitted job"}},
+)
+async def submit_find_spots(
+    params: Annotated[
+        BatchAnalysisParameters, Body(examples=find_spots_batch_examples)
+    ],
+    response: Response,
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+    job_manager: Annotated[JobManager, Depends(get_job_manager)],
+) -> SpotfindingJob:
+    job = job_manager.submit(
+        functools.partial(_run_find_spots, params=params, worker_pool=worker_pool)
+    )
+    response.headers["Location"] = router.url_path_for("get_job", job_id=job.job_id)
+    return _spotfinding_job(job)
+
+
+@router.get("/{job_id}")
+async def get_job(
+    job_id: str,
+    job_manager: Annotated[JobManager, Depends(get_job_manager)],
+    wait: Annotated[
+        float,
+        Query(
+            ge=0,
+            le=MAX_WAIT,
+            description="Time in seconds to wait for the job to finish before responding",
+        ),
+    ] = 0,
+) -> SpotfindingJob:
+    job = await job_manager.wait(job_id, wait)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found"
+        )
+    return _spotfinding_job(job)
+
+
+@router.delete(
+    "/{job_id}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    response_class=Response,
+    responses={204: {"description": "The job was cancelled and deleted"}},
+)
+async def cancel_job(
+    job_id: str,
+    job_manager: Annotated[JobManager, Depends(get_job_manager)],
+):
+    if not job_manager.cancel(job_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Job {job_id} not found"
+        )
+
+
+async def _run_find_spots(
+    context: JobContext, params: BatchAnalysisParameters, worker_pool: WorkerPool
+):
+    # Jobs wait their turn for the worker pool rather than failing when it is busy
+    await worker_pool.wait_until_available()
+    image_indices = await worker_pool.run(_image_indices, params)
+    context.set_total(len(image_indices))
+    await worker_pool.wait_until_available()
+    async for image_index, stats in worker_pool.imap_unordered(
+        functools.partial(_find_spots_for_image, params), image_indices
+    ):
+        context.add_result(
+            ImageAnalysisResults(image_index=image_index, **stats).dict()
+        )
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import gzip
+import io
+import logging
+from enum import Enum
+from pathlib import Path
+from typing import Annotated
+
+import numpy as np
+import pydantic
+from fastapi import APIRouter, Body, Depends, HTTPException, status
+from fastapi.responses import Response, StreamingResponse
+
+from ..auth import JWTBearer
+from ..executor import WorkerPool, get_worker_pool
+from ..experiments import imageset_index, import_experiment_for_image
+from ..imaging import bin_pixels
+from ..metrics import experiment_labels, stage_timer
+from ..prefetch import frame_prefetcher
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/raw_data",
+    tags=["images"],
+    dependencies=[Depends(JWTBearer())],
+    responses={
+        404: {"description": "Not found"},
+        503: {"description": "Server is busy"},
+        504: {"description": "Timed out"},
+    },
+)
+
+# The size of the chunks in which uncompressed data are streamed to the client
+CHUNK_SIZE = 2**20
+
+
+class RawDataFormat(str, Enum):
+    npy = "npy"
+    raw = "raw"
+
+
+class Compression(str, Enum):
+    none = "none"
+    gzip = "gzip"
+    zstd = "zstd"
+    bslz4 = "bslz4"
+
+
+class RawDataParams(pydantic.BaseModel):
+    filename: Path
+    image_index: pydantic.PositiveInt = 1
+    panel: pydantic.NonNegativeInt = 0
+    binning: pydantic.PositiveInt = 1
+    apply_mask: bool = False
+    format: RawDataFormat = RawDataFormat.npy
+    compression: Compression = Compression.none
+
+
+raw_data_examples = {
+    "NPY example": {
+        "description": "Get the raw counts of an image as a NumPy .npy file, loadable with numpy.load()",
+        "value": {
+            "filename": "/path/to/image_00001.cbf",
+        },
+    },
+    "Binned and masked example": {
+        "description": (
+            "Get the fifth image of a NeXus file binned 4x4 as zstd-compressed "
+            "raw little-endian data, with untrusted pixels excluded from the sums"
+        ),
+        "value": {
+            "filename": "/path/to/master.h5",
+            "image_index": 5,
+            "binning": 4,
+            "apply_mask": True,
+            "format": "raw",
+            "compression": "zstd",
+        },
+    },
+}
+
+
+@router.post(
+    "/",
+    status_code=200,
+    response_class=Response,
+    responses={
+        200: {
+            "description": (
+                "Returns the pixel data as a .npy file or as raw little-endian "
+                "values, optionally compressed. The X-Data-Dtype, X-Data-Shape "
+                "and X-Data-Compression headers describe the payload"
+            ),
+            "content": {"application/octet-stream": {}},
+        },
+        404: {"description": "File not found"},
+    },
+)
+async def raw_data(
+    params: Annotated[RawDataParams, Body(examples=raw_data_examples)],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+) -> Response:
+    if (
+        params.compression is Compression.bslz4
+        and params.format is not RawDataFormat.raw
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="bslz4 compression is only supported with the raw format",
+        )
+    dtype, shape, payload = await worker_pool.run(_raw_data, params)
+    headers = {
+        "X-Data-Dtype": dtype.str,
+        "X-Data-Shape": ",".join(str(n) for n in shape),
+        "X-Data-Compression": params.compression.value,
+    }
+    if isinstance(payload, bytes):
+        return Response(
+            content=payload, media_type="application/octet-stream", headers=headers
+        )
+    header = _npy_header(payload) if params.format is RawDataFormat.npy else b""
+    headers["Content-Length"] = str(len(header) + payload.nbytes)
+    return StreamingResponse(
+        _iter_chunks(header, payload),
+        media_type="application/octet-stream",
+        headers=headers,
+    )
+
+
+def _raw_data(
+    params: RawDataParams,
+) -> tuple[np.dtype, tuple[int, ...], np.ndarray | bytes]:
+    """
+    Read, mask and bin the requested panel of an image.
+
+    Returns the dtype and shape of the prepared little-endian array, along with
+    either the array itself or, if compression was requested, the compressed
+    payload. Uncompressed arrays are streamed directly from the array's buffer
+    rather than first being copied into a bytes object.
+    """
+    logger.info(f"Exporting raw data with parameters:\n{params!r}")
+    expt = import_experiment_for_image(params.filename, params.image_index)
+    imageset = expt.imageset
+    index = imageset_index(imageset, params.image_index)
+    with stage_timer("read", **experiment_labels(expt)):
+        raw_data = frame_prefetcher.get_raw_data(params.filename, imageset, index)
+    if params.panel >= len(raw_data):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Panel {params.panel} not found: the detector has {len(raw_data)} panels",
+        )
+    data = raw_data[params.panel].as_numpy_array()
+    mask = None
+    if params.apply_mask:
+        mask = imageset.get_mask(index)[params.panel].as_numpy_array()
+    data = bin_pixels(data, params.binning, mask=mask)
+    data = np.ascontiguousarray(data, dtype=data.dtype.newbyteorder("<"))
+
+    if params.compression is Compression.none:
+        return data.dtype, data.shape, data
+    return data.dtype, data.shape, _compress(data, params)
+
+
+def _npy_header(data: np.ndarray) -> bytes:
+    f = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        f, np.lib.format.header_data_from_array_1_0(data)
+    )
+    return f.getvalue()
+
+
+def _compress(data: np.ndarray, params: RawDataParams) -> bytes:
+    if params.compression is Compression.bslz4:
+        try:
+            import bitshuffle
+        except ImportError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="bslz4 compression requires the bitshuffle package",
+            )
+        return bitshuffle.compress_lz4(data).tobytes()
+
+    # Otherwise compress the whole payload, so that decompressing an npy
+    # payload gives a valid .npy file
+    buffer = memoryview(data).cast("B")
+    if params.format is RawDataFormat.npy:
+        buffer = _npy_header(data) + buffer
+    if params.compression is Compression.gzip:
+        return gzip.compress(buffer, compresslevel=1)
+    elif params.compression is Compression.zstd:
+        try:
+            import zstandard
+        except ImportError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="zstd compression requires the zstandard package",
+            )
+        return zstandard.ZstdCompressor().compress(buffer)
+    raise ValueError(f"Unknown compression {params.compression}")
+
+
+def _iter_chunks(header: bytes, data: np.ndarray):
+    if header:
+        yield header
+    view = memoryview(data).cast("B")
+    for start in range(0, len(view), CHUNK_SIZE):
+        yield bytes(view[start : start + CHUNK_SIZE])
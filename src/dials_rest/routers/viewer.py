@@ -0,0 +1,253 @@
+"""
+Stream rendered images to a viewer over a WebSocket, e.g. for playing through a
+sweep like a movie, without a separate request (and token check) per frame.
+
+The client sends JSON objects of ExportBitmapParams fields, the first of which
+must include the filename. Each message updates the parameters of the previous
+one, e.g. {"image_index": 42} to move to another frame, and requests the image
+for the updated parameters. Nested parameters such as resolution_rings are
+replaced as a whole.
+
+For each image the server sends a JSON text message, e.g.
+{"image_index": 42, "media_type": "image/png", "etag": "..."}, immediately
+followed by the encoded image as a binary message. Errors are reported as a
+JSON text message {"image_index": 42, "error": {"status_code": ..., "detail": ...}}
+and leave the connection open, as do binary messages from the client, which are
+answered with a 400 error.
+
+If the client requests another image before the previous one is sent, e.g. while
+scrubbing quickly, the previous one is dropped, without being rendered unless
+its render has already started. Once an image is sent, the next few frames in
+the direction of travel are rendered in the background, so that playback finds
+them cached; a new request stops any more of them being rendered.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from typing import Annotated
+
+import pydantic
+from dateutil.tz import UTC
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+
+from ..auth import UserToken, verify_websocket
+from ..executor import WorkerPool, get_worker_pool
+from ..settings import Settings
+from .image import (
+    ExportBitmapParams,
+    _bitmap_cache_key,
+    _cached_bitmap,
+    _image_as_bitmap,
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(
+    prefix="/export_bitmap",
+    tags=["images"],
+)
+
+
+@router.websocket("/ws")
+async def image_stream(
+    websocket: WebSocket,
+    token: Annotated[UserToken, Depends(verify_websocket)],
+    worker_pool: Annotated[WorkerPool, Depends(get_worker_pool)],
+):
+    await websocket.accept()
+    session = _ViewerSession(
+        websocket, worker_pool, token, Settings.get().viewer_prefetch_frames
+    )
+    await session.run()
+
+
+class _ViewerSession:
+    """The state of one WebSocket image stream"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        worker_pool: WorkerPool,
+        token: UserToken,
+        prefetch: int,
+    ):
+        self.websocket = websocket
+        self.worker_pool = worker_pool
+        self.token = token
+        self.prefetch = prefetch
+        self.params: ExportBitmapParams | None = None
+        # Incremented for each request, so that stale renders can be dropped
+        self.generation = 0
+        self.dropped = 0
+        self._requested = asyncio.Event()
+        self._send_lock = asyncio.Lock()
+        self._prefetching: asyncio.Task | None = None
+        self._last_image_index: int | None = None
+
+    async def run(self):
+        tasks = {
+            asyncio.ensure_future(self._receive_requests()),
+            asyncio.ensure_future(self._send_images()),
+        }
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            if self._prefetching is not None:
+                tasks.add(self._prefetching)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        logger.info(f"Image stream closed, having dropped {self.dropped} stale images")
+
+    async def _receive_requests(self):
+        while True:
+            received = await self.websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            text = received.get("text")
+            if text is None:
+                await self._send_error(
+                    None, status.HTTP_400_BAD_REQUEST, "Expected a JSON text message"
+                )
+                continue
+            try:
+                message = json.loads(text)
+                if not isinstance(message, dict):
+                    raise ValueError("Expected a JSON object")
+                params = _updated_params(self.params, message)
+            except pydantic.ValidationError as e:
+                await self._send_error(
+                    None, status.HTTP_422_UNPROCESSABLE_ENTITY, e.errors()
+                )
+                continue
+            except ValueError as e:
+                await self._send_error(None, status.HTTP_400_BAD_REQUEST, str(e))
+                continue
+            self.params = params
+            self.generation += 1
+            if self._prefetching is not None:
+                # Frames being rendered still complete into the cache, but no
+                # more are rendered for the previous request
+                self._prefetching.cancel()
+            self._requested.set()
+
+    async def _send_images(self):
+        while True:
+            await self._requested.wait()
+            self._requested.clear()
+            if self.token.expiry <= datetime.now(tz=UTC):
+                await self.websocket.close(
+                    code=status.WS_1008_POLICY_VIOLATION, reason="Expired token"
+                )
+                return
+            params, generation = self.params, self.generation
+            try:
+                # Resolving and stat-ing the file may block on network filesystems
+                key = await run_in_threadpool(_bitmap_cache_key, params)
+                if generation != self.generation:
+                    # The client has moved on before the image was rendered
+                    self.dropped += 1
+                    continue
+                content = await self._render(params, key)
+            except HTTPException as e:
+                if generation == self.generation:
+                    await self._send_error(params.image_index, e.status_code, e.detail)
+                continue
+            except Exception as e:
+                # Report the failure to render this image, and carry on with
+                # the next one rather than closing the stream
+                logger.exception(e)
+                if generation == self.generation:
+                    await self._send_error(
+                        params.image_index,
+                        status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        str(e),
+                    )
+                continue
+            if generation != self.generation:
+                # The client has already moved on
+                self.dropped += 1
+                continue
+            await self._send_image(params, key, content)
+            step = (
+                -1
+                if self._last_image_index is not None
+                and params.image_index < self._last_image_index
+                else 1
+            )
+            self._last_image_index = params.image_index
+            if self._prefetching is not None:
+                # Renders already submitted still complete into the cache
+                self._prefetching.cancel()
+            if self.prefetch:
+                self._prefetching = asyncio.ensure_future(self._prefetch(params, step))
+
+    async def _render(self, params: ExportBitmapParams, key: str | None) -> bytes:
+        return await _cached_bitmap(_image_as_bitmap, params, key, self.worker_pool)
+
+    async def _prefetch(self, params: ExportBitmapParams, step: int):
+        """Render the frames after the given one into the cache, one at a time"""
+        for i in range(1, self.prefetch + 1):
+            image_index = params.image_index + step * i
+            if image_index < 1:
+                return
+            if self.worker_pool.saturated:
+                # Leave the pool to requests that someone is waiting for
+                return
+            try:
+                # Validated like a request, so that it has the same cache key
+                frame_params = _updated_params(params, {"image_index": image_index})
+                key = await run_in_threadpool(_bitmap_cache_key, frame_params)
+                if key is None:
+                    return
+                await self._render(frame_params, key)
+            except HTTPException:
+                # e.g. past the end of the sweep
+                return
+            except Exception as e:
+                logger.warning(
+                    f"Failed to prefetch image {image_index} of {params.filename}: {e}"
+                )
+                return
+
+    async def _send_image(self, params: ExportBitmapParams, key: str | None, content):
+        header = {
+            "image_index": params.image_index,
+            "media_type": f"image/{params.format.value}",
+            "etag": key,
+        }
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(header))
+            await self.websocket.send_bytes(content)
+
+    async def _send_error(self, image_index: int | None, status_code: int, detail):
+        message = {
+            "image_index": image_index,
+            "error": {"status_code": status_code, "detail": detail},
+        }
+        async with self._send_lock:
+            await self.websocket.send_text(json.dumps(message, default=str))
+
+
+def _updated_params(
+    params: ExportBitmapParams | None, message: dict
+) -> ExportBitmapParams:
+    """The parameters with the fields of a message replaced, validated as a whole"""
+    current = params.dict() if params is not None else {}
+    return ExportBitmapParams.parse_obj({**current, **message})
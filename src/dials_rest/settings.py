@@ -1,20 +1,140 @@
 from __future__ import annotations
 
+from enum import Enum
 from functools import lru_cache
 from pathlib import Path
 
+import pydantic
 from pydantic import BaseSettings, Field
 
 # The pydantic secrets-reading dir, for settings secret settings from file
 SECRETS_DIR = Path("/opt/secrets")
 
 
+class WorkerPoolType(str, Enum):
+    thread = "thread"
+    process = "process"
+
+
 class Settings(BaseSettings):
     jwt_secret: str
     enable_metrics: bool = Field(
         default=False,
         description="Expose metrics in prometheus format on the /metrics endpoint",
     )
+    jwt_cache_size: pydantic.NonNegativeInt = Field(
+        default=1024,
+        description="Maximum number of verified access tokens to cache (0 to disable)",
+    )
+    worker_pool: WorkerPoolType = Field(
+        default=WorkerPoolType.thread,
+        description="Run spotfinding and image rendering in a pool of threads or processes",
+    )
+    max_workers: pydantic.PositiveInt | None = Field(
+        default=None,
+        description="Maximum number of concurrent jobs (defaults to the number of CPUs)",
+    )
+    max_queued_jobs: pydantic.NonNegativeInt = Field(
+        default=16,
+        description="Maximum number of jobs waiting for a free worker before responding 503",
+    )
+    job_timeout: pydantic.PositiveFloat | None = Field(
+        default=300,
+        description="Time in seconds after which a job is abandoned and responds 504",
+    )
+    job_store_path: Path | None = Field(
+        default=None,
+        description="SQLite database in which to store jobs (by default jobs are kept in memory)",
+    )
+    max_running_jobs: pydantic.PositiveInt = Field(
+        default=2,
+        description="Maximum number of background jobs to run at once",
+    )
+    job_ttl: pydantic.PositiveFloat = Field(
+        default=3600,
+        description="Time in seconds after its last update at which a finished job is deleted",
+    )
+    experiment_cache_size: pydantic.NonNegativeInt = Field(
+        default=32,
+        description="Maximum number of imported experiment lists to cache (0 to disable)",
+    )
+    experiment_cache_max_bytes: pydantic.PositiveInt = Field(
+        default=2**30,
+        description="Approximate memory budget in bytes for cached experiment lists",
+    )
+    bitmap_cache_max_bytes: pydantic.NonNegativeInt = Field(
+        default=256 * 2**20,
+        description="Memory budget in bytes for cached rendered images (0 to disable)",
+    )
+    bitmap_cache_dir: Path | None = Field(
+        default=None,
+        description="Directory in which to additionally cache rendered images on disk",
+    )
+    bitmap_cache_dir_max_bytes: pydantic.PositiveInt = Field(
+        default=4 * 2**30,
+        description="Disk budget in bytes for cached rendered images",
+    )
+    frame_cache_max_bytes: pydantic.NonNegativeInt = Field(
+        default=512 * 2**20,
+        description="Memory budget in bytes for rendered frames shared between image tiles",
+    )
+    bitmap_pyramid: bool = Field(
+        default=False,
+        description=(
+            "Render each frame once at full resolution and derive all "
+            "power-of-two binning levels from that"
+        ),
+    )
+    bitmap_pyramid_levels: pydantic.PositiveInt = Field(
+        default=5,
+        description="Number of levels in each image pyramid, i.e. up to binning 2**(levels-1)",
+    )
+    pyramid_cache_max_bytes: pydantic.NonNegativeInt = Field(
+        default=1024 * 2**20,
+        description="Memory budget in bytes for image pyramids",
+    )
+    geometry_cache_size: pydantic.NonNegativeInt = Field(
+        default=8,
+        description="Maximum number of detector geometries for which to cache resolution ring overlays (0 to disable)",
+    )
+    geometry_cache_max_bytes: pydantic.NonNegativeInt = Field(
+        default=512 * 2**20,
+        description="Memory budget in bytes for the per-pixel geometry from which ring overlays are rendered",
+    )
+    overlay_cache_max_bytes: pydantic.NonNegativeInt = Field(
+        default=256 * 2**20,
+        description="Memory budget in bytes for rendered ring overlays (0 to disable)",
+    )
+    png_compression_level: int = Field(
+        default=6,
+        ge=0,
+        le=9,
+        description="Default zlib compression level for png images, from 0 (fastest) to 9 (smallest)",
+    )
+    preload: list[Path] = Field(
+        default=[],
+        description="Image files or filename templates to import and render on startup, as a JSON list",
+    )
+    preload_binning: list[pydantic.PositiveInt] = Field(
+        default=[1],
+        description="Binning factors at which to render the first image of each preloaded dataset, as a JSON list",
+    )
+    viewer_prefetch_frames: pydantic.NonNegativeInt = Field(
+        default=4,
+        description="Number of frames after the latest requested frame to render in the background for WebSocket image streams",
+    )
+    frame_prefetch_max_frames: pydantic.NonNegativeInt = Field(
+        default=8,
+        description="Maximum number of frames to read ahead of sequential requests for images (0 to disable)",
+    )
+    frame_prefetch_cache_max_bytes: pydantic.NonNegativeInt = Field(
+        default=512 * 2**20,
+        description="Memory budget in bytes for the raw data of frames read ahead (0 to disable)",
+    )
+    bitmap_max_age: pydantic.NonNegativeInt = Field(
+        default=0,
+        description="Time in seconds for which clients may reuse a rendered image without revalidating",
+    )
 
     @staticmethod
     @lru_cache
@@ -0,0 +1,280 @@
+"""
+Synthetic diffraction images, for benchmarking without real datasets.
+
+Images consist of a Poisson-distributed background with Gaussian spots scattered
+at random positions. They can be written as Pilatus-style miniCBF files or as a
+single NeXus (NXmx) file, both of which can be read by dxtbx. The diffraction
+geometry is a simple rotation experiment with the beam at the centre of the
+detector.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class Geometry:
+    pixel_size: float = 0.172  # mm
+    distance: float = 200.0  # mm
+    wavelength: float = 0.9795  # Å
+    oscillation: float = 0.1  # degrees per image
+    exposure_time: float = 0.1  # seconds
+    sensor_thickness: float = 0.45  # mm
+    saturation_value: int = 1048576
+
+
+def synthetic_image(
+    shape: tuple[int, int],
+    n_spots: int,
+    rng: np.random.Generator,
+    background: float = 2.0,
+    spot_sigma: float = 1.0,
+    max_intensity: float = 5000.0,
+) -> np.ndarray:
+    """
+    An int32 image of the given (slow, fast) shape with a Poisson background and
+    n_spots Gaussian spots.
+    """
+    slow, fast = shape
+    image = rng.poisson(background, size=shape).astype(np.int32)
+    radius = max(1, int(np.ceil(3 * spot_sigma)))
+    offsets = np.arange(-radius, radius + 1)
+    profile = np.exp(-0.5 * (offsets / spot_sigma) ** 2)
+    profile = np.outer(profile, profile)
+    profile /= profile.sum()
+    ys = rng.integers(radius, slow - radius, size=n_spots)
+    xs = rng.integers(radius, fast - radius, size=n_spots)
+    intensities = rng.uniform(0.05, 1, size=n_spots) * max_intensity
+    for y, x, intensity in zip(ys, xs, intensities):
+        image[y - radius : y + radius + 1, x - radius : x + radius + 1] += (
+            rng.poisson(profile * intensity)
+        ).astype(np.int32)
+    return image
+
+
+def byte_offset_compress(data: np.ndarray) -> bytes:
+    """Compress an integer array with the CBF byte offset algorithm"""
+    delta = np.diff(data.ravel().astype(np.int64), prepend=0)
+    magnitude = np.abs(delta)
+    small = magnitude < 0x80
+    medium = ~small & (magnitude < 0x8000)
+    large = ~small & ~medium
+    if np.any(magnitude[large] >= 2**31):
+        raise ValueError("Pixel values differ by too much for 32-bit byte offsets")
+    sizes = np.where(small, 1, np.where(medium, 3, 7))
+    offsets = np.cumsum(sizes) - sizes
+    out = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    out[offsets[small]] = delta[small].astype(np.int8).view(np.uint8)
+    # Larger differences are escaped with -128, then -32768 for 32-bit values
+    pos = offsets[medium]
+    out[pos] = 0x80
+    out[pos[:, None] + [1, 2]] = (
+        delta[medium].astype("<i2").view(np.uint8).reshape(-1, 2)
+    )
+    pos = offsets[large]
+    out[pos[:, None] + [0, 1, 2]] = [0x80, 0x00, 0x80]
+    out[pos[:, None] + [3, 4, 5, 6]] = (
+        delta[large].astype("<i4").view(np.uint8).reshape(-1, 4)
+    )
+    return out.tobytes()
+
+
+def write_cbf(
+    path: Path,
+    image: np.ndarray,
+    image_number: int = 1,
+    geometry: Geometry = Geometry(),
+):
+    """Write an int32 image as a Pilatus-style miniCBF file"""
+    slow, fast = image.shape
+    compressed = byte_offset_compress(image)
+    md5 = base64.b64encode(hashlib.md5(compressed).digest()).decode()
+    start_angle = (image_number - 1) * geometry.oscillation
+    header = f"""###CBF: VERSION 1.5, CBFlib v0.7.8 - PILATUS detectors
+
+data_{path.stem}
+
+_array_data.header_convention "PILATUS_1.2"
+_array_data.header_contents
+;
+# Detector: PILATUS synthetic, S/N 00-0000
+# 2024-01-01T00:00:00.000
+# Pixel_size {geometry.pixel_size * 1e-3:g} m x {geometry.pixel_size * 1e-3:g} m
+# Silicon sensor, thickness {geometry.sensor_thickness * 1e-3:f} m
+# Exposure_time {geometry.exposure_time:f} s
+# Exposure_period {geometry.exposure_time:f} s
+# Tau = 0 s
+# Count_cutoff {geometry.saturation_value} counts
+# Threshold_setting: 6000 eV
+# Wavelength {geometry.wavelength:f} A
+# Detector_distance {geometry.distance * 1e-3:f} m
+# Beam_xy ({fast / 2:.2f}, {slow / 2:.2f}) pixels
+# Start_angle {start_angle:f} deg.
+# Angle_increment {geometry.oscillation:f} deg.
+;
+
+_array_data.data
+;
+--CIF-BINARY-FORMAT-SECTION--
+Content-Type: application/octet-stream;
+     conversions="x-CBF_BYTE_OFFSET"
+Content-Transfer-Encoding: BINARY
+X-Binary-Size: {len(compressed)}
+X-Binary-ID: 1
+X-Binary-Element-Type: "signed 32-bit integer"
+X-Binary-Element-Byte-Order: LITTLE_ENDIAN
+Content-MD5: {md5}
+X-Binary-Number-of-Elements: {image.size}
+X-Binary-Size-Fastest-Dimension: {fast}
+X-Binary-Size-Second-Dimension: {slow}
+X-Binary-Size-Padding: 4095
+
+"""
+    footer = "\n--CIF-BINARY-FORMAT-SECTION----\n;\n\n"
+    with open(path, "wb") as f:
+        f.write(header.replace("\n", "\r\n").encode())
+        f.write(b"\x0c\x1a\x04\xd5")
+        f.write(compressed)
+        f.write(b"\0" * 4095)
+        f.write(footer.replace("\n", "\r\n").encode())
+
+
+def write_nexus(
+    path: Path,
+    images: Iterable[np.ndarray],
+    n_images: int,
+    shape: tuple[int, int],
+    geometry: Geometry = Geometry(),
+):
+    """Write a sequence of int32 images as a single NeXus (NXmx) file"""
+    import h5py
+
+    slow, fast = shape
+    pixel_size = geometry.pixel_size
+    detector_path = "/entry/instrument/detector"
+    with h5py.File(path, "w") as f:
+        entry = _nx_group(f, "entry", "NXentry")
+        entry["definition"] = "NXmx"
+        entry["start_time"] = "2024-01-01T00:00:00Z"
+
+        data = _nx_group(entry, "data", "NXdata")
+        data.attrs["signal"] = "data"
+        dataset = data.create_dataset(
+            "data",
+            shape=(n_images, slow, fast),
+            dtype=np.int32,
+            chunks=(1, slow, fast),
+            compression="gzip",
+            compression_opts=1,
+        )
+        for i, image in enumerate(images):
+            dataset[i] = image
+
+        instrument = _nx_group(entry, "instrument", "NXinstrument")
+        beam = _nx_group(instrument, "beam", "NXbeam")
+        _nx_field(beam, "incident_wavelength", geometry.wavelength, "angstrom")
+
+        detector = _nx_group(instrument, "detector", "NXdetector")
+        detector["depends_on"] = f"{detector_path}/transformations/det_z"
+        detector["description"] = "Synthetic detector"
+        detector["sensor_material"] = "Si"
+        _nx_field(detector, "sensor_thickness", geometry.sensor_thickness, "mm")
+        _nx_field(detector, "x_pixel_size", pixel_size, "mm")
+        _nx_field(detector, "y_pixel_size", pixel_size, "mm")
+        _nx_field(detector, "count_time", geometry.exposure_time, "s")
+        detector["saturation_value"] = geometry.saturation_value
+        detector["underload_value"] = -1
+        transformations = _nx_group(detector, "transformations", "NXtransformations")
+        _nx_transformation(
+            transformations,
+            "det_z",
+            geometry.distance,
+            "mm",
+            "translation",
+            (0, 0, 1),
+            ".",
+        )
+        module = _nx_group(detector, "module", "NXdetector_module")
+        module["data_origin"] = np.array([0, 0])
+        module["data_size"] = np.array([slow, fast])
+        module_path = f"{detector_path}/module"
+        _nx_transformation(
+            module,
+            "module_offset",
+            0,
+            "mm",
+            "translation",
+            (1, 0, 0),
+            f"{detector_path}/transformations/det_z",
+            offset=(fast / 2 * pixel_size, slow / 2 * pixel_size, 0),
+        )
+        _nx_transformation(
+            module,
+            "fast_pixel_direction",
+            pixel_size,
+            "mm",
+            "translation",
+            (-1, 0, 0),
+            f"{module_path}/module_offset",
+        )
+        _nx_transformation(
+            module,
+            "slow_pixel_direction",
+            pixel_size,
+            "mm",
+            "translation",
+            (0, -1, 0),
+            f"{module_path}/module_offset",
+        )
+
+        sample = _nx_group(entry, "sample", "NXsample")
+        sample["depends_on"] = "/entry/sample/transformations/omega"
+        transformations = _nx_group(sample, "transformations", "NXtransformations")
+        _nx_transformation(
+            transformations,
+            "omega",
+            np.arange(n_images) * geometry.oscillation,
+            "deg",
+            "rotation",
+            (-1, 0, 0),
+            ".",
+        )
+
+
+def _nx_group(parent, name: str, nx_class: str):
+    group = parent.create_group(name)
+    group.attrs["NX_class"] = nx_class
+    return group
+
+
+def _nx_field(parent, name: str, value, units: str):
+    dataset = parent.create_dataset(name, data=value)
+    dataset.attrs["units"] = units
+    return dataset
+
+
+def _nx_transformation(
+    parent,
+    name: str,
+    value,
+    units: str,
+    transformation_type: str,
+    vector: tuple[float, float, float],
+    depends_on: str,
+    offset: tuple[float, float, float] | None = None,
+):
+    dataset = _nx_field(parent, name, value, units)
+    dataset.attrs["transformation_type"] = transformation_type
+    dataset.attrs["vector"] = np.array(vector, dtype=float)
+    dataset.attrs["depends_on"] = depends_on
+    if offset is not None:
+        dataset.attrs["offset"] = np.array(offset, dtype=float)
+        dataset.attrs["offset_units"] = units
+    return dataset
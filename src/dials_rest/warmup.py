@@ -0,0 +1,103 @@
+"""
+Deferred loading of the DIALS stack.
+
+The routers only import dials, dxtbx and cctbx when they are first needed, so
+the app can start accepting connections without waiting for them. On startup
+they are imported in the background instead, along with any datasets to
+preload, so that the first request doesn't pay for them either; the server
+reports itself ready once they are loaded.
+"""
+
+from __future__ import annotations
+
+import importlib
+import logging
+import threading
+import time
+from typing import Awaitable, Callable, Iterable
+
+from fastapi.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# The modules used by spotfinding and image rendering, which take seconds to
+# import between them
+DIALS_MODULES = (
+    "dxtbx.imageset",
+    "dxtbx.model.experiment_list",
+    "cctbx.sgtbx",
+    "cctbx.uctbx",
+    "dials.array_family.flex",
+    "dials.algorithms.spot_finding.per_image_analysis",
+    "dials.command_line.find_spots",
+    "dials.util.export_bitmaps",
+    "PIL.Image",
+    "PIL.ImageDraw",
+    "PIL.ImageFont",
+)
+
+# When this module, i.e. the app, started loading
+_t0 = time.perf_counter()
+_imported = threading.Event()
+_ready = threading.Event()
+error: str | None = None
+# Seconds from loading the app to each phase of starting up
+startup_timings: dict[str, float] = {}
+
+
+def import_dials():
+    for name in DIALS_MODULES:
+        importlib.import_module(name)
+
+
+def initialize_worker():
+    """Import the DIALS stack in a new worker process, before it receives any work"""
+    try:
+        import_dials()
+    except Exception:
+        # Let the first job report the error, rather than breaking the pool
+        logger.exception("Failed to import the DIALS stack in a worker process")
+
+
+def record_startup(phase: str):
+    startup_timings[phase] = time.perf_counter() - _t0
+    logger.info(f"Reached {phase} {startup_timings[phase]:.2f} seconds after loading")
+
+
+async def warm_up(preload: Iterable[tuple[str, Callable[[], Awaitable]]] = ()):
+    """
+    Import the DIALS stack, then run each of the given (name, preload) tasks,
+    then mark the server as ready.
+
+    Preloading failures are logged, but don't stop the server from becoming
+    ready, since the files may just not exist yet.
+    """
+    global error
+    t0 = time.perf_counter()
+    try:
+        await run_in_threadpool(import_dials)
+    except Exception as e:
+        logger.exception("Failed to import the DIALS stack")
+        error = f"{type(e).__name__}: {e}"
+        return
+    logger.info(f"Imported the DIALS stack in {time.perf_counter() - t0:.2f} seconds")
+    error = None
+    _imported.set()
+    for name, task in preload:
+        t0 = time.perf_counter()
+        try:
+            await task()
+        except Exception as e:
+            logger.warning(f"Failed to preload {name}: {e}")
+        else:
+            logger.info(f"Preloaded {name} in {time.perf_counter() - t0:.2f} seconds")
+    record_startup("ready")
+    _ready.set()
+
+
+def is_imported() -> bool:
+    return _imported.is_set()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
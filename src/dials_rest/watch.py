@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import re
+import time
+from pathlib import Path
+
+from fastapi import HTTPException, status
+
+from .cache import file_identity
+from .experiments import image_numbers, import_experiments, template_image_path
+
+# The suffixes of HDF5 files, e.g. NeXus, whose frames may be declared before
+# they are written
+HDF5_SUFFIXES = {".h5", ".hdf5", ".nxs"}
+
+
+def is_template(filename: Path) -> bool:
+    return "#" in filename.stem
+
+
+def is_hdf5(filename: Path) -> bool:
+    return filename.suffix.lower() in HDF5_SUFFIXES
+
+
+class DatasetWatcher:
+    """
+    Track the images of a dataset that is still being written, by polling.
+
+    For a filename template, this looks for the file of the next image. For an
+    HDF5 file, e.g. NeXus, it looks for the data of the next frame, with
+    written_frames(). For any other file, it looks for changes to the file's
+    modification time or size, once the file has stopped changing for one poll.
+    Polling only stats or opens files, so is cheap enough to run often; listing
+    the new images, which may need to re-import the dataset, is left to
+    new_images().
+    """
+
+    def __init__(self, filename: Path, start: int = 1):
+        self.filename = filename
+        self.next_image = start
+        self._last_identity: tuple[int, int] | None = None
+        self._listed_identity: tuple[int, int] | None = None
+
+    def poll(self) -> bool:
+        """Whether there may be new images since they were last listed"""
+        if is_template(self.filename):
+            return template_image_path(self.filename, self.next_image).exists()
+        if is_hdf5(self.filename):
+            return written_frames(self.filename) >= self.next_image
+        identity = file_identity(self.filename)
+        stable = identity is not None and identity == self._last_identity
+        self._last_identity = identity
+        return stable and identity != self._listed_identity
+
+    def update(self, images: list[int]):
+        """Record the images returned by new_images(), after a poll"""
+        self._listed_identity = self._last_identity
+        if images:
+            self.next_image = max(images) + 1
+
+
+def new_images(filename: Path, start: int, settle_time: float = 0) -> list[int]:
+    """
+    The numbers of the images of a dataset from start onwards.
+
+    Images of a filename template are listed in order up to the first missing
+    file, or the first file modified within the last settle_time seconds, which
+    may not be completely written yet. Images of an HDF5 file are listed up to
+    the first frame that hasn't been written, from written_frames(). Other files
+    are (re-)imported to list their images.
+    """
+    if is_template(filename):
+        images = []
+        now = time.time()
+        while True:
+            path = template_image_path(filename, start + len(images))
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                break
+            if now - mtime < settle_time:
+                break
+            images.append(start + len(images))
+        return images
+    if is_hdf5(filename):
+        written = written_frames(filename)
+        if written < start:
+            return []
+        return [
+            i
+            for i in image_numbers(import_experiments(filename))
+            if start <= i <= written
+        ]
+    return [i for i in image_numbers(import_experiments(filename)) if i >= start]
+
+
+def written_frames(filename: Path, limit: int | None = None) -> int:
+    """
+    The number of frames of an HDF5 (e.g. NeXus) file, from the first, whose
+    data have been written, counting no further than limit frames if given.
+
+    Files from detectors such as the Eiger declare every frame before it is
+    written, either as a virtual dataset or as external links to data files,
+    which are only created, and then filled, as the frames are written. A frame
+    counts as written once the file holding it exists and the chunk holding it
+    has been allocated. A file that can't be read (yet) has no frames written.
+    """
+    import h5py
+
+    try:
+        with h5py.File(filename, "r") as f:
+            data = f.get("entry/data")
+            if not isinstance(data, h5py.Group):
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f"Can't watch {filename}, which has no /entry/data group",
+                )
+            if "data" in data:
+                names = ["data"]
+            else:
+                # One external link per data file
+                names = sorted(name for name in data if re.fullmatch(r"data_\d+", name))
+            n_frames = 0
+            for name in names:
+                remaining = None if limit is None else limit - n_frames
+                if remaining is not None and remaining <= 0:
+                    break
+                dataset = data.get(name)
+                if not isinstance(dataset, h5py.Dataset):
+                    # An external link to a data file that doesn't exist yet
+                    break
+                if dataset.is_virtual:
+                    written = _written_virtual_frames(
+                        dataset, filename.parent, remaining
+                    )
+                else:
+                    written = _written_stored_frames(dataset, remaining)
+                n_frames += written
+                if written < len(dataset):
+                    break
+            return n_frames
+    except OSError:
+        return 0
+
+
+def _written_virtual_frames(dataset, directory: Path, limit: int | None) -> int:
+    """The frames of a virtual dataset, from the first, with written source data"""
+    import h5py
+
+    written = [False] * _limited(len(dataset), limit)
+    for source in dataset.virtual_sources():
+        (start, *_), (end, *_) = source.vspace.get_select_bounds()
+        if start >= len(written):
+            continue
+        end = min(end, len(written) - 1)
+        if source.src_space.get_select_type() == h5py.h5s.SEL_HYPERSLABS:
+            source_start = source.src_space.get_select_bounds()[0][0]
+        else:
+            source_start = 0
+        source_limit = source_start + end - start + 1
+        if source.file_name == ".":
+            n_source = _written_source_frames(
+                dataset.file, source.dset_name, source_limit
+            )
+        else:
+            try:
+                with h5py.File(directory / source.file_name, "r") as f:
+                    n_source = _written_source_frames(f, source.dset_name, source_limit)
+            except OSError:
+                # The data file hasn't been created yet
+                n_source = 0
+        count = min(end - start + 1, max(0, n_source - source_start))
+        written[start : start + count] = [True] * count
+    return written.index(False) if False in written else len(written)
+
+
+def _written_source_frames(f, name: str, limit: int | None) -> int:
+    import h5py
+
+    dataset = f.get(name)
+    if not isinstance(dataset, h5py.Dataset):
+        return 0
+    return _written_stored_frames(dataset, limit)
+
+
+def _written_stored_frames(dataset, limit: int | None) -> int:
+    """The frames of a dataset, from the first, whose chunks have been allocated"""
+    n_frames = _limited(len(dataset), limit)
+    if dataset.chunks is None:
+        # Contiguous datasets are allocated as a whole, so their frames can't be
+        # told apart
+        return n_frames
+    origin = (0,) * (dataset.ndim - 1)
+    for start in range(0, n_frames, dataset.chunks[0]):
+        if dataset.id.get_chunk_info_by_coord((start, *origin)).byte_offset is None:
+            return start
+    return n_frames
+
+
+def _limited(n_frames: int, limit: int | None) -> int:
+    return n_frames if limit is None else min(n_frames, limit)
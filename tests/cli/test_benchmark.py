@@ -0,0 +1,21 @@
+import pytest
+
+from dials_rest.cli import benchmark
+
+
+def test_summarise():
+    summary = benchmark.summarise([0.3, 0.1, 0.2, 0.4])
+    assert summary["latency_mean"] == pytest.approx(0.25)
+    assert summary["latency_p50"] == 0.3
+    assert summary["latency_max"] == 0.4
+
+
+def test_generate_datasets(tmp_path):
+    datasets = benchmark.generate_datasets(
+        tmp_path, ["cbf"], detector_size=(60, 50), n_images=2, n_spots=5
+    )
+    assert datasets == {"cbf": tmp_path / "synthetic_#####.cbf"}
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "synthetic_00001.cbf",
+        "synthetic_00002.cbf",
+    ]
@@ -1,3 +1,6 @@
+import os
+
+import numpy as np
 import pytest
 from fastapi.testclient import TestClient
 
@@ -5,6 +8,9 @@ JWT_SECRET = "FooBar"
 
 
 def pytest_configure(config):
+    # The settings are read as dials_rest modules are imported, which the test
+    # modules do when they are collected
+    os.environ["DIALS_REST_JWT_SECRET"] = JWT_SECRET
     if not config.pluginmanager.hasplugin("dials_data"):
 
         @pytest.fixture(scope="session")
@@ -14,18 +20,20 @@ def pytest_configure(config):
         globals()["dials_data"] = dials_data
 
 
-@pytest.fixture
-def client(monkeypatch):
+@pytest.fixture(autouse=True)
+def jwt_secret(monkeypatch):
     monkeypatch.setenv("DIALS_REST_JWT_SECRET", JWT_SECRET)
+
+
+@pytest.fixture
+def client():
     from dials_rest.main import app
 
     return TestClient(app)
 
 
 @pytest.fixture
-def access_token(monkeypatch):
-    monkeypatch.setenv("DIALS_REST_JWT_SECRET", JWT_SECRET)
-
+def access_token():
     from dials_rest.auth import create_access_token
 
     return create_access_token(data={})
@@ -34,3 +42,73 @@ def access_token(monkeypatch):
 @pytest.fixture
 def authentication_headers(access_token):
     return {"Authorization": f"Bearer {access_token}"}
+
+
+class _Panel:
+    def __init__(self, image_size=(100, 80), pixel_size=0.5, distance=100):
+        self.image_size = image_size
+        self.pixel_size = pixel_size
+        # The beam hits the centre of the panel
+        self.origin = (
+            image_size[0] * pixel_size / 2,
+            image_size[1] * pixel_size / 2,
+            -distance,
+        )
+
+    def get_image_size(self):
+        return self.image_size
+
+    def get_pixel_size(self):
+        return (self.pixel_size, self.pixel_size)
+
+    def get_origin(self):
+        return self.origin
+
+    def get_fast_axis(self):
+        return (-1, 0, 0)
+
+    def get_slow_axis(self):
+        return (0, -1, 0)
+
+
+class _Detector(list):
+    def get_max_resolution(self, s0):
+        panel = self[0]
+        fast, slow = panel.get_image_size()
+        # The corners of the panel are furthest from the beam
+        radius = np.hypot(fast, slow) * panel.pixel_size / 2
+        two_theta = np.arctan2(radius, -panel.origin[2])
+        return np.linalg.norm(s0) ** -1 / (2 * np.sin(two_theta / 2))
+
+    def to_dict(self):
+        return {"panels": [vars(panel) for panel in self]}
+
+
+class _Beam:
+    def __init__(self, wavelength=1.0):
+        self.wavelength = wavelength
+
+    def get_wavelength(self):
+        return self.wavelength
+
+    def get_s0(self):
+        return (0, 0, -1 / self.wavelength)
+
+    def to_dict(self):
+        return {"wavelength": self.wavelength}
+
+
+@pytest.fixture
+def make_detector_and_beam():
+    """
+    Make minimal stand-ins for dxtbx detector and beam models: a single flat
+    panel, perpendicular to the beam, with the beam at its centre
+    """
+
+    def make(image_size=(100, 80), pixel_size=0.5, distance=100, wavelength=1.0):
+        return (
+            _Detector([_Panel(image_size, pixel_size, distance)]),
+            _Beam(wavelength),
+        )
+
+    return make
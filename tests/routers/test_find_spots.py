@@ -1,21 +1,49 @@
 from __future__ import annotations
 
+import json
 import os
 from unittest import mock
 
+import pydantic
 import pytest
-from fastapi import status
+from fastapi import HTTPException, status
 
+from dials_rest.routers import find_spots
 
-def test_find_spots_params_schema(monkeypatch):
-    monkeypatch.setenv("DIALS_REST_JWT_SECRET", "FooBar")
-    from dials_rest.routers import find_spots
 
+def test_find_spots_params_schema():
     p = find_spots.PerImageAnalysisParameters(filename="/path/to/image.cbf")
     p.json()
     p.schema()
 
 
+def test_find_spots_params_spot_size_range():
+    p = find_spots.PerImageAnalysisParameters(
+        filename="/path/to/image.cbf", kernel_size="5,5", min_spot_size=3
+    )
+    assert p.kernel_size == (5, 5)
+    with pytest.raises(pydantic.ValidationError):
+        find_spots.PerImageAnalysisParameters(
+            filename="/path/to/image.cbf", min_spot_size=10, max_spot_size=5
+        )
+
+
+def test_find_spots_phil_params_are_memoised():
+    p = find_spots.PerImageAnalysisParameters(
+        filename="/path/to/image.cbf", gain=2, kernel_size=(5, 5), scan_range=(1, 1)
+    )
+    find_spots._spotfinder_phil_params.cache_clear()
+    a = find_spots._phil_params(p)
+    b = find_spots._phil_params(p.copy(update={"scan_range": (2, 2)}))
+    assert find_spots._spotfinder_phil_params.cache_info().hits == 1
+    # Each request gets its own copy of the parameters
+    assert a is not b
+    assert a.spotfinder.scan_range == ((1, 1),)
+    assert b.spotfinder.scan_range == ((2, 2),)
+    assert b.spotfinder.threshold.dispersion.gain == 2
+    assert tuple(b.spotfinder.threshold.dispersion.kernel_size) == (5, 5)
+
+
 def test_find_spots_file_not_found_responds_404(client, authentication_headers):
     data = {"filename": "/made/up/path.cbf"}
     response = client.post("find_spots", json=data, headers=authentication_headers)
@@ -80,6 +108,33 @@ def test_find_spots_cbf(filename, client, authentication_headers, dials_data):
     }
 
 
+def test_find_spots_mask_not_found_responds_404(
+    client, authentication_headers, dials_data
+):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "mask": "/made/up/mask.pickle",
+    }
+    response = client.post("find_spots", json=data, headers=authentication_headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_find_spots_cbf_spotfinder_options(client, authentication_headers, dials_data):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "d_min": 3.5,
+        "min_spot_size": 10,
+    }
+    response = client.post("find_spots", json=data, headers=authentication_headers)
+    assert response.status_code == 200
+    # Requiring larger spots can only reduce the number found
+    assert response.json()["n_spots_total"] < 49
+
+
 def test_find_spots_h5(client, authentication_headers, dials_data):
     data = {
         "filename": os.fspath(
@@ -100,3 +155,178 @@ def test_find_spots_h5(client, authentication_headers, dials_data):
         "noisiness_method_1": mock.ANY,
         "noisiness_method_2": mock.ANY,
     }
+
+
+def test_find_spots_batch_params_with_images_and_scan_range_responds_422(
+    client, authentication_headers
+):
+    data = {"filename": "/made/up/path.cbf", "scan_range": [1, 2], "images": [1]}
+    response = client.post(
+        "find_spots/batch", json=data, headers=authentication_headers
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.parametrize(
+    "selection", [{"images": [2, 12]}, {"scan_range": [9, 11]}, {"scan_range": [0, 1]}]
+)
+def test_find_spots_batch_images_out_of_range_responds_422(selection, monkeypatch):
+    monkeypatch.setattr(find_spots, "import_experiments", lambda filename: None)
+    monkeypatch.setattr(
+        find_spots, "image_numbers", lambda experiments: [1, 2, 3, 9, 10]
+    )
+    params = find_spots.BatchAnalysisParameters(
+        filename="/path/to/image.cbf", **selection
+    )
+    with pytest.raises(HTTPException) as e:
+        find_spots._image_indices(params)
+    assert e.value.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert "outside the range of images 1-10" in e.value.detail
+
+    params = find_spots.BatchAnalysisParameters(
+        filename="/path/to/image.cbf", images=[3, 1]
+    )
+    assert find_spots._image_indices(params) == [3, 1]
+
+
+def test_find_spots_batch_file_not_found_responds_404(client, authentication_headers):
+    data = {"filename": "/made/up/path.cbf"}
+    response = client.post(
+        "find_spots/batch", json=data, headers=authentication_headers
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_find_spots_batch_cbf(client, authentication_headers, dials_data):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_####.cbf"
+        ),
+        "scan_range": (1, 3),
+        "d_min": 3.5,
+    }
+    response = client.post(
+        "find_spots/batch", json=data, headers=authentication_headers
+    )
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["image_index"] for r in results] == [1, 2, 3]
+    assert results[0] == {
+        "image_index": 1,
+        "processing_time": mock.ANY,
+        "n_spots_4A": 36,
+        "n_spots_no_ice": 44,
+        "n_spots_total": 49,
+        "total_intensity": 56848.0,
+        "d_min_distl_method_1": mock.ANY,
+        "d_min_distl_method_2": mock.ANY,
+        "estimated_d_min": mock.ANY,
+        "noisiness_method_1": mock.ANY,
+        "noisiness_method_2": mock.ANY,
+    }
+
+
+def test_find_spots_stream_file_not_found_responds_404(client, authentication_headers):
+    data = {"filename": "/made/up/path.cbf"}
+    response = client.post(
+        "find_spots/stream", json=data, headers=authentication_headers
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.parametrize("event_stream", [False, True])
+def test_find_spots_stream_cbf(
+    event_stream, client, authentication_headers, dials_data
+):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_####.cbf"
+        ),
+        "images": [1, 2, 3],
+        "d_min": 3.5,
+    }
+    headers = dict(authentication_headers)
+    if event_stream:
+        headers["Accept"] = "text/event-stream"
+    with client.stream(
+        "POST", "find_spots/stream", json=data, headers=headers
+    ) as response:
+        assert response.status_code == 200
+        lines = [line for line in response.iter_lines() if line]
+    if event_stream:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert lines[::2] == ["event: result"] * 3
+        assert all(line.startswith("data: ") for line in lines[1::2])
+        lines = [line[len("data: ") :] for line in lines[1::2]]
+    else:
+        assert response.headers["content-type"] == "application/x-ndjson"
+    results = sorted(
+        (json.loads(line) for line in lines), key=lambda r: r["image_index"]
+    )
+    assert [r["image_index"] for r in results] == [1, 2, 3]
+    assert results[0]["n_spots_total"] == 49
+
+
+def test_filter_by_resolution():
+    from dials.array_family import flex
+
+    reflections = flex.reflection_table()
+    reflections["rlp"] = flex.vec3_double(
+        [(0, 0, 1 / d) for d in (1.0, 2.0, 3.0, 50.0)]
+    )
+    selected = find_spots._filter_by_resolution(reflections, d_min=1.5, d_max=40)
+    assert list(selected["d"]) == pytest.approx([2.0, 3.0])
+    selected = find_spots._filter_by_resolution(reflections, d_min=2.5)
+    assert list(selected["d"]) == pytest.approx([3.0, 50.0])
+
+
+def test_find_spots_watch_template(
+    client, authentication_headers, monkeypatch, tmp_path
+):
+    def find_spots_for_image(params, image_index):
+        assert params.filename == tmp_path / f"image_{image_index:03d}.cbf"
+        return {
+            "n_spots_4A": 0,
+            "n_spots_no_ice": 0,
+            "n_spots_total": image_index,
+            "total_intensity": 0,
+        }
+
+    monkeypatch.setattr(find_spots, "_find_spots_for_image", find_spots_for_image)
+    for i in (1, 2, 3):
+        (tmp_path / f"image_{i:03d}.cbf").write_bytes(b"")
+    data = {
+        "filename": os.fspath(tmp_path / "image_###.cbf"),
+        "start": 2,
+        "end": 3,
+        "poll_interval": 0.1,
+    }
+    with client.stream(
+        "POST", "find_spots/watch", json=data, headers=authentication_headers
+    ) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = [json.loads(line) for line in response.iter_lines() if line]
+    assert sorted(r["n_spots_total"] for r in results) == [2, 3]
+
+
+def test_find_spots_watch_idle_timeout(client, authentication_headers, tmp_path):
+    data = {
+        "filename": os.fspath(tmp_path / "master.h5"),
+        "poll_interval": 0.1,
+        "idle_timeout": 0.3,
+    }
+    headers = {**authentication_headers, "Accept": "text/event-stream"}
+    with client.stream(
+        "POST", "find_spots/watch", json=data, headers=headers
+    ) as response:
+        assert response.status_code == 200
+        assert [line for line in response.iter_lines() if line] == []
+
+
+def test_find_spots_watch_rejects_scan_range(client, authentication_headers):
+    data = {"filename": "/made/up/image_#####.cbf", "scan_range": [1, 10]}
+    response = client.post(
+        "find_spots/watch", json=data, headers=authentication_headers
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
@@ -1,17 +1,24 @@
 from __future__ import annotations
 
+import asyncio
+import contextlib
 import os
+import sys
 from io import BytesIO
+from types import SimpleNamespace
 
+import numpy as np
+import PIL.ImageFont
+import pydantic
 import pytest
-from fastapi import status
+from fastapi import HTTPException, status
 from PIL import Image
 
+from dials_rest.executor import WorkerPool
+from dials_rest.routers import image
 
-def test_export_bitmap_params_schema(monkeypatch):
-    monkeypatch.setenv("DIALS_REST_JWT_SECRET", "FooBar")
-    from dials_rest.routers import image
 
+def test_export_bitmap_params_schema():
     p = image.ExportBitmapParams(filename="/path/to/image.cbf")
     p.json()
     p.schema()
@@ -102,3 +109,482 @@ def test_export_bitmap_h5(client, authentication_headers, dials_data):
     assert response.status_code == 200
     img = Image.open(BytesIO(response.content))
     assert img.size == (1034, 1081)
+
+
+def test_export_bitmap_etag(client, authentication_headers, dials_data):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "binning": 4,
+    }
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    headers = {**authentication_headers, "If-None-Match": etag}
+    response = client.post("export_bitmap", json=data, headers=headers)
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.headers["ETag"] == etag
+    assert not response.content
+
+    # A different image has a different ETag
+    data["binning"] = 2
+    response = client.post("export_bitmap", json=data, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    img = Image.open(BytesIO(response.content))
+    assert img.size == (1231, 1263)
+
+
+def test_export_bitmap_tile_cbf(client, authentication_headers, dials_data):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "binning": 4,
+        "resolution_rings": {"show": True},
+    }
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert response.status_code == 200
+    full = Image.open(BytesIO(response.content))
+    assert full.size == (615, 631)
+
+    for x, y, size in [(0, 0, (256, 256)), (512, 512, (103, 119))]:
+        response = client.post(
+            "export_bitmap/tile",
+            json={**data, "x": x, "y": y},
+            headers=authentication_headers,
+        )
+        assert response.status_code == 200
+        tile = Image.open(BytesIO(response.content))
+        assert tile.size == size
+        assert (
+            tile.convert("RGB").tobytes()
+            == full.convert("RGB").crop((x, y, x + size[0], y + size[1])).tobytes()
+        )
+
+
+def test_export_bitmap_tile_outside_image_responds_422(
+    client, authentication_headers, dials_data
+):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "binning": 4,
+        "x": 615,
+    }
+    response = client.post(
+        "export_bitmap/tile", json=data, headers=authentication_headers
+    )
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+@pytest.mark.parametrize("stack_mode", ["sum", "mean", "max"])
+def test_export_bitmap_stacked_images(
+    stack_mode, client, authentication_headers, dials_data
+):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_####.cbf"
+        ),
+        "image_index": 1,
+        "binning": 4,
+        "stack_images": 3,
+        "stack_mode": stack_mode,
+        "resolution_rings": {"show": True},
+    }
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert response.status_code == 200
+    img = Image.open(BytesIO(response.content))
+    assert img.size == (615, 631)
+
+
+def test_export_bitmap_stacked_images_out_of_range_responds_422(
+    client, authentication_headers, dials_data
+):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_####.cbf"
+        ),
+        "image_index": 8,
+        "stack_images": 3,
+    }
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_ice_ring_params_are_validated_without_cctbx(monkeypatch):
+    monkeypatch.setitem(sys.modules, "cctbx", None)
+    params = image.ExportBitmapParams(
+        filename="/path/to/image.cbf",
+        ice_rings={"unit_cell": "4.5, 4.5, 7.3, 90, 90, 120", "space_group": 194},
+    )
+    assert params.ice_rings.unit_cell == (4.5, 4.5, 7.3, 90.0, 90.0, 120.0)
+    with pytest.raises(pydantic.ValidationError):
+        image.IceRingsParams(unit_cell="4.5 4.5 a 90 90 120")
+
+
+@pytest.mark.parametrize(
+    "ice_rings",
+    [{"unit_cell": "1 1 1 90 90 270"}, {"space_group": "P 7"}],
+)
+def test_export_bitmap_invalid_ice_rings_responds_422(
+    ice_rings, client, authentication_headers, dials_data
+):
+    pytest.importorskip("cctbx.sgtbx")
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "ice_rings": {"show": True, **ice_rings},
+    }
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+    assert response.json()["detail"].startswith("Invalid")
+
+
+def test_ring_overlay_is_cached(make_detector_and_beam):
+    detector, beam = make_detector_and_beam()
+    expt = SimpleNamespace(detector=detector, beam=beam)
+    params = image.ExportBitmapParams(
+        filename="/path/to/image.cbf",
+        binning=2,
+        resolution_rings={"show": True, "number": 3, "fill": "red"},
+    )
+    image.overlay_cache.clear()
+    rendered = []
+    for _ in range(2):
+        pil_img = Image.new("RGB", (50, 40))
+        image._draw_rings(expt, pil_img, None, params)
+        rendered.append(np.asarray(pil_img))
+    assert len(image.overlay_cache) == 1
+    assert (rendered[0] == rendered[1]).all()
+    # Only the ring pixels and labels are drawn, in the requested colour
+    drawn = rendered[0].any(axis=-1)
+    assert drawn.any() and not drawn.all()
+    assert (rendered[0][drawn][:, 1:] == 0).all()
+
+
+def test_ring_labels_fall_back_to_bitmap_font(monkeypatch, make_detector_and_beam):
+    def load_default_without_size(size=None):
+        # As on Pillow < 10.1, which only has the bitmap font
+        if size is not None:
+            raise TypeError("load_default() got an unexpected keyword argument 'size'")
+        return PIL.ImageFont.load_default_imagefont()
+
+    monkeypatch.setattr(PIL.ImageFont, "load_default", load_default_without_size)
+    geometry = image.DetectorGeometry(*make_detector_and_beam())
+    rings = geometry.rings(geometry.resolution_ring_spacings(3))
+    pil_img = Image.new("RGBA", (100, 80), (0, 0, 0, 0))
+    image._draw_ring_overlay(pil_img, rings, fill="red", fontsize=30)
+    assert pil_img.getbbox() is not None
+
+
+@pytest.mark.parametrize(
+    "options,lossless",
+    [
+        ({"format": "png"}, True),
+        ({"format": "png", "compression_level": 1}, True),
+        ({"format": "webp"}, True),
+        ({"format": "webp", "compression_level": 0}, True),
+        ({"format": "webp", "quality": 50}, False),
+        ({"format": "jpeg", "quality": 50}, False),
+    ],
+)
+def test_encode(options, lossless):
+    params = image.ExportBitmapParams(filename="/path/to/image.cbf", **options)
+    rng = np.random.default_rng(42)
+    pil_img = Image.fromarray(rng.integers(0, 256, (40, 50, 3), dtype=np.uint8))
+    decoded = Image.open(BytesIO(image._encode(pil_img, params, {})))
+    assert decoded.format.lower() == options["format"]
+    assert decoded.size == pil_img.size
+    if lossless:
+        assert decoded.convert("RGB").tobytes() == pil_img.tobytes()
+
+
+def test_encoding_is_timed_with_image_labels(monkeypatch):
+    stages = []
+
+    @contextlib.contextmanager
+    def stage_timer(stage, **labels):
+        stages.append((stage, labels))
+        yield
+
+    monkeypatch.setattr(image, "stage_timer", stage_timer)
+    params = image.ExportBitmapParams(filename="/path/to/image.cbf")
+    labels = {"fmt": "FormatCBFMiniPilatus", "detector": "1x100x80"}
+    image._encode(Image.new("RGB", (10, 10)), params, labels)
+    assert stages == [("encoding", labels)]
+
+
+def test_encoding_options_change_etag(tmp_path):
+    filename = tmp_path / "image.cbf"
+    filename.touch()
+    keys = {
+        image._bitmap_cache_key(image.ExportBitmapParams(filename=filename, **options))
+        for options in (
+            {},
+            {"compression_level": 1},
+            {"format": "webp"},
+            {"format": "webp", "quality": 80},
+        )
+    }
+    assert len(keys) == 4
+
+
+@pytest.mark.parametrize(
+    "setting, value",
+    [
+        ("bitmap_pyramid", True),
+        ("bitmap_pyramid_levels", 2),
+        ("png_compression_level", 1),
+    ],
+)
+def test_render_settings_change_etag(setting, value, tmp_path, monkeypatch):
+    filename = tmp_path / "image.cbf"
+    filename.touch()
+    params = image.ExportBitmapParams(filename=filename, binning=2)
+    key = image._bitmap_cache_key(params)
+    monkeypatch.setattr(image._settings, setting, value)
+    assert image._bitmap_cache_key(params) != key
+
+
+def test_unwritten_nexus_frames_are_not_cached(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    with h5py.File(filename, "w") as f:
+        f.create_group("entry/data")["data"] = h5py.ExternalLink(
+            "data_000001.h5", "data"
+        )
+    params = image.ExportBitmapParams(filename=filename, image_index=2)
+    assert image._bitmap_cache_key(params) is None
+    with h5py.File(tmp_path / "data_000001.h5", "w") as f:
+        dataset = f.create_dataset(
+            "data", shape=(10, 4, 4), dtype="i4", chunks=(1, 4, 4)
+        )
+        dataset[0] = 1
+    # The master file is unchanged, but only the first frame is written
+    assert image._bitmap_cache_key(params.copy(update={"image_index": 1}))
+    assert image._bitmap_cache_key(params) is None
+    stacked = params.copy(update={"image_index": 1, "stack_images": 2})
+    assert image._bitmap_cache_key(stacked) is None
+    with h5py.File(tmp_path / "data_000001.h5", "r+") as f:
+        f["data"][1] = 1
+    assert image._bitmap_cache_key(params)
+    assert image._bitmap_cache_key(stacked)
+
+
+@pytest.fixture
+def pyramid_mode(monkeypatch, tmp_path):
+    """
+    Render in pyramid mode from a colour-mapped 80x100 frame, which is what
+    dials would render at binning 1, counting how often it is rendered
+    """
+    monkeypatch.setattr(image._settings, "bitmap_pyramid", True)
+    monkeypatch.setattr(image._settings, "bitmap_pyramid_levels", 3)
+    for cache in ("bitmap_cache", "pyramid_cache", "frame_cache"):
+        monkeypatch.setattr(image, cache, image.LRUCache(max_entries=16))
+    frame = np.random.default_rng(0).integers(0, 256, (80, 100, 3), dtype=np.uint8)
+    expt = SimpleNamespace(
+        imageset=SimpleNamespace(get_format_class=lambda: object), detector=None
+    )
+    rendered = []
+
+    def colour_mapped(params):
+        rendered.append(params.binning)
+        b = params.binning
+        return expt, None, frame[: 80 // b * b : b, : 100 // b * b : b]
+
+    monkeypatch.setattr(image, "_colour_mapped", colour_mapped)
+    monkeypatch.setattr(image, "import_experiment_for_image", lambda *args: expt)
+    filename = tmp_path / "image_00001.cbf"
+    filename.write_bytes(b"")
+    return filename, rendered
+
+
+def test_export_bitmap_pyramid_mode(client, authentication_headers, pyramid_mode):
+    filename, rendered = pyramid_mode
+    etags = {}
+    for binning, size in ((1, (100, 80)), (2, (50, 40)), (4, (25, 20))):
+        data = {"filename": str(filename), "binning": binning}
+        response = client.post(
+            "export_bitmap", json=data, headers=authentication_headers
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert Image.open(BytesIO(response.content)).size == size
+        etags[binning] = response.headers["ETag"]
+    # Every level comes from a single render at full resolution
+    assert rendered == [1]
+    assert len(set(etags.values())) == 3
+
+    # Beyond the levels of the pyramid, frames are rendered at the binning
+    data = {"filename": str(filename), "binning": 8}
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert Image.open(BytesIO(response.content)).size == (12, 10)
+    assert rendered == [1, 8]
+
+    # Levels are revalidated and cached like any other image
+    data = {"filename": str(filename), "binning": 2}
+    response = client.post(
+        "export_bitmap",
+        json=data,
+        headers={**authentication_headers, "If-None-Match": etags[2]},
+    )
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    hits = image.bitmap_cache.hits
+    response = client.post("export_bitmap", json=data, headers=authentication_headers)
+    assert response.headers["ETag"] == etags[2]
+    assert image.bitmap_cache.hits == hits + 1
+    assert rendered == [1, 8]
+
+
+def test_export_bitmap_tile_pyramid_mode(client, authentication_headers, pyramid_mode):
+    filename, rendered = pyramid_mode
+    for binning, size in ((1, (64, 64)), (2, (50, 40)), (4, (25, 20))):
+        data = {"filename": str(filename), "binning": binning, "width": 64}
+        data["height"] = 64
+        response = client.post(
+            "export_bitmap/tile", json=data, headers=authentication_headers
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert Image.open(BytesIO(response.content)).size == size
+    data = {"filename": str(filename), "binning": 2, "x": 32, "y": 32}
+    response = client.post(
+        "export_bitmap/tile", json=data, headers=authentication_headers
+    )
+    assert Image.open(BytesIO(response.content)).size == (18, 8)
+    assert rendered == [1]
+
+
+class _FakeSequence:
+    """The parts of a dxtbx ImageSequence of images first..last used to render"""
+
+    def __init__(self, first: int, last: int):
+        self.image_range = (first, last)
+        self.read = []
+
+    def __len__(self):
+        return self.image_range[1] - self.image_range[0] + 1
+
+    def get_scan(self):
+        return SimpleNamespace(get_image_range=lambda: self.image_range)
+
+    def get_array_range(self):
+        return (self.image_range[0] - 1, self.image_range[1])
+
+    def get_format_class(self):
+        return object
+
+    def get_path(self, index):
+        return "/path/to/image.cbf"
+
+    def get_raw_data(self, index):
+        self.read.append(index)
+        return (_panel(index),)
+
+
+def _panel(value):
+    """A panel of raw data, as far as stacking it goes"""
+    return SimpleNamespace(
+        as_numpy_array=lambda: np.full((2, 2), value), size=lambda: 4
+    )
+
+
+def _imageset_as_flex_image(imageset, images, **kwargs):
+    """Read images like dials.util.export_bitmaps.imageset_as_flex_image"""
+    from dxtbx.imageset import ImageSequence
+
+    start = imageset.get_array_range()[0] if isinstance(imageset, ImageSequence) else 0
+    for image_number in images:
+        imageset.get_raw_data(image_number - 1 - start)
+        data = np.zeros((4, 5, 3), dtype=np.uint8)
+        yield SimpleNamespace(
+            as_bytes=lambda: data.tobytes(), ex_size1=lambda: 4, ex_size2=lambda: 5
+        )
+
+
+@pytest.fixture
+def offset_sequence(monkeypatch):
+    """Render images of a sequence of images 11 to 20"""
+    from dxtbx.imageset import ImageSequence
+
+    imageset = type("Sequence", (_FakeSequence, ImageSequence), {})(11, 20)
+    expt = SimpleNamespace(imageset=imageset, detector=None)
+    monkeypatch.setattr(image, "import_experiment_for_image", lambda *args: expt)
+    monkeypatch.setattr(
+        "dials.util.export_bitmaps.imageset_as_flex_image", _imageset_as_flex_image
+    )
+    return imageset
+
+
+def test_colour_mapped_reads_frame_of_offset_sequence(offset_sequence):
+    params = image.ExportBitmapParams(filename="/path/to/image.cbf", image_index=13)
+    image._colour_mapped(params)
+    assert offset_sequence.read == [2]
+    params = image.ExportBitmapParams(filename="/path/to/image.cbf", image_index=21)
+    with pytest.raises(HTTPException) as e:
+        image._colour_mapped(params)
+    assert e.value.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_colour_mapped_stacks_frames_of_offset_sequence(offset_sequence, monkeypatch):
+    # numpy arrays stand in for flex arrays of the stacked frames
+    monkeypatch.setattr(
+        "dials.array_family.flex",
+        SimpleNamespace(double=lambda a: a, grid=lambda shape: shape),
+    )
+    params = image.ExportBitmapParams(
+        filename="/path/to/image.cbf", image_index=13, stack_images=3
+    )
+    image._colour_mapped(params)
+    assert offset_sequence.read == [2, 3, 4]
+    params = params.copy(update={"image_index": 19})
+    with pytest.raises(HTTPException) as e:
+        image._colour_mapped(params)
+    assert e.value.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_render_direct_matches_colour_mapped_bytes(monkeypatch):
+    data = np.random.default_rng(0).integers(0, 256, (4, 5, 3), dtype=np.uint8)
+    flex_img = SimpleNamespace(
+        as_bytes=lambda: data.tobytes(), ex_size1=lambda: 4, ex_size2=lambda: 5
+    )
+    expt = SimpleNamespace(imageset=_FakeSequence(1, 1), detector=None)
+    monkeypatch.setattr(image, "import_experiment_for_image", lambda *args: expt)
+    monkeypatch.setattr(
+        "dials.util.export_bitmaps.imageset_as_flex_image",
+        lambda *args, **kw: iter([flex_img]),
+    )
+    params = image.ExportBitmapParams(filename="/path/to/image.cbf")
+
+    _, _, rgb = image._colour_mapped(params)
+    assert not rgb.flags.writeable
+    assert (rgb == data).all()
+    assert np.asarray(image._render_direct(params)).tolist() == data.tolist()
+
+
+def test_preload_fills_bitmap_cache(monkeypatch, tmp_path):
+    filename = tmp_path / "image_00001.cbf"
+    filename.touch()
+    monkeypatch.setattr(image, "bitmap_cache", image.LRUCache(max_entries=8))
+    monkeypatch.setattr(
+        image, "_image_as_bitmap", lambda params: str(params.binning).encode()
+    )
+    preloaded_rings = []
+    monkeypatch.setattr(
+        image, "_preload_rings", lambda *args: preloaded_rings.append(args)
+    )
+    pool = WorkerPool(max_workers=1)
+    try:
+        asyncio.run(image.preload(filename, [1, 4], pool))
+    finally:
+        pool.shutdown()
+    # A request for the first image with the default parameters is a cache hit
+    for binning in (1, 4):
+        params = image.ExportBitmapParams(filename=filename, binning=binning)
+        key = image._bitmap_cache_key(params)
+        assert image.bitmap_cache.get(key) == str(binning).encode()
+    assert preloaded_rings == [(filename, [1, 4])]
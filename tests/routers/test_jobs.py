@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import os
+
+from fastapi import status
+
+
+def test_get_job_not_found_responds_404(client, authentication_headers):
+    response = client.get("jobs/made-up-job", headers=authentication_headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_find_spots_job_file_not_found_fails_with_404(client, authentication_headers):
+    data = {"filename": "/made/up/path.cbf"}
+    # Jobs run in the background on the client's event loop, so keep it running
+    with client:
+        response = client.post(
+            "jobs/find_spots", json=data, headers=authentication_headers
+        )
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        job_id = response.json()["job_id"]
+        assert response.headers["Location"] == f"/jobs/{job_id}"
+        response = client.get(
+            f"jobs/{job_id}", params={"wait": 10}, headers=authentication_headers
+        )
+    assert response.status_code == 200
+    job = response.json()
+    assert job["status"] == "failed"
+    assert job["error"]["status_code"] == status.HTTP_404_NOT_FOUND
+
+
+def test_find_spots_job_cbf(client, authentication_headers, dials_data):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_####.cbf"
+        ),
+        "scan_range": (1, 3),
+        "d_min": 3.5,
+    }
+    with client:
+        response = client.post(
+            "jobs/find_spots", json=data, headers=authentication_headers
+        )
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        job_id = response.json()["job_id"]
+        response = client.get(
+            f"jobs/{job_id}", params={"wait": 60}, headers=authentication_headers
+        )
+        job = response.json()
+        assert job["status"] == "completed"
+        assert job["progress"] == {"done": 3, "total": 3}
+        assert [r["image_index"] for r in job["results"]] == [1, 2, 3]
+        assert job["results"][0]["n_spots_total"] == 49
+
+        response = client.delete(f"jobs/{job_id}", headers=authentication_headers)
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        response = client.get(f"jobs/{job_id}", headers=authentication_headers)
+        assert response.status_code == status.HTTP_404_NOT_FOUND
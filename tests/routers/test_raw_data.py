@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import gzip
+import os
+from io import BytesIO
+
+import numpy as np
+import pytest
+from fastapi import status
+
+from dials_rest.routers import raw_data
+
+
+def test_raw_data_params_schema():
+    p = raw_data.RawDataParams(filename="/path/to/image.cbf")
+    p.json()
+    p.schema()
+
+
+def test_raw_data_without_jwt_responds_401(client):
+    response = client.post("raw_data")
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_raw_data_file_not_found_responds_404(client, authentication_headers):
+    data = {"filename": "/made/up/path.cbf"}
+    response = client.post("raw_data", json=data, headers=authentication_headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.parametrize("filename", ["centroid_0001.cbf", "centroid_####.cbf"])
+def test_raw_data_cbf(filename, client, authentication_headers, dials_data):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / filename
+        ),
+        "image_index": 1,
+    }
+    response = client.post("raw_data", json=data, headers=authentication_headers)
+    assert response.status_code == 200
+    assert response.headers["X-Data-Shape"] == "2527,2463"
+    pixels = np.load(BytesIO(response.content))
+    assert pixels.shape == (2527, 2463)
+    assert pixels.dtype.str == response.headers["X-Data-Dtype"]
+
+    data.update(
+        {"binning": 4, "apply_mask": True, "format": "raw", "compression": "gzip"}
+    )
+    response = client.post("raw_data", json=data, headers=authentication_headers)
+    assert response.status_code == 200
+    assert response.headers["X-Data-Shape"] == "631,615"
+    binned = np.frombuffer(
+        gzip.decompress(response.content), dtype=response.headers["X-Data-Dtype"]
+    ).reshape(631, 615)
+    trusted = pixels[: 631 * 4, : 615 * 4] >= 0
+    assert binned.max() > 0
+    assert binned[binned >= 0].sum() <= pixels[: 631 * 4, : 615 * 4][trusted].sum()
+
+
+def test_raw_data_image_out_of_range_responds_422(
+    client, authentication_headers, dials_data
+):
+    data = {
+        "filename": os.fspath(
+            dials_data("centroid_test_data", pathlib=True) / "centroid_0001.cbf"
+        ),
+        "image_index": 2,
+    }
+    response = client.post("raw_data", json=data, headers=authentication_headers)
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
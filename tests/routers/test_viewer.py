@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+from fastapi import status
+from starlette.websockets import WebSocketDisconnect
+
+from dials_rest.routers import viewer
+
+
+@pytest.fixture
+def rendered(monkeypatch):
+    """Render each image as its image index, recording which were rendered"""
+    rendered = []
+
+    def image_as_bitmap(params):
+        rendered.append(params.image_index)
+        if params.image_index > 10:
+            raise viewer.HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="No such image"
+            )
+        return str(params.image_index).encode()
+
+    monkeypatch.setattr(viewer, "_image_as_bitmap", image_as_bitmap)
+    return rendered
+
+
+def test_image_stream_without_jwt_is_closed(client):
+    with pytest.raises(WebSocketDisconnect) as e:
+        with client.websocket_connect("export_bitmap/ws"):
+            pass
+    assert e.value.code == status.WS_1008_POLICY_VIOLATION
+
+
+def test_image_stream_invalid_jwt_is_closed(client):
+    with pytest.raises(WebSocketDisconnect) as e:
+        with client.websocket_connect("export_bitmap/ws?token=FooBar"):
+            pass
+    assert e.value.code == status.WS_1008_POLICY_VIOLATION
+
+
+def test_image_stream(client, access_token, rendered, tmp_path):
+    filename = tmp_path / "image_00001.cbf"
+    filename.write_bytes(b"")
+    with client.websocket_connect(f"export_bitmap/ws?token={access_token}") as ws:
+        ws.send_json({"filename": str(filename), "image_index": 1, "format": "jpeg"})
+        header = ws.receive_json()
+        assert header["image_index"] == 1
+        assert header["media_type"] == "image/jpeg"
+        assert header["etag"]
+        assert ws.receive_bytes() == b"1"
+
+        # Only the changed parameters need to be sent
+        ws.send_json({"image_index": 3})
+        assert ws.receive_json()["image_index"] == 3
+        assert ws.receive_bytes() == b"3"
+
+        # Errors are reported without closing the connection
+        ws.send_json({"image_index": 11})
+        assert ws.receive_json() == {
+            "image_index": 11,
+            "error": {"status_code": 404, "detail": "No such image"},
+        }
+        ws.send_json({"binning": 0})
+        assert ws.receive_json()["error"]["status_code"] == 422
+        ws.send_text("[1, 2]")
+        assert ws.receive_json()["error"]["status_code"] == 400
+        ws.send_json({"image_index": 2})
+        assert ws.receive_json()["image_index"] == 2
+        assert ws.receive_bytes() == b"2"
+
+
+def test_image_stream_rejects_binary_messages(client, access_token, rendered):
+    with client.websocket_connect(f"export_bitmap/ws?token={access_token}") as ws:
+        ws.send_bytes(b'{"image_index": 1}')
+        assert ws.receive_json() == {
+            "image_index": None,
+            "error": {"status_code": 400, "detail": "Expected a JSON text message"},
+        }
+        ws.send_json({"image_index": 1})
+        assert ws.receive_json()["error"]["status_code"] == 422
+    assert rendered == []
+
+
+def test_image_stream_reports_unexpected_errors(
+    client, access_token, rendered, tmp_path, monkeypatch
+):
+    filename = tmp_path / "image_00001.cbf"
+    filename.write_bytes(b"")
+    image_as_bitmap = viewer._image_as_bitmap
+
+    def broken_image_as_bitmap(params):
+        if params.image_index == 5:
+            raise RuntimeError("Broken image")
+        return image_as_bitmap(params)
+
+    monkeypatch.setattr(viewer, "_image_as_bitmap", broken_image_as_bitmap)
+    monkeypatch.setattr(viewer.Settings.get(), "viewer_prefetch_frames", 0)
+    with client.websocket_connect(f"export_bitmap/ws?token={access_token}") as ws:
+        ws.send_json({"filename": str(filename), "image_index": 5})
+        assert ws.receive_json() == {
+            "image_index": 5,
+            "error": {"status_code": 500, "detail": "Broken image"},
+        }
+        # The stream carries on with the next image
+        ws.send_json({"image_index": 6})
+        assert ws.receive_json()["image_index"] == 6
+        assert ws.receive_bytes() == b"6"
+
+
+def test_image_stream_prefetches_next_frames(
+    client, authentication_headers, rendered, tmp_path
+):
+    filename = tmp_path / "image_00001.cbf"
+    filename.write_bytes(b"")
+    with client.websocket_connect(
+        "export_bitmap/ws", headers=authentication_headers
+    ) as ws:
+        ws.send_json({"filename": str(filename), "image_index": 1})
+        ws.receive_json()
+        ws.receive_bytes()
+        for _ in range(100):
+            if len(rendered) > 4:
+                break
+            time.sleep(0.01)
+        assert rendered == [1, 2, 3, 4, 5]
+
+        # Prefetched frames are sent from the cache
+        ws.send_json({"image_index": 2})
+        assert ws.receive_json()["image_index"] == 2
+        assert ws.receive_bytes() == b"2"
+    assert rendered.count(2) == 1
+
+
+def test_image_stream_drops_stale_images_before_rendering(
+    client, authentication_headers, rendered, tmp_path, monkeypatch
+):
+    filename = tmp_path / "image_00001.cbf"
+    filename.write_bytes(b"")
+    # Hold up the first request until the next one has arrived
+    next_request = threading.Event()
+    bitmap_cache_key = viewer._bitmap_cache_key
+
+    def slow_bitmap_cache_key(params):
+        if params.image_index == 1:
+            next_request.wait(5)
+        return bitmap_cache_key(params)
+
+    monkeypatch.setattr(viewer, "_bitmap_cache_key", slow_bitmap_cache_key)
+    with client.websocket_connect(
+        "export_bitmap/ws", headers=authentication_headers
+    ) as ws:
+        ws.send_json({"filename": str(filename), "image_index": 1})
+        ws.send_json({"image_index": 8})
+        time.sleep(0.1)
+        next_request.set()
+        assert ws.receive_json()["image_index"] == 8
+        assert ws.receive_bytes() == b"8"
+    assert 1 not in rendered
+
+
+def test_image_stream_prefetch_failure_is_logged(
+    client, authentication_headers, rendered, tmp_path, monkeypatch, caplog
+):
+    filename = tmp_path / "image_00001.cbf"
+    filename.write_bytes(b"")
+    image_as_bitmap = viewer._image_as_bitmap
+
+    def image_as_bitmap_failing(params):
+        if params.image_index == 3:
+            raise RuntimeError("Corrupt image")
+        return image_as_bitmap(params)
+
+    monkeypatch.setattr(viewer, "_image_as_bitmap", image_as_bitmap_failing)
+    with client.websocket_connect(
+        "export_bitmap/ws", headers=authentication_headers
+    ) as ws:
+        ws.send_json({"filename": str(filename), "image_index": 1})
+        ws.receive_json()
+        ws.receive_bytes()
+        for _ in range(100):
+            if "Failed to prefetch image 3" in caplog.text:
+                break
+            time.sleep(0.01)
+        # Prefetching stops at the failure, and the stream carries on
+        assert rendered == [1, 2]
+        ws.send_json({"image_index": 2})
+        assert ws.receive_json()["image_index"] == 2
+        assert ws.receive_bytes() == b"2"
+    assert "Failed to prefetch image 3" in caplog.text
@@ -0,0 +1,38 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+
+import pytest
+from dateutil.tz import UTC
+from fastapi import HTTPException, status
+
+from dials_rest import auth
+
+
+def test_verify_token_is_cached(access_token):
+    auth.token_cache.clear()
+    token = auth.verify_token(access_token)
+    assert len(auth.token_cache) == 1
+    hits = auth.token_cache.hits
+    assert auth.verify_token(access_token) is token
+    assert auth.token_cache.hits == hits + 1
+
+
+def test_verify_token_invalid_is_not_cached(access_token):
+    auth.token_cache.clear()
+    with pytest.raises(HTTPException) as e:
+        auth.verify_token(access_token[:-2])
+    assert e.value.status_code == status.HTTP_401_UNAUTHORIZED
+    assert len(auth.token_cache) == 0
+
+
+def test_verify_token_expired_is_not_served_from_cache(access_token, monkeypatch):
+    auth.token_cache.clear()
+    token = auth.verify_token(access_token)
+    # Pretend the token has since expired
+    monkeypatch.setattr(token, "expiry", datetime.now(tz=UTC) - timedelta(seconds=1))
+    with pytest.raises(HTTPException) as e:
+        auth.verify_token(access_token)
+    assert e.value.status_code == status.HTTP_401_UNAUTHORIZED
+    assert e.value.detail == "Expired token"
+    assert len(auth.token_cache) == 0
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from dials_rest.cache import DiskCache, LRUCache, file_identity
+
+
+def test_lru_cache_max_entries():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # "b" was the least recently used
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.get("b") is None
+    assert cache.stats() == {
+        "entries": 2,
+        "bytes": 0,
+        "hits": 3,
+        "misses": 1,
+        "evictions": 1,
+    }
+
+
+def test_lru_cache_max_bytes():
+    cache = LRUCache(max_bytes=10, sizeof=len)
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.nbytes == 10
+    cache.put("c", b"123")
+    assert "a" not in cache
+    assert cache.nbytes == 8
+    # Values larger than the budget are never cached
+    cache.put("d", b"12345678901")
+    assert "d" not in cache
+    assert len(cache) == 2
+    with pytest.raises(ValueError):
+        LRUCache(max_bytes=10)
+
+
+def test_lru_cache_get_or_create_and_discard():
+    cache = LRUCache()
+    calls = []
+
+    def factory():
+        calls.append(1)
+        return "value"
+
+    assert cache.get_or_create(("x", 1), factory) == "value"
+    assert cache.get_or_create(("x", 1), factory) == "value"
+    assert len(calls) == 1
+    cache.put(("x", 2), "other")
+    cache.put(("y", 1), "other")
+    assert cache.discard(lambda k: k[0] == "x") == 2
+    assert len(cache) == 1
+
+
+def test_disk_cache(tmp_path):
+    cache = DiskCache(tmp_path / "cache", max_bytes=10)
+    assert cache.get("a") is None
+    cache.put("a", b"12345")
+    cache.put("b", b"12345")
+    assert cache.get("a") == b"12345"
+    cache.put("c", b"123")
+    # "b" was the least recently used
+    assert cache.get("b") is None
+    assert not (tmp_path / "cache" / "b").exists()
+    assert cache.stats() == {
+        "entries": 2,
+        "bytes": 8,
+        "hits": 1,
+        "misses": 2,
+        "evictions": 1,
+    }
+
+    # Existing entries are picked up by a new cache using the same directory
+    cache = DiskCache(tmp_path / "cache", max_bytes=10)
+    assert len(cache) == 2
+    assert cache.get("c") == b"123"
+
+
+def test_file_identity(tmp_path):
+    filename = tmp_path / "image_00001.cbf"
+    assert file_identity(filename) is None
+    filename.write_bytes(b"foo")
+    identity = file_identity(filename)
+    assert identity is not None and identity[1] == 3
+    os.utime(filename, ns=(0, 0))
+    assert file_identity(filename) != identity
+    # Templates are identified by their containing directory
+    template = tmp_path / "image_#####.cbf"
+    assert file_identity(template) is not None
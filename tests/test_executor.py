@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException, status
+
+from dials_rest.executor import SingleFlight, WorkerPool
+
+
+def _add(a, b):
+    return a + b
+
+
+def _not_found():
+    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not here")
+
+
+def test_worker_pool_run():
+    pool = WorkerPool(max_workers=2)
+    assert asyncio.run(pool.run(_add, 1, b=2)) == 3
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+@pytest.mark.parametrize("kind", ["thread", "process"])
+def test_worker_pool_propagates_http_exceptions(kind):
+    pool = WorkerPool(kind=kind, max_workers=1)
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(pool.run(_not_found))
+    assert e.value.status_code == status.HTTP_404_NOT_FOUND
+    assert e.value.detail == "Not here"
+    pool.shutdown()
+
+
+def test_worker_pool_saturated_responds_503():
+    pool = WorkerPool(max_workers=1, max_queued_jobs=1)
+    release = threading.Event()
+
+    async def main():
+        jobs = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        assert pool.saturated
+        with pytest.raises(HTTPException) as e:
+            await pool.run(_add, 1, 2)
+        assert e.value.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+        release.set()
+        await asyncio.gather(*jobs)
+
+    asyncio.run(main())
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+def test_worker_pool_timeout_responds_504():
+    pool = WorkerPool(max_workers=1, timeout=0.1)
+    release = threading.Event()
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(pool.run(release.wait))
+    assert e.value.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+    # The timed out job still occupies its worker until it completes
+    assert pool.pending == 1
+    release.set()
+    pool.shutdown()
+
+
+def test_worker_pool_imap_unordered():
+    pool = WorkerPool(max_workers=2)
+
+    async def main():
+        return [item async for item in pool.imap_unordered(abs, range(-5, 5))]
+
+    results = asyncio.run(main())
+    assert sorted(results) == [(i, abs(i)) for i in range(-5, 5)]
+    assert pool.pending == 0
+    pool.shutdown()
+
+
+def test_worker_pool_imap_unordered_propagates_http_exceptions():
+    pool = WorkerPool(max_workers=2)
+
+    def not_found_if_odd(i):
+        if i % 2:
+            _not_found()
+        return i
+
+    async def main():
+        return [item async for item in pool.imap_unordered(not_found_if_odd, range(4))]
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(main())
+    assert e.value.status_code == status.HTTP_404_NOT_FOUND
+    pool.shutdown()
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value
+
+    async def main():
+        results = await asyncio.gather(
+            single_flight.run("a", lambda: compute(1)),
+            single_flight.run("a", lambda: compute(2)),
+            single_flight.run("b", lambda: compute(3)),
+        )
+        assert len(single_flight) == 0
+        # Nothing is remembered once the computation has completed
+        assert await single_flight.run("a", lambda: compute(4)) == 4
+        return results
+
+    assert asyncio.run(main()) == [1, 1, 3]
+    assert calls == [1, 3, 4]
+    assert single_flight.coalesced == 1
+
+
+def test_single_flight_shares_exceptions_and_survives_cancellation():
+    single_flight = SingleFlight()
+
+    async def not_found():
+        await asyncio.sleep(0.05)
+        _not_found()
+
+    async def main():
+        first = asyncio.ensure_future(single_flight.run("a", not_found))
+        second = asyncio.ensure_future(single_flight.run("a", not_found))
+        await asyncio.sleep(0.01)
+        # The first caller going away doesn't affect the second
+        first.cancel()
+        with pytest.raises(HTTPException) as e:
+            await second
+        assert e.value.status_code == status.HTTP_404_NOT_FOUND
+
+    asyncio.run(main())
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+import os
+import shutil
+
+import pytest
+from fastapi import HTTPException, status
+
+from dials_rest import experiments
+
+
+@pytest.fixture(autouse=True)
+def empty_experiment_cache():
+    experiments.experiment_cache.clear()
+
+
+def test_import_experiments_file_not_found_raises_404(tmp_path):
+    with pytest.raises(HTTPException) as e:
+        experiments.import_experiments(tmp_path / "image_00001.cbf")
+    assert e.value.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_import_experiments_is_cached(dials_data, tmp_path):
+    filename = tmp_path / "centroid_0001.cbf"
+    shutil.copy(
+        dials_data("centroid_test_data", pathlib=True) / filename.name, filename
+    )
+    cache = experiments.experiment_cache
+
+    first = experiments.import_experiments(filename)
+    assert experiments.import_experiments(filename) is first
+    assert cache.hits == 1
+
+    # Modifying the file invalidates the cached experiments
+    st = filename.stat()
+    os.utime(filename, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert experiments.import_experiments(filename) is not first
+    assert len(cache) == 1
+
+
+def test_import_experiment_for_image_does_not_modify_cached_experiment(dials_data):
+    filename = dials_data("vmxi_thaumatin", pathlib=True) / "image_15799_master.h5"
+    cached = experiments.import_experiments(filename, load_models=False)[0]
+    first = experiments.import_experiment_for_image(filename, 1)
+    second = experiments.import_experiment_for_image(filename, 2)
+    assert first is not cached and second is not cached
+    assert first.imageset is cached.imageset
+    assert first.detector is not None and second.detector is not None
+    assert cached.beam is None
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from dials_rest import geometry as geometry_module
+from dials_rest.geometry import DetectorGeometry, geometry_key
+
+
+def test_geometry_key(make_detector_and_beam):
+    detector, beam = make_detector_and_beam()
+    assert geometry_key(detector, beam) == geometry_key(*make_detector_and_beam())
+    assert geometry_key(detector, beam) != geometry_key(
+        *make_detector_and_beam(wavelength=0.9)
+    )
+    assert geometry_key(detector, beam) != geometry_key(
+        *make_detector_and_beam(distance=200)
+    )
+
+
+def test_d_star_sq(make_detector_and_beam):
+    geometry = DetectorGeometry(*make_detector_and_beam())
+    (d_star_sq,) = geometry.d_star_sq()
+    assert d_star_sq.shape == (80, 100)
+    # Increases away from the beam centre, out to the maximum resolution
+    centre = d_star_sq[39:41, 49:51]
+    assert d_star_sq.min() == pytest.approx(centre.min())
+    assert 1 / np.sqrt(d_star_sq.max()) == pytest.approx(
+        geometry.max_resolution, rel=2e-2
+    )
+    # Binned pixels are sampled at the centre of each block of pixels
+    (binned,) = geometry.d_star_sq(binning=4)
+    assert binned.shape == (20, 25)
+    assert binned[0, 0] == pytest.approx(d_star_sq[1:3, 1:3].mean(), rel=1e-3)
+    assert geometry.d_star_sq(binning=4)[0] is binned
+
+
+def test_resolution_ring_spacings(make_detector_and_beam):
+    geometry = DetectorGeometry(*make_detector_and_beam())
+    spacings = geometry.resolution_ring_spacings(4)
+    d_star_sq = 1 / np.square(spacings)
+    assert np.allclose(np.diff(d_star_sq), d_star_sq[0])
+    assert d_star_sq[-1] == pytest.approx(0.8 / geometry.max_resolution**2)
+
+
+@pytest.mark.parametrize("binning", [1, 2])
+def test_rings(binning, make_detector_and_beam):
+    geometry = DetectorGeometry(*make_detector_and_beam())
+    d_spacings = geometry.resolution_ring_spacings(3)
+    rings = geometry.rings(d_spacings, binning=binning)
+    assert geometry.rings(d_spacings, binning=binning) is rings
+    (mask,) = rings.masks
+    assert mask.shape == geometry.d_star_sq(binning)[0].shape
+    assert mask.any() and not mask.all()
+    # A ring is about as wide as the line width where it crosses the beam centre
+    (single,) = geometry.rings(d_spacings[:1], binning=binning).masks
+    assert 2 <= single[single.shape[0] // 2].sum() <= 6
+    for panel, x, y in rings.label_positions:
+        assert panel == 0
+        assert mask[y, x]
+    # The label of a ring that is entirely on the detector is above the beam centre
+    _, x, _ = rings.label_positions[0]
+    assert abs(x - mask.shape[1] / 2) <= 1
+    ys = [y for _, _, y in rings.label_positions]
+    assert ys == sorted(ys, reverse=True)
+
+
+def test_rings_off_the_detector(make_detector_and_beam):
+    geometry = DetectorGeometry(*make_detector_and_beam())
+    rings = geometry.rings([geometry.max_resolution / 2])
+    assert not rings.masks[0].any()
+    assert rings.label_positions == [None]
+
+
+def test_computed_in_blocks_of_rows(make_detector_and_beam, monkeypatch):
+    expected = DetectorGeometry(*make_detector_and_beam())
+    monkeypatch.setattr(geometry_module, "_BLOCK_ROWS", 7)
+    geometry = DetectorGeometry(*make_detector_and_beam())
+    (d_star_sq,) = geometry.d_star_sq()
+    assert d_star_sq.dtype == np.float32
+    assert geometry.shape() == [d_star_sq.shape]
+    np.testing.assert_array_equal(d_star_sq, expected.d_star_sq()[0])
+    d_spacings = geometry.resolution_ring_spacings(3)
+    rings = geometry.rings(d_spacings)
+    expected_rings = expected.rings(d_spacings)
+    np.testing.assert_array_equal(rings.masks[0], expected_rings.masks[0])
+    assert rings.label_positions == expected_rings.label_positions
+
+
+def test_geometry_cache_counts_bytes(monkeypatch, make_detector_and_beam):
+    cache = geometry_module.LRUCache(max_bytes=10**6, sizeof=lambda g: g.nbytes)
+    monkeypatch.setattr(geometry_module, "geometry_cache", cache)
+    geometry = geometry_module.get_geometry(*make_detector_and_beam())
+    assert cache.nbytes == 0
+    geometry.d_star_sq()
+    assert cache.nbytes == geometry.nbytes == 80 * 100 * 4
+    geometry.rings(geometry.resolution_ring_spacings(3))
+    assert cache.nbytes == 80 * 100 * 5
+    # A geometry that outgrows the budget is no longer cached
+    large = geometry_module.get_geometry(
+        *make_detector_and_beam(image_size=(1000, 1000))
+    )
+    assert len(cache) == 2
+    large.d_star_sq()
+    assert large.key not in cache and geometry.key in cache
@@ -0,0 +1,65 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from dials_rest.imaging import bin_pixels, downsample, pyramid, stack
+
+
+def test_downsample_rgb():
+    image = np.zeros((5, 7, 3), dtype=np.uint8)
+    image[:2, :2] = [255, 1, 2]
+    binned = downsample(image)
+    assert binned.shape == (2, 3, 3)
+    assert binned.dtype == np.uint8
+    assert binned[0, 0].tolist() == [255, 1, 2]
+    assert binned[1:, 1:].sum() == 0
+
+
+def test_downsample_float():
+    image = np.arange(16, dtype=np.float64).reshape(4, 4)
+    assert downsample(image, factor=4).tolist() == [[7.5]]
+
+
+def test_pyramid():
+    image = np.ones((2527, 2463, 3), dtype=np.uint8)
+    levels = pyramid(image, n_levels=5)
+    assert [level.shape[:2] for level in levels] == [
+        (2527, 2463),
+        (1263, 1231),
+        (631, 615),
+        (315, 307),
+        (157, 153),
+    ]
+    assert all((level == 1).all() for level in levels)
+    # Stops once the image can't be downsampled any further
+    assert len(pyramid(np.ones((4, 4)), n_levels=5)) == 3
+
+
+def test_bin_pixels():
+    data = np.arange(20, dtype=np.int32).reshape(4, 5)
+    assert bin_pixels(data, 1) is data
+    assert bin_pixels(data, 2).tolist() == [[12, 20], [52, 60]]
+    mask = np.ones_like(data, dtype=bool)
+    mask[:2, :2] = False
+    mask[2, 2] = False
+    assert bin_pixels(data, 2, mask=mask).tolist() == [[-1, 20], [52, 48]]
+    # Integer overflow is clipped rather than wrapping around
+    data = np.full((2, 2), 100, dtype=np.int8)
+    assert bin_pixels(data, 2).tolist() == [[127]]
+
+
+@pytest.mark.parametrize(
+    "mode,expected", [("sum", [[3, 0]]), ("mean", [[1, 0]]), ("max", [[2, 1]])]
+)
+def test_stack(mode, expected):
+    frames = (
+        (np.array([[i, 1 - i]], dtype=np.int32), np.full((2, 2), i)) for i in range(3)
+    )
+    stacked = stack(frames, mode)
+    assert len(stacked) == 2
+    assert stacked[0].dtype == np.float64
+    assert stacked[0].tolist() == expected
+    assert stacked[1].shape == (2, 2)
+    with pytest.raises(ValueError):
+        stack([], mode)
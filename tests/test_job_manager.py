@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from dateutil.tz import UTC
+from fastapi import HTTPException, status
+
+from dials_rest import jobs
+from dials_rest.jobs import Job, JobError, JobManager, JobStatus
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        yield jobs.InMemoryJobStore()
+    else:
+        store = jobs.SQLiteJobStore(tmp_path / "jobs.sqlite")
+        yield store
+        store.close()
+
+
+def test_job_store(store):
+    now = datetime.now(tz=UTC)
+    store.create(Job(job_id="a", created=now, updated=now))
+    assert store.get("a").status is JobStatus.queued
+    assert store.get("x") is None
+    store.update("a", status=JobStatus.running, total=2)
+    store.add_result("a", {"image_index": 1})
+    job = store.get("a")
+    assert job.status is JobStatus.running
+    assert (job.progress.done, job.progress.total) == (1, 2)
+    assert job.results == [{"image_index": 1}]
+    store.update(
+        "a", status=JobStatus.failed, error=JobError(status_code=404, detail="x")
+    )
+    job = store.get("a")
+    assert job.finished
+    assert job.error.status_code == 404
+    store.create(Job(job_id="b", created=now, updated=now))
+    store.create(Job(job_id="c", created=now, updated=now))
+    store.update("c", status=JobStatus.running)
+    assert store.delete_expired(now) == 0
+    assert store.delete_expired(now + timedelta(days=1)) == 1
+    assert store.get("a") is None
+    assert store.get("b").status is JobStatus.queued
+    assert store.get("c").status is JobStatus.running
+    assert not store.delete("a")
+
+
+def test_job_manager(store):
+    async def work(context):
+        context.set_total(3)
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            context.add_result({"i": i})
+
+    async def fail(context):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not here")
+
+    async def main():
+        manager = JobManager(store, max_running_jobs=1)
+        job = manager.submit(work)
+        failed = manager.submit(fail)
+        assert job.status is JobStatus.queued
+        job = await manager.wait(job.job_id, timeout=5)
+        assert job.status is JobStatus.completed
+        assert job.progress.done == job.progress.total == 3
+        assert job.results == [{"i": i} for i in range(3)]
+        failed = await manager.wait(failed.job_id, timeout=5)
+        assert failed.status is JobStatus.failed
+        assert failed.error.status_code == status.HTTP_404_NOT_FOUND
+        assert failed.error.detail == "Not here"
+
+    asyncio.run(main())
+
+
+def test_job_manager_cancel(store):
+    async def main():
+        manager = JobManager(store)
+        job = manager.submit(lambda context: asyncio.sleep(10))
+        assert (await manager.wait(job.job_id, timeout=0.1)).status in {
+            JobStatus.queued,
+            JobStatus.running,
+        }
+        assert manager.cancel(job.job_id)
+        assert manager.get(job.job_id) is None
+        assert not manager.cancel(job.job_id)
+
+    asyncio.run(main())
+
+
+def test_job_manager_keeps_unfinished_jobs(store, monkeypatch):
+    monkeypatch.setattr(JobManager, "CLEANUP_INTERVAL", 0)
+
+    async def main():
+        manager = JobManager(store, max_running_jobs=1, ttl=0.01)
+        finish = asyncio.Event()
+
+        async def long_running(context):
+            await finish.wait()
+
+        running = manager.submit(long_running)
+        queued = manager.submit(long_running)
+        await asyncio.sleep(0.1)
+        assert manager.get(running.job_id).status is JobStatus.running
+        assert manager.get(queued.job_id).status is JobStatus.queued
+        finish.set()
+        assert (await manager.wait(queued.job_id, timeout=5)).finished
+        await asyncio.sleep(0.1)
+        assert manager.get(running.job_id) is None
+        assert manager.get(queued.job_id) is None
+
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from dials_rest import executor
+from dials_rest.cache import LRUCache
+from dials_rest.executor import WorkerPool
+from dials_rest.metrics import (
+    record_stage,
+    recording_stages,
+    register_cache_metrics,
+    register_worker_pool_metrics,
+    stage_timer,
+)
+
+
+def _stages():
+    with stage_timer("a", fmt="FormatCBF", detector="1x10x10"):
+        pass
+    record_stage("b", 0.5)
+    return 42
+
+
+def test_recording_stages():
+    with recording_stages() as timings:
+        assert _stages() == 42
+    assert [t[:3] for t in timings] == [("a", "FormatCBF", "1x10x10"), ("b", "", "")]
+    assert timings[1][3] == 0.5
+
+
+@pytest.mark.parametrize("kind", ["thread", "process"])
+def test_worker_pool_observes_stages(kind, monkeypatch):
+    observed = []
+    monkeypatch.setattr(executor, "observe_stages", observed.extend)
+    pool = executor.WorkerPool(kind=kind, max_workers=1)
+    assert asyncio.run(pool.run(_stages)) == 42
+    pool.shutdown()
+    assert [t[0] for t in observed] == ["a", "b"]
+
+
+def test_cache_collector():
+    prometheus_client = pytest.importorskip("prometheus_client")
+
+    cache = LRUCache(max_entries=1)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    registry = prometheus_client.CollectorRegistry()
+    register_cache_metrics({"test": cache}, registry=registry)
+    labels = {"cache": "test"}
+    assert registry.get_sample_value("dials_rest_cache_entries", labels) == 1
+    assert registry.get_sample_value("dials_rest_cache_hits_total", labels) == 1
+    assert registry.get_sample_value("dials_rest_cache_misses_total", labels) == 1
+
+
+def test_worker_pool_collector():
+    prometheus_client = pytest.importorskip("prometheus_client")
+
+    pool = WorkerPool(max_workers=3)
+    registry = prometheus_client.CollectorRegistry()
+    register_worker_pool_metrics(lambda: pool, registry=registry)
+    assert registry.get_sample_value("dials_rest_worker_pool_pending") == 0
+    assert registry.get_sample_value("dials_rest_worker_pool_workers") == 3
+    pool.shutdown()
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+
+import pytest
+
+from dials_rest import prefetch
+
+
+class _Panel:
+    def size(self):
+        return 100
+
+
+class _ImageSet:
+    """One file per frame, recording which frames are read"""
+
+    def __init__(self, directory, n_images=20, paths=None):
+        if paths is None:
+            paths = [directory / f"image_{i:03d}.cbf" for i in range(n_images)]
+            for path in paths:
+                path.write_bytes(b"")
+        self.paths = paths
+        self.reads = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get_path(self, index):
+        return str(self.paths[index])
+
+    def get_raw_data(self, index):
+        with self._lock:
+            self.reads.append(index)
+        return (_Panel(),)
+
+
+def _wait_for_reads(prefetcher):
+    for _ in range(100):
+        if not prefetcher._pending:
+            return
+        time.sleep(0.01)
+
+
+def test_access_pattern():
+    pattern = prefetch._AccessPattern()
+    depths = []
+    for index in (0, 1, 2, 3, 4, 5, 5, 6):
+        pattern.update(index, max_depth=4)
+        depths.append(pattern.depth)
+    assert depths == [0, 1, 2, 4, 4, 4, 4, 4]
+    # Jumping about stops reading ahead
+    pattern.update(20, max_depth=4)
+    assert pattern.depth == 0
+    # Playing backwards reads ahead backwards
+    pattern.update(19, max_depth=4)
+    pattern.update(18, max_depth=4)
+    assert (pattern.step, pattern.depth) == (-1, 2)
+    pattern.update(19, max_depth=4)
+    assert (pattern.step, pattern.depth) == (1, 1)
+
+
+def test_prefetcher_reads_ahead(tmp_path):
+    prefetcher = prefetch.FramePrefetcher(max_depth=4, max_bytes=2**20)
+    imageset = _ImageSet(tmp_path)
+    for index in range(8):
+        prefetcher.get_raw_data("dataset", imageset, index)
+        _wait_for_reads(prefetcher)
+    # Each frame is read once, and only after the first two frames are frames
+    # read ahead, up to four frames ahead
+    assert sorted(imageset.reads) == list(range(12))
+    assert prefetcher.cache.hits >= 5
+
+    # Random access doesn't read ahead
+    prefetcher.get_raw_data("dataset", imageset, 18)
+    _wait_for_reads(prefetcher)
+    assert imageset.reads[-1] == 18
+    assert 19 not in imageset.reads
+
+
+def test_prefetcher_rereads_modified_frames(tmp_path):
+    prefetcher = prefetch.FramePrefetcher(max_depth=4, max_bytes=2**20)
+    imageset = _ImageSet(tmp_path)
+    prefetcher.get_raw_data("dataset", imageset, 0)
+    prefetcher.get_raw_data("dataset", imageset, 0)
+    assert imageset.reads == [0]
+    st = imageset.paths[0].stat()
+    os.utime(imageset.paths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    prefetcher.get_raw_data("dataset", imageset, 0)
+    assert imageset.reads == [0, 0]
+
+
+def test_prefetcher_disabled(tmp_path):
+    prefetcher = prefetch.FramePrefetcher(max_depth=0, max_bytes=2**20)
+    imageset = _ImageSet(tmp_path)
+    for index in (0, 0, 1, 2, 3):
+        prefetcher.get_raw_data("dataset", imageset, index)
+    assert imageset.reads == [0, 0, 1, 2, 3]
+    assert len(prefetcher.cache) == 0
+
+
+def test_prefetching_imageset(tmp_path):
+    prefetcher = prefetch.FramePrefetcher(max_depth=4, max_bytes=2**20)
+    imageset = prefetch.PrefetchingImageSet(_ImageSet(tmp_path), "dataset", prefetcher)
+    assert len(imageset) == 20
+    assert imageset.get_path(1).endswith("image_001.cbf")
+    imageset.get_raw_data(1)
+    imageset.get_raw_data(1)
+    assert imageset.reads == [1]
+
+
+def test_prefetcher_only_caches_written_frames(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    with h5py.File(filename, "w") as f:
+        dataset = f.create_group("entry/data").create_dataset(
+            "data", shape=(10, 4, 4), dtype="i4", chunks=(1, 4, 4)
+        )
+        dataset[:3] = 1
+    prefetcher = prefetch.FramePrefetcher(max_depth=4, max_bytes=2**20)
+    imageset = _ImageSet(tmp_path, paths=[filename] * 10)
+    for index in range(3):
+        prefetcher.get_raw_data("dataset", imageset, index)
+        _wait_for_reads(prefetcher)
+    # Nothing is read ahead past the frames written so far
+    assert sorted(imageset.reads) == [0, 1, 2]
+
+    # Frames that haven't been written yet are read, but not cached
+    for _ in range(2):
+        prefetcher.get_raw_data("dataset", imageset, 3)
+        _wait_for_reads(prefetcher)
+    assert sorted(imageset.reads) == [0, 1, 2, 3, 3]
+    with h5py.File(filename, "r+") as f:
+        f["entry/data/data"][3:5] = 1
+    prefetcher.get_raw_data("dataset", imageset, 3)
+    prefetcher.get_raw_data("dataset", imageset, 3)
+    _wait_for_reads(prefetcher)
+    assert sorted(imageset.reads) == [0, 1, 2, 3, 3, 3, 4]
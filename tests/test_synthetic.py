@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import numpy as np
+import pytest
+
+from dials_rest import synthetic
+
+
+def _byte_offset_decompress(data: bytes, n: int) -> np.ndarray:
+    buf = np.frombuffer(data, dtype=np.uint8)
+    values = np.empty(n, dtype=np.int64)
+    pos, current = 0, 0
+    for i in range(n):
+        delta = int(buf[pos : pos + 1].view(np.int8)[0])
+        pos += 1
+        if delta == -0x80:
+            delta = int(buf[pos : pos + 2].view("<i2")[0])
+            pos += 2
+            if delta == -0x8000:
+                delta = int(buf[pos : pos + 4].view("<i4")[0])
+                pos += 4
+        current += delta
+        values[i] = current
+    assert pos == len(buf)
+    return values
+
+
+def test_byte_offset_compress_round_trip():
+    data = np.array(
+        [0, 1, -1, 127, -127, 128, -128, 32767, -32767, 32768, 2**30, -(2**29), 5],
+        dtype=np.int32,
+    )
+    compressed = synthetic.byte_offset_compress(data)
+    np.testing.assert_array_equal(_byte_offset_decompress(compressed, data.size), data)
+
+
+def test_synthetic_image():
+    rng = np.random.default_rng(42)
+    image = synthetic.synthetic_image((50, 60), n_spots=10, rng=rng)
+    assert image.shape == (50, 60)
+    assert image.dtype == np.int32
+    assert image.min() >= 0
+    # The spots stand out from the background
+    assert image.max() > 100
+
+
+def test_write_cbf(tmp_path):
+    rng = np.random.default_rng(42)
+    image = synthetic.synthetic_image((50, 60), n_spots=10, rng=rng)
+    path = tmp_path / "image_00001.cbf"
+    synthetic.write_cbf(path, image)
+    content = path.read_bytes()
+    assert content.startswith(b"###CBF: VERSION 1.5")
+    assert b"X-Binary-Size-Fastest-Dimension: 60\r\n" in content
+    assert b"X-Binary-Size-Second-Dimension: 50\r\n" in content
+    start = content.index(b"\x0c\x1a\x04\xd5") + 4
+    compressed = synthetic.byte_offset_compress(image)
+    assert content[start : start + len(compressed)] == compressed
+
+
+def test_write_nexus(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    rng = np.random.default_rng(42)
+    images = [synthetic.synthetic_image((50, 60), 10, rng) for _ in range(3)]
+    path = tmp_path / "synthetic.nxs"
+    synthetic.write_nexus(path, images, 3, (50, 60))
+    with h5py.File(path) as f:
+        assert f["/entry/definition"][()] == b"NXmx"
+        np.testing.assert_array_equal(f["/entry/data/data"][2], images[2])
+        omega = f["/entry/sample/transformations/omega"]
+        np.testing.assert_allclose(omega[()], [0, 0.1, 0.2])
+        assert omega.attrs["transformation_type"] == "rotation"
+
+
+@pytest.mark.parametrize("fmt", ["cbf", "nexus"])
+def test_synthetic_dataset_imports_with_dxtbx(fmt, tmp_path):
+    pytest.importorskip("dxtbx")
+    from dxtbx.model.experiment_list import ExperimentListFactory
+
+    geometry = synthetic.Geometry()
+    rng = np.random.default_rng(42)
+    images = [synthetic.synthetic_image((50, 60), 10, rng) for _ in range(3)]
+    if fmt == "cbf":
+        for i, image in enumerate(images, start=1):
+            synthetic.write_cbf(tmp_path / f"synthetic_{i:05d}.cbf", image, i, geometry)
+        experiments = ExperimentListFactory.from_templates(
+            [tmp_path / "synthetic_#####.cbf"]
+        )
+    else:
+        pytest.importorskip("h5py")
+        path = tmp_path / "synthetic.nxs"
+        synthetic.write_nexus(path, images, 3, (50, 60), geometry)
+        experiments = ExperimentListFactory.from_filenames([path])
+
+    assert len(experiments) == 1
+    expt = experiments[0]
+    assert len(expt.imageset) == 3
+    assert expt.scan.get_oscillation()[1] == pytest.approx(geometry.oscillation)
+    assert expt.beam.get_wavelength() == pytest.approx(geometry.wavelength)
+    panel = expt.detector[0]
+    assert panel.get_image_size() == (60, 50)
+    assert panel.get_pixel_size() == pytest.approx(
+        (geometry.pixel_size, geometry.pixel_size)
+    )
+    assert panel.get_distance() == pytest.approx(geometry.distance)
+    np.testing.assert_array_equal(
+        expt.imageset.get_raw_data(2)[0].as_numpy_array(), images[2]
+    )
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import asyncio
+import subprocess
+import sys
+import time
+
+import pytest
+from fastapi import status
+
+from dials_rest import main, warmup
+from dials_rest.routers import image
+
+
+@pytest.fixture
+def fresh_warmup(monkeypatch):
+    """Warm up from scratch, importing a stand-in for the DIALS stack"""
+    monkeypatch.setattr(warmup, "DIALS_MODULES", ("json",))
+    monkeypatch.setattr(warmup, "_imported", warmup.threading.Event())
+    monkeypatch.setattr(warmup, "_ready", warmup.threading.Event())
+    monkeypatch.setattr(warmup, "error", None)
+
+
+def _wait_until_ready(client):
+    for _ in range(100):
+        response = client.get("/readyz")
+        if response.status_code == status.HTTP_200_OK:
+            break
+        time.sleep(0.01)
+    return response
+
+
+def test_healthz(client):
+    response = client.get("/healthz")
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"status": "ok"}
+
+
+def test_readyz(client, fresh_warmup):
+    response = client.get("/readyz")
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.json()["ready"] is False
+    assert response.json()["checks"]["dials"] is False
+
+    with client:
+        response = _wait_until_ready(client)
+    assert response.status_code == status.HTTP_200_OK
+    body = response.json()
+    assert body["ready"] is True
+    assert body["checks"] == {"dials": True, "preload": True, "worker_pool": True}
+    assert body["error"] is None
+    assert body["startup_seconds"]["startup"] <= body["startup_seconds"]["ready"]
+
+
+def test_readyz_reports_import_error(client, fresh_warmup, monkeypatch):
+    monkeypatch.setattr(warmup, "DIALS_MODULES", ("made_up_module",))
+    asyncio.run(warmup.warm_up())
+    response = client.get("/readyz")
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert "made_up_module" in response.json()["error"]
+
+
+def test_preload(client, fresh_warmup, monkeypatch, tmp_path):
+    preloaded = []
+
+    async def preload(filename, binning, worker_pool):
+        preloaded.append((filename, binning))
+        await asyncio.sleep(0.1)
+
+    monkeypatch.setattr(image, "preload", preload)
+    filenames = [tmp_path / "a.nxs", tmp_path / "b_#####.cbf"]
+    monkeypatch.setattr(main.settings, "preload", filenames)
+    monkeypatch.setattr(main.settings, "preload_binning", [1, 4])
+    with client:
+        assert client.get("/readyz").json()["checks"]["preload"] is False
+        response = _wait_until_ready(client)
+    assert response.status_code == status.HTTP_200_OK
+    assert preloaded == [(filename, [1, 4]) for filename in filenames]
+
+
+def test_shutdown_cancels_preload(client, fresh_warmup, monkeypatch, tmp_path):
+    cancelled = []
+
+    async def preload(filename, binning, worker_pool):
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(filename)
+            raise
+
+    monkeypatch.setattr(image, "preload", preload)
+    monkeypatch.setattr(main.settings, "preload", [tmp_path / "a.nxs"])
+    with client:
+        for _ in range(100):
+            if warmup.is_imported():
+                break
+            time.sleep(0.01)
+    assert cancelled == [tmp_path / "a.nxs"]
+    assert main._warm_up is None
+    assert not warmup.is_ready()
+
+
+def test_failed_preload_does_not_stop_ready(client, fresh_warmup):
+    async def fail():
+        raise FileNotFoundError("/made/up/path.cbf")
+
+    asyncio.run(warmup.warm_up([("/made/up/path.cbf", fail)]))
+    assert warmup.is_ready()
+    response = client.get("/readyz")
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_app_starts_without_importing_dials():
+    code = (
+        "import sys, dials_rest.main; "
+        "print(sorted({m.split('.')[0] for m in sys.modules} & {'dials', 'dxtbx', 'cctbx'}))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == "[]"
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import os
+import pathlib
+
+import pytest
+
+from dials_rest import watch
+
+
+def _touch(path: pathlib.Path, age: float = 10):
+    path.write_bytes(b"")
+    st = path.stat()
+    os.utime(path, (st.st_atime, st.st_mtime - age))
+
+
+def test_template_image_path():
+    template = pathlib.Path("/data/image_#####.cbf")
+    assert watch.template_image_path(template, 12) == pathlib.Path(
+        "/data/image_00012.cbf"
+    )
+    assert watch.is_template(template)
+    assert not watch.is_template(pathlib.Path("/data/#1/master.h5"))
+
+
+def test_new_images_template(tmp_path):
+    template = tmp_path / "image_###.cbf"
+    assert watch.new_images(template, 1) == []
+    for i in (1, 2, 3, 5):
+        _touch(tmp_path / f"image_{i:03d}.cbf")
+    # Image 4 is missing, so image 5 isn't new yet
+    assert watch.new_images(template, 1) == [1, 2, 3]
+    assert watch.new_images(template, 2) == [2, 3]
+    # Images that are still being written are skipped
+    _touch(tmp_path / "image_004.cbf", age=0)
+    assert watch.new_images(template, 4, settle_time=5) == []
+    assert watch.new_images(template, 4) == [4, 5]
+
+
+def test_watcher_template(tmp_path):
+    watcher = watch.DatasetWatcher(tmp_path / "image_###.cbf", start=2)
+    assert not watcher.poll()
+    _touch(tmp_path / "image_002.cbf")
+    assert watcher.poll()
+    watcher.update([2])
+    assert watcher.next_image == 3
+    assert not watcher.poll()
+
+
+def test_watcher_file(tmp_path):
+    filename = tmp_path / "images.cbf"
+    watcher = watch.DatasetWatcher(filename)
+    assert not watcher.poll()
+    _touch(filename)
+    # The file must be unchanged for one poll before it is listed
+    assert not watcher.poll()
+    assert watcher.poll()
+    watcher.update([1, 2])
+    assert watcher.next_image == 3
+    assert not watcher.poll()
+    # Growing the file triggers another listing once it settles
+    filename.write_bytes(b"more")
+    assert not watcher.poll()
+    assert watcher.poll()
+    watcher.update([])
+    assert watcher.next_image == 3
+    assert not watcher.poll()
+
+
+def _write_frames(path, n_frames, written):
+    import h5py
+
+    with h5py.File(path, "w") as f:
+        dataset = f.create_dataset(
+            "data", shape=(n_frames, 4, 4), dtype="i4", chunks=(1, 4, 4)
+        )
+        for i in range(written):
+            dataset[i] = i
+
+
+def test_written_frames_of_master_file(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    assert watch.written_frames(filename) == 0
+    with h5py.File(filename, "w") as f:
+        dataset = f.create_group("entry/data").create_dataset(
+            "data", shape=(10, 4, 4), dtype="i4", chunks=(2, 4, 4)
+        )
+        dataset[:3] = 1
+    # Frames are counted a chunk at a time, and the fourth shares the third's
+    assert watch.written_frames(filename) == 4
+
+
+def test_written_frames_of_virtual_dataset(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    layout = h5py.VirtualLayout(shape=(10, 4, 4), dtype="i4")
+    for i in range(2):
+        source = h5py.VirtualSource(f"data_{i}.h5", "data", shape=(5, 4, 4))
+        layout[5 * i : 5 * (i + 1)] = source
+    with h5py.File(filename, "w") as f:
+        f.create_group("entry/data").create_virtual_dataset("data", layout)
+    # Every frame is declared up front, but no data file exists yet
+    assert watch.written_frames(filename) == 0
+    _write_frames(tmp_path / "data_0.h5", 5, 5)
+    _write_frames(tmp_path / "data_1.h5", 5, 2)
+    assert watch.written_frames(filename) == 7
+
+
+def test_written_frames_of_linked_data_files(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    with h5py.File(filename, "w") as f:
+        data = f.create_group("entry/data")
+        for i in (1, 2):
+            data[f"data_{i:06d}"] = h5py.ExternalLink(f"data_{i:06d}.h5", "data")
+    assert watch.written_frames(filename) == 0
+    _write_frames(tmp_path / "data_000001.h5", 5, 3)
+    assert watch.written_frames(filename) == 3
+    _write_frames(tmp_path / "data_000001.h5", 5, 5)
+    _write_frames(tmp_path / "data_000002.h5", 5, 1)
+    assert watch.written_frames(filename) == 6
+
+
+def test_written_frames_without_data_responds_422(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    with h5py.File(filename, "w") as f:
+        f.create_group("entry")
+    with pytest.raises(watch.HTTPException) as e:
+        watch.written_frames(filename)
+    assert e.value.status_code == 422
+
+
+def test_new_images_hdf5(tmp_path, monkeypatch):
+    h5py = pytest.importorskip("h5py")
+    filename = tmp_path / "master.h5"
+    _write_frames(tmp_path / "data.h5", 10, 0)
+    with h5py.File(filename, "w") as f:
+        f.create_group("entry/data")["data"] = h5py.ExternalLink("data.h5", "data")
+    monkeypatch.setattr(watch, "import_experiments", lambda filename: None)
+    monkeypatch.setattr(watch, "image_numbers", lambda experiments: range(1, 11))
+    watcher = watch.DatasetWatcher(filename)
+    assert not watcher.poll()
+    assert watch.new_images(filename, 1) == []
+    _write_frames(tmp_path / "data.h5", 10, 4)
+    assert watcher.poll()
+    # Only the images written so far are listed, although all ten are declared
+    assert watch.new_images(filename, 1) == [1, 2, 3, 4]
+    watcher.update([1, 2, 3, 4])
+    assert not watcher.poll()